@@ -0,0 +1,99 @@
+from trax_aarch64_asm import AArch64Assembler
+from trax_aarch64_disasm import disassemble, TraceListing
+from trax_obj import TraxObject
+
+def test_disassemble_every_encoding():
+    asm = AArch64Assembler()
+    label = asm.new_label()
+    asm.add(1, 2, 3)
+    asm.sub(1, 2, 3)
+    asm.mul(1, 2, 3)
+    asm.madd(1, 2, 3, 4)
+    asm.msub(1, 2, 3, 4)
+    asm.sdiv(1, 2, 3)
+    asm.add_imm(31, 31, 32)
+    asm.sub_imm(1, 2, 5)
+    asm.cmp(1, 2)
+    asm.cmp_imm(1, 3)
+    asm.cmn_imm(1, 3)
+    asm.ccmp(1, 2, 4, AArch64Assembler.NE)
+    asm.ccmp_imm(1, 3, 0, AArch64Assembler.EQ)
+    asm.ccmn_imm(1, 3, 8, AArch64Assembler.GE)
+    asm.mov(1, 2)
+    asm.mov_imm(1, 7)
+    asm.movn(1, 0, 16)
+    asm.movk(1, 0x1234, 32)
+    asm.ldr(1, 0, 16)
+    asm.str(1, 31, 8)
+    asm.ldur(1, 2, 3)
+    asm.stur(1, 2, -5)
+    asm.and_imm(1, 2, 0)
+    asm.ands(31, 2, immr=0, imms=0)
+    asm.lsl(1, 2, 1)
+    asm.lsr(1, 2, 3)
+    asm.asr(1, 2, 1)
+    asm.sbfx(1, 2, 0, 63)
+    asm.eor(1, 2, 3)
+    asm.csel(1, 2, 3, AArch64Assembler.LT)
+    asm.b(label)
+    asm.bne(label)
+    asm.cbz(1, label)
+    asm.tbnz(1, 2, label)
+    asm.blr(16)
+    asm.assign_label(label)
+    asm.ret()
+    asm.add_data(0)
+
+    assert disassemble(asm.to_bytes()) == [
+        'add x1, x2, x3', 'sub x1, x2, x3', 'mul x1, x2, x3', 'madd x1, x2, x3, x4', 'msub x1, x2, x3, x4',
+        'sdiv x1, x2, x3', 'add sp, sp, #0x20', 'sub x1, x2, #5', 'cmp x1, x2', 'cmp x1, #3', 'cmn x1, #3',
+        'ccmp x1, x2, #4, ne', 'ccmp x1, #3, #0, eq', 'ccmn x1, #3, #8, ge', 'mov x1, x2', 'mov x1, #7',
+        'movn x1, #0, lsl #16', 'movk x1, #0x1234, lsl #32', 'ldr x1, [x0, #16]', 'str x1, [sp, #8]',
+        'ldur x1, [x2, #3]', 'stur x1, [x2, #-5]', 'and x1, x2, #0x100000001', 'tst x2, #0x1', 'lsl x1, x2, #1',
+        'lsr x1, x2, #3', 'asr x1, x2, #1', 'sbfx x1, x2, #0, #63', 'eor x1, x2, x3', 'csel x1, x2, x3, lt',
+        'b 0x8c', 'b.ne 0x8c', 'cbz x1, 0x8c', 'tbnz x1, #2, 0x8c', 'blr x16', 'ret', '.word 0x00000000',
+    ]
+
+def test_trace_listing():
+    from trax_aarch64_sim import SimulatorBackend
+    from trax_tracing import TraceCompiler
+
+    constants = [TraxObject.from_int(1)]
+    compiler = TraceCompiler()
+    compiler.loop_header_guard_id = 9
+    n_input = compiler.input(0)
+    i_input = compiler.input(1)
+    values = [n_input, i_input]
+    compiler.guard_int(0, n_input, values)
+    compiler.guard_int(1, i_input, values)
+    compiler.guard_true(2, compiler.lt(i_input, n_input), values)
+    i_input.phi = compiler.add(i_input, compiler.constant(0, 0))
+    compiler.optimize(constants)
+
+    listing = TraceListing()
+    code = SimulatorBackend().compile_trace(compiler, constants, listing)
+    text = str(listing)
+
+    assert dict(listing.section_sizes())['body'] > 0
+    assert sum(size for _, size in listing.section_sizes()) == len(code)
+    assert 'v0 = InputInstruction(input_index=0)  ; -> x3' in text
+    assert 'ldr x3, [x0]' in text
+    assert '; exit for guard_id=2' in text
+    assert '; exit guard_id=2' in text
+
+def test_compare_against_a_constant_too_big_for_an_immediate():
+    from trax_aarch64_sim import SimulatorBackend
+    from trax_tracing import TraceCompiler
+
+    constants = [TraxObject.from_int(5000), TraxObject.from_int(-3)]
+    compiler = TraceCompiler()
+    value = compiler.input(0)
+    big = compiler.constant(0, 0)
+    small = compiler.constant(1, 0)
+
+    asm = AArch64Assembler()
+    backend = SimulatorBackend()
+    backend._emit_compare(asm, value, big, {value: 3}, constants)
+    backend._emit_compare(asm, value, small, {value: 3}, constants)
+    # The tagged 10000 goes through a scratch register
+    assert disassemble(asm.to_bytes()) == ['mov x16, #0x2710', 'cmp x3, x16', 'cmn x3, #6']
@@ -0,0 +1,66 @@
+from trax_aarch64_asm import AArch64Assembler
+from trax_aarch64_sim import SimulatorBackend
+from trax_obj import TraxObject
+
+def test_simulated_loop():
+    asm = AArch64Assembler()
+
+    # Sum the integers below the first input, counting by the second
+    asm.mov(3, 31)
+    asm.mov(4, 31)
+    asm.ldr(5, 0, imm=0)
+    asm.ldr(6, 0, imm=8)
+    loop_start = asm.new_label()
+    asm.assign_label(loop_start)
+    asm.add(4, 4, 3)
+    asm.add(3, 3, 6)
+    asm.cmp(3, 5)
+    asm.blt(loop_start)
+    asm.str(4, 2, imm=0)
+    asm.mov_imm(0, 7)
+    asm.ret()
+
+    be = SimulatorBackend()
+    code = be.create_executable_memory(asm)
+    ct = be.const_table([])
+    guard_id, values = be.call_function(code, [TraxObject.from_int(10), TraxObject.from_int(1)], ct, 1)
+
+    assert guard_id == 7
+    assert values[0].to_int() == 45
+    assert be.stats.instructions == 4 + 4 * 10 + 3
+    assert be.stats.loads == 2 and be.stats.taken_branches == 9
+    # Loads take a few cycles, everything else issues one per cycle
+    assert be.stats.cycles > be.stats.instructions
+
+def test_simulated_trace_allocates_through_the_runtime():
+    from trax_tracing import TraceCompiler
+
+    constants = [TraxObject.from_int(1), TraxObject.from_int(3)]
+    compiler = TraceCompiler()
+    compiler.loop_header_guard_id = 0
+    box, i = compiler.input(0), compiler.input(1)
+    values = [box, i]
+    compiler.guard_index(1, box, 3, values)
+    compiler.guard_int(2, i, values)
+    compiler.guard_true(3, compiler.lt(i, compiler.constant(1, 0)), values)
+    # Push i onto a linked list kept in the box's first field
+    node = compiler.new(4, 2)
+    compiler.set_field(node, 0, i)
+    compiler.set_field(node, 1, compiler.get_field(box, 0))
+    compiler.set_field(box, 0, node)
+    i.phi = compiler.add(i, compiler.constant(0, 0))
+    compiler.optimize(constants)
+
+    be = SimulatorBackend()
+    code = be.compile_trace(compiler, constants)
+    box_obj = TraxObject.new(3, [TraxObject(TraxObject.NIL_TAG)])
+    entry = be.prepare_trace(code, 2, 2, be.const_table(constants))
+
+    assert entry.enter([box_obj, TraxObject.from_int(0)]) == 3
+    assert entry.exit_values(2)[1].to_int() == 3
+    assert be.stats.calls == 3
+    node, items = box_obj.get_field(0), []
+    while node.is_object():
+        items.append(node.get_field(0).to_int())
+        node = node.get_field(1)
+    assert items == [2, 1, 0]
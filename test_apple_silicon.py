@@ -1,4 +1,4 @@
-from trax_aarch64_asm import AArch64Assembler, RelocVar
+from trax_aarch64_asm import AArch64Assembler
 from trax_backend import AppleSiliconBackend, Backend
 from trax_obj import TraxObject
 
@@ -41,7 +41,7 @@ def test_aarch64_loop():
     asm.ldr(5, 0, imm=8)
 
     # Loop start label
-    loop_start = RelocVar()
+    loop_start = asm.new_label()
     asm.assign_label(loop_start)
     asm.add(3, 3, 2)
     asm.add(2, 2, 4)
@@ -67,3 +67,97 @@ def test_aarch64_loop():
 
     # Check if the result is correct (sum of numbers from 0 to 9)
     assert result.to_int() == 55
+
+def test_mov_const_picks_shortest_sequence():
+    def words(value):
+        asm = AArch64Assembler()
+        asm.mov_const(3, value)
+        code = asm.to_bytes()
+        return [int.from_bytes(code[i:i + 4], byteorder='little') for i in range(0, len(code), 4)]
+
+    assert words(0) == [0xD2800003]                      # movz x3, #0
+    assert words(0x12340000) == [0xD2A24683]             # movz x3, #0x1234, lsl 16
+    assert words(-1) == [0x92800003]                     # movn x3, #0
+    assert words(0x10002) == [0xD2800043, 0xF2A00023]    # movz + movk
+    assert AArch64Assembler.mov_const_length(0x123456789ABCDEF0) == 4
+
+def test_multiply_divide_encodings():
+    asm = AArch64Assembler()
+    asm.mul(0, 1, 2)
+    asm.sdiv(0, 1, 2)
+    asm.msub(0, 1, 2, 3)
+    asm.sbfx(0, 1, 0, 63)
+    words = [int.from_bytes(asm.code[i:i + 4], byteorder='little') for i in range(0, len(asm.code), 4)]
+    assert words == [0x9B027C20, 0x9AC20C20, 0x9B028C20, 0x9340F820]
+
+def test_test_branch_and_conditional_compare_encodings():
+    asm = AArch64Assembler()
+    label = asm.new_label()
+    asm.tbnz(3, 0, label)
+    asm.tbz(3, 34, label)
+    asm.ccmp(1, 2, 4, AArch64Assembler.NE)
+    asm.ccmp_imm(1, 3, 0, AArch64Assembler.EQ)
+    asm.ccmn_imm(1, 3, 8, AArch64Assembler.GE)
+    asm.assign_label(label)
+    code = asm.to_bytes()
+    words = [int.from_bytes(code[i:i + 4], byteorder='little') for i in range(0, len(code), 4)]
+    assert words == [0x370000A3, 0xB6100083, 0xFA421024, 0xFA430820, 0xBA43A828]
+
+def test_adjacent_guards_share_a_branch():
+    from trax_tracing import TraceCompiler
+    constants = [TraxObject.from_int(1)]
+    compiler = TraceCompiler()
+    compiler.loop_header_guard_id = 9
+    n_input = compiler.input(0)
+    i_input = compiler.input(1)
+    values = [n_input, i_input]
+    compiler.guard_int(0, n_input, values)
+    compiler.guard_int(1, i_input, values)
+    compiler.guard_true(2, compiler.lt(i_input, n_input), values)
+    i_input.phi = compiler.add(i_input, compiler.constant(0, 0))
+    compiler.optimize(constants)
+
+    code = AppleSiliconBackend().compile_trace(compiler, constants)
+    words = [int.from_bytes(code[i:i + 4], byteorder='little') for i in range(0, len(code), 4)]
+    # Checking i is an integer and then i < n is a tst, a ccmp and one branch
+    assert any(word & 0xFFE00C10 == 0xFA400000 for word in words)
+    assert any(word & 0x7F000000 == 0x37000000 for word in words)
+
+def test_field_access_and_call_encodings():
+    asm = AArch64Assembler()
+    asm.ldur(0, 1, 3)
+    asm.stur(0, 1, -5)
+    asm.blr(16)
+    words = [int.from_bytes(asm.code[i:i + 4], byteorder='little') for i in range(0, len(asm.code), 4)]
+    assert words == [0xF8403020, 0xF81FB020, 0xD63F0200]
+
+def test_far_conditional_branch_becomes_long_branch():
+    asm = AArch64Assembler()
+    label = asm.new_label()
+    asm.tbnz(3, 0, label)
+    for _ in range(9000):
+        asm.add_data(0xD503201F) # nop, pushes the label past tbnz's 32KiB reach
+    asm.assign_label(label)
+    words = asm.finalize()
+    # tbz over an unconditional branch to the label
+    assert list(words[:2]) == [0x36000043, 0x14000000 | 9001]
+    assert len(words) == 9002
+
+def test_trace_entry_reuses_its_buffers():
+    from trax_obj import ffi
+
+    # Stands in for a compiled trace: exits through guard 3 keeping the sum of its inputs
+    @ffi.callback("int(trax_value*, trax_value*, trax_value*)")
+    def fake_trace(inputs, const_table, exits):
+        exits[0] = inputs[0] + inputs[1] + const_table[0]
+        return 3
+
+    be = AppleSiliconBackend()
+    const_table = be.const_table([TraxObject.from_int(100)])
+    entry = be.prepare_trace(int(ffi.cast("uintptr_t", fake_trace)), 2, 1, const_table)
+    inputs, exits = entry.inputs, entry.exits
+
+    for i in range(3):
+        assert entry.enter([TraxObject.from_int(i), TraxObject.from_int(10)]) == 3
+        assert entry.exit_values(1)[0].to_int() == i + 110
+    assert entry.inputs is inputs and entry.exits is exits
@@ -16,7 +16,7 @@ def test_compile_square_method():
     assert len(instructions) == 6
     assert instructions[0]['opcode'] == 'dup'
     assert instructions[1]['opcode'] == 'dup'
-    assert instructions[2]['method_name'] == '*'
+    assert compiler.names[instructions[2]['selector']] == '*'
     assert instructions[3]['opcode'] == 'pop'
     assert instructions[4]['opcode'] == 'push_const'
     assert instructions[5]['opcode'] == 'return'
@@ -36,7 +36,35 @@ def test_compile_square_method_with_return():
     assert len(instructions) == 6
     assert instructions[0]['opcode'] == 'dup'
     assert instructions[1]['opcode'] == 'dup'
-    assert instructions[2]['method_name'] == '*'
+    assert compiler.names[instructions[2]['selector']] == '*'
     assert instructions[3]['opcode'] == 'return'
     assert instructions[4]['opcode'] == 'push_const'
     assert instructions[5]['opcode'] == 'return'
+
+def test_bytecode_is_packed_and_disassembles():
+    from trax_bc_compile import Bytecode
+    from trax_parser import parse
+
+    code = """
+    fn Int:count() {
+        var i = 0;
+        while i < self {
+            i = i + 1;
+        }
+        return i;
+    }
+    """
+    compiler = Compiler(parse(code))
+    constants, method_map = compiler.compile()
+    bytecode = method_map[(0, 'count')]
+
+    assert len(bytecode.code) == len(bytecode) * Bytecode.INSTRUCTION.size
+    assert compiler.names == ['count', '<', '+']
+    instructions = [bytecode[pc] for pc in range(len(bytecode))]
+    assert Bytecode.encode(instructions, list(compiler.names)).code == bytecode.code
+    loop_back = next(pc for pc, inst in enumerate(instructions) if inst['opcode'] == 'jmp' and inst['loop_back'])
+    assert bytecode.fetch(loop_back) == ('jmp', (instructions[loop_back]['offset'], True))
+    lines = bytecode.disassemble()
+    assert len(lines) == len(bytecode)
+    assert "add_int '+'" in lines[loop_back - 2]
+    assert lines[loop_back].endswith(f"; -> {loop_back + 1 + instructions[loop_back]['offset']}")
@@ -1,9 +1,10 @@
+import pytest
 from trax_ast import *
 from trax_parser import parse
 from trax_bc_compile import Compiler
-from trax_interp import Interpreter
-from trax_obj import TraxObject
-from trax_tracing import TraceCompiler, ValueInstruction
+from trax_interp import Interpreter, CallSite
+from trax_obj import TraxObject, type_index_of, is_integer_value, is_false_value
+from trax_tracing import TraceCompiler, ValueInstruction, GuardInt, AddInstruction
 
 def test_interpret_square_method():
     ast = [
@@ -93,3 +94,643 @@ def test_interpret_sum_to_100():
 
     assert result.is_integer()
     assert result.to_int() == 5050  # Sum of numbers from 1 to 99
+
+def test_materialize_virtual_objects_on_exit():
+    from trax_interp import GuardFrame, GuardHandler
+    from trax_tracing import VirtualObject
+
+    interpreter = Interpreter([], {})
+    tc = TraceCompiler()
+    point, total = tc.new(3, 2), tc.input(0)
+    handler = GuardHandler(GuardFrame((0, 'f'), 0, [point, total]), [], [point, total])
+    handler.resume = [VirtualObject(3, [0, 1]), 1]
+
+    values = interpreter.materialize_exit_values(handler, [TraxObject.from_int(4), TraxObject.from_int(5)])
+
+    assert values[0].get_type_index() == 3
+    assert values[0].get_field(0).to_int() == 4
+    assert values[0].get_field(1).to_int() == 5
+    assert values[1].to_int() == 5
+
+def test_loop_that_cannot_be_compiled_is_blacklisted():
+    from trax_tracing import BinaryOpInstruction
+
+    # An operation the backend has no lowering for
+    class UnknownInstruction(BinaryOpInstruction):
+        pass
+
+    code = """
+    fn Int:count() {
+        var i = 0;
+        while i < self {
+            i = i + 1;
+        }
+        return i;
+    }
+    """
+    constants, method_map = Compiler(parse(code)).compile()
+    interpreter = Interpreter(constants, method_map)
+
+    def int_add(stack):
+        b = stack.pop()
+        a = stack.pop()
+        return TraxObject.from_int(a.to_int() + b.to_int())
+
+    def int_add_trace(tc: Interpreter, args: list[ValueInstruction]):
+        tc.emit_guard_index(args[0], 0)
+        tc.emit_guard_index(args[1], 0)
+        v = UnknownInstruction(args[0], args[1], 0)
+        tc.trace_compiler.add_instruction(v)
+        return v
+
+    def int_less(stack):
+        b = stack.pop()
+        a = stack.pop()
+        return TraxObject(TraxObject.TRUE_TAG if a.to_int() < b.to_int() else TraxObject.FALSE_TAG)
+
+    def int_less_trace(tc: Interpreter, args: list[ValueInstruction]):
+        tc.emit_guard_index(args[0], 0)
+        tc.emit_guard_index(args[1], 0)
+        return tc.trace_compiler.lt(args[0], args[1])
+
+    interpreter.add_builtin_method(0, '+', int_add, int_add_trace)
+    interpreter.add_builtin_method(0, '<', int_less, int_less_trace)
+
+    result = interpreter.run(TraxObject.from_int(20), 'count')
+
+    # The loop keeps running in the interpreter and is never traced again
+    assert result.to_int() == 20
+    assert not interpreter.compiled_traces
+    assert len(interpreter.blacklisted_loops) == 1
+    assert not interpreter.trace_active
+
+def test_builtin_with_native_implementation_is_called_from_the_trace():
+    from trax_backend import NativeHelper
+
+    code = """
+    fn Int:sum_to() {
+        var sum = 0;
+        var i = 1;
+        while i < self {
+            sum = sum + i;
+            i = i + 1;
+        }
+        return sum;
+    }
+    """
+    constants, method_map = Compiler(parse(code)).compile()
+    interpreter = Interpreter(constants, method_map)
+    calls = {'native': 0, 'interpreted': 0}
+
+    def int_add(stack):
+        b = stack.pop()
+        a = stack.pop()
+        calls['interpreted'] += 1
+        return TraxObject.from_int(a.to_int() + b.to_int())
+
+    # Gives up on big numbers, the interpreter has to add those
+    def native_add(a, b):
+        calls['native'] += 1
+        if not (a.is_integer() and b.is_integer()) or a.to_int() >= 1000:
+            return None
+        return TraxObject.from_int(a.to_int() + b.to_int())
+
+    def int_less(stack):
+        b = stack.pop()
+        a = stack.pop()
+        return TraxObject(TraxObject.TRUE_TAG if a.to_int() < b.to_int() else TraxObject.FALSE_TAG)
+
+    def int_less_trace(tc: Interpreter, args: list[ValueInstruction]):
+        tc.emit_guard_index(args[0], 0)
+        tc.emit_guard_index(args[1], 0)
+        return tc.trace_compiler.lt(args[0], args[1])
+
+    interpreter.add_builtin_method(0, '+', int_add, native=NativeHelper.from_python('int_add', 2, native_add))
+    interpreter.add_builtin_method(0, '<', int_less, int_less_trace)
+
+    result = interpreter.run(TraxObject.from_int(101), 'sum_to')
+
+    assert result.to_int() == 5050
+    assert interpreter.compiled_traces
+    assert calls['native'] > 0 and calls['interpreted'] > 0
+
+def test_decode_resolves_jumps_and_finds_loop_headers():
+    code = """
+    fn Int:count() {
+        var i = 0;
+        while i < self {
+            i = i + 1;
+        }
+        return i;
+    }
+    """
+    constants, method_map = Compiler(parse(code)).compile()
+    interpreter = Interpreter(constants, method_map)
+    bytecode = method_map[(0, 'count')]
+
+    decoded = interpreter.decode((0, 'count'))
+
+    assert decoded is interpreter.decode((0, 'count'))
+    assert len(decoded.instructions) == len(bytecode) + 1
+    for pc, (handler, operands) in enumerate(decoded.instructions[:-1]):
+        instruction = bytecode[pc]
+        if instruction['opcode'] in ('add_int', 'lt_int'):
+            assert handler.__name__ == 'execute_int_operation'
+            assert decoded.recording[pc][0].__name__ == 'record_int_operation'
+            continue
+        if instruction['opcode'] == 'jmp' and not instruction['loop_back']:
+            # The jump into the loop starts it over, see MethodLoops.suspended
+            assert handler.__name__ == 'execute_enter_loop'
+            assert operands == (pc + 1 + instruction['offset'], decoded.loops, 0)
+            assert decoded.recording[pc][0] == handler
+            continue
+        assert handler.__name__ == f"execute_{instruction['opcode']}"
+        if instruction['opcode'] == 'jmp' and instruction['loop_back']:
+            assert operands == (pc + 1 + instruction['offset'],)
+            # Back edges go to the loop's header, which has the method's loop table
+            assert bytecode[operands[0]] == {'opcode': 'loop_header', 'loop_id': 0}
+            assert decoded.instructions[operands[0]][1] == (decoded.loops, 0)
+            assert decoded.loops.headers == [operands[0]]
+        # Jumps don't record anything, the loop header they go to is where recording starts and stops
+        recorder = decoded.recording[pc][0].__name__
+        assert recorder == ('execute_jmp' if instruction['opcode'] == 'jmp' else f"record_{instruction['opcode']}")
+
+def test_baseline_code_hands_hot_loops_to_the_tracer():
+    code = """
+    fn Int:sum_to() {
+        var sum = 0;
+        var i = 1;
+        while i < self {
+            sum = sum + i;
+            i = i + 1;
+        }
+        return sum;
+    }
+    """
+    constants, method_map = Compiler(parse(code)).compile()
+
+    def int_add(stack):
+        b = stack.pop()
+        a = stack.pop()
+        return TraxObject.from_int(a.to_int() + b.to_int())
+
+    def int_add_trace(tc: Interpreter, args: list[ValueInstruction]):
+        tc.emit_guard_index(args[0], 0)
+        tc.emit_guard_index(args[1], 0)
+        return tc.trace_compiler.add(args[0], args[1])
+
+    def int_less(stack):
+        b = stack.pop()
+        a = stack.pop()
+        return TraxObject(TraxObject.TRUE_TAG if a.to_int() < b.to_int() else TraxObject.FALSE_TAG)
+
+    def int_less_trace(tc: Interpreter, args: list[ValueInstruction]):
+        tc.emit_guard_index(args[0], 0)
+        tc.emit_guard_index(args[1], 0)
+        return tc.trace_compiler.lt(args[0], args[1])
+
+    results = []
+    for threshold in (1000, 5):
+        interpreter = Interpreter(constants, method_map, trace_threshold=threshold, baseline=True)
+        interpreter.add_builtin_method(0, '+', int_add, int_add_trace)
+        interpreter.add_builtin_method(0, '<', int_less, int_less_trace)
+        results.append(interpreter.run(TraxObject.from_int(101), 'sum_to').to_int())
+        assert interpreter.baseline.functions[(0, 'sum_to')] is not None
+        # With the higher threshold the loop never leaves the generated code
+        assert bool(interpreter.compiled_traces) == (threshold == 5)
+
+    assert results == [5050, 5050]
+
+def test_values_are_plain_ints_with_tag_helpers():
+    assert type(TraxObject.from_int(-21).value) is int
+    assert TraxObject.from_int(-21).to_int() == -21
+    # Values wrap around like the 64-bit words they stand for
+    assert TraxObject(1 << 64).value == 0
+
+    obj = TraxObject.new(5, [TraxObject.from_int(3), TraxObject(TraxObject.nil)])
+    assert type_index_of(obj.value) == 5
+    assert obj.get_field(0).to_int() == 3
+    obj.set_field(1, TraxObject(TraxObject.true))
+    assert obj.get_field(1).is_true()
+    TraxObject.free(obj)
+
+    assert is_integer_value(TraxObject.from_int(7).value)
+    assert [type_index_of(v) for v in (4, TraxObject.true, TraxObject.false, TraxObject.nil)] == [0, 1, 1, 2]
+    assert is_false_value(TraxObject.false) and not is_false_value(TraxObject.nil)
+
+def test_call_sites_are_quickened_by_receiver_type():
+    code = """
+    fn Int:plus(other) {
+        return self combine other;
+    }
+    """
+    constants, method_map = Compiler(parse(code)).compile()
+    interpreter = Interpreter(constants, method_map)
+    interpreter.add_builtin_method(0, 'combine', lambda stack: TraxObject.from_int(stack.pop().to_int() + stack.pop().to_int()), lambda *args: None)
+    interpreter.add_builtin_method(1, 'combine', lambda stack: [stack.pop(), stack.pop()][0], lambda *args: None)
+    pc = next(pc for pc, (opcode, _) in enumerate(method_map[(0, 'plus')]) if opcode == 'call')
+    instructions = interpreter.decode((0, 'plus')).instructions
+
+    assert instructions[pc][0].__name__ == 'execute_call'
+    assert interpreter.run(TraxObject.from_int(2), 'plus', TraxObject.from_int(3)).to_int() == 5
+    handler, (site, type_index, builtin) = instructions[pc]
+    assert handler.__name__ == 'execute_call_builtin'
+    assert type_index == 0 and builtin is interpreter.builtin_methods[(0, 'combine')]
+
+    # Another receiver type misses the cache and makes the call polymorphic
+    assert interpreter.run(TraxObject.from_int(2), 'plus', TraxObject(TraxObject.true)).is_true()
+    assert instructions[pc][0].__name__ == 'execute_call_polymorphic'
+    assert set(site.targets) == {0, 1}
+
+def test_calls_resolve_through_vtables_by_selector():
+    code = """
+    fn Int:double() {
+        return self + self;
+    }
+    """
+    compiler = Compiler(parse(code))
+    constants, method_map = compiler.compile()
+    interpreter = Interpreter(constants, method_map)
+    int_add = lambda stack: TraxObject.from_int(stack.pop().to_int() + stack.pop().to_int())
+    interpreter.add_builtin_method(0, '+', int_add, lambda *args: None)
+
+    double, plus = compiler.names.index('double'), compiler.names.index('+')
+    assert interpreter.vtables[0][double] == (None, None, (0, 'double'))
+    assert interpreter.vtables[0][plus][0] is int_add
+    # Types without the method still get an entry for it
+    assert interpreter.vtables[1][plus] == (None, None, (1, '+'))
+
+    # New names get a selector in every table
+    interpreter.add_builtin_method(1, 'not', lambda stack: stack.pop(), lambda *args: None)
+    assert interpreter.vtables.names[-1] == 'not'
+    assert len(interpreter.vtables[0]) == len(interpreter.vtables[1]) == len(interpreter.vtables.names)
+    # The compiler's names and other interpreters on the same code keep theirs
+    assert 'not' not in compiler.names
+    other = Interpreter(constants, method_map)
+    other.add_builtin_method(1, 'and', lambda stack: stack.pop(), lambda *args: None)
+    other.add_builtin_method(0, 'not', lambda stack: stack.pop(), lambda *args: None)
+    assert other.vtables.names[-2:] == ['and', 'not']
+    assert interpreter.vtables.selector('not') != other.vtables.selector('not')
+
+    assert interpreter.run(TraxObject.from_int(21), 'double').to_int() == 42
+
+def test_int_operators_run_inline_and_record_arithmetic():
+    code = """
+    fn Int:sum_to() {
+        var sum = 0;
+        var i = 1;
+        while i < self {
+            sum = sum + i;
+            i = i + 1;
+        }
+        return sum;
+    }
+
+    fn Int:less(other) {
+        return self < other;
+    }
+    """
+    constants, method_map = Compiler(parse(code)).compile()
+    opcodes = [opcode for opcode, _ in method_map[(0, 'sum_to')]]
+    assert 'call' not in opcodes and {'lt_int', 'add_int'} <= set(opcodes)
+
+    # No builtins needed, Int operators are part of the runtime
+    for baseline in (False, True):
+        interpreter = Interpreter(constants, method_map, trace_threshold=5, baseline=baseline)
+        assert interpreter.run(TraxObject.from_int(101), 'sum_to').to_int() == 5050
+        assert interpreter.compiled_traces
+
+    # The trace records the arithmetic directly, guarded on both operands being Ints
+    interpreter = Interpreter(constants, method_map, trace_threshold=10**9)
+    interpreter.decode((0, 'sum_to'))
+    interpreter.trace_active = ((0, 'sum_to'), 0)
+    interpreter.switch_to((0, 'sum_to'))
+    interpreter.stack = [TraxObject.from_int(2), TraxObject.from_int(3)]
+    interpreter.trace_stack = [interpreter.trace_compiler.input(0), interpreter.trace_compiler.input(1)]
+    interpreter.pc = 1
+    interpreter.record_int_operation(CallSite(0, 1), 'add_int')
+    assert interpreter.stack[-1].to_int() == 5
+    assert [type(inst) for inst in interpreter.trace_compiler.instructions[-3:]] == [GuardInt, GuardInt, AddInstruction]
+
+    # Other operand types are an ordinary call
+    interpreter = Interpreter(constants, method_map)
+    assert interpreter.run(TraxObject.from_int(1), 'less', TraxObject.from_int(2)).is_true()
+    interpreter.add_builtin_method(1, '<', lambda stack: [stack.pop(), stack.pop()][1], lambda *args: None)
+    assert interpreter.run(TraxObject.from_int(1), 'less', TraxObject(TraxObject.true)).to_int() == 1
+
+def test_calls_share_one_value_stack():
+    code = """
+    fn Int:inc(step) {
+        return self + step;
+    }
+
+    fn Int:count() {
+        var i = 0;
+        while i < self {
+            i = i inc(1);
+        }
+        return i;
+    }
+    """
+    constants, method_map = Compiler(parse(code)).compile()
+    # The receiver and argument, then self and the 1 pushed for the addition
+    assert method_map[(0, 'inc')].num_args == 2
+    assert method_map[(0, 'inc')].max_stack == 4
+
+    for threshold in (10**9, 5):
+        interpreter = Interpreter(constants, method_map, trace_threshold=threshold)
+        assert interpreter.run(TraxObject.from_int(50), 'count').to_int() == 50
+        assert interpreter.stack == [] and interpreter.call_stack == []
+        # The call to inc was recorded into the trace
+        assert bool(interpreter.compiled_traces) == (threshold == 5)
+
+    # Calls check up front that the callee's frame fits
+    interpreter = Interpreter(constants, method_map, stack_size=5)
+    with pytest.raises(ValueError, match="Stack overflow"):
+        interpreter.run(TraxObject.from_int(50), 'count')
+
+def test_loops_are_counted_and_traced_by_loop_id():
+    code = """
+    fn Int:grid() {
+        var total = 0;
+        var i = 0;
+        var j = 0;
+        while i < self {
+            j = 0;
+            while j < self {
+                total = total + 1;
+                j = j + 1;
+            }
+            i = i + 1;
+        }
+        return total;
+    }
+    """
+    constants, method_map = Compiler(parse(code)).compile()
+    loop_ids = [operands[0] for opcode, operands in method_map[(0, 'grid')] if opcode == 'loop_header']
+    assert sorted(loop_ids) == [0, 1]
+
+    interpreter = Interpreter(constants, method_map, trace_threshold=3)
+    assert interpreter.run(TraxObject.from_int(6), 'grid').to_int() == 36
+    loops = interpreter.method_loops[(0, 'grid')]
+    bytecode = method_map[(0, 'grid')]
+    assert all(bytecode[pc]['loop_id'] == loop_id for loop_id, pc in enumerate(loops.headers))
+    # The inner loop gets hot first and its trace goes in its slot
+    outer, inner = sorted(range(2), key=lambda loop_id: loops.headers[loop_id])
+    assert loops.traces[inner] is not None
+    assert interpreter.compiled_traces[loops.key(inner)] is loops.traces[inner]
+    assert loops.counts[outer] <= 6
+
+def test_division_without_a_zero_check_is_not_compiled():
+    from trax_backend import NativeHelper
+
+    code = """
+    fn Int:quotients() {
+        var q = 0;
+        var i = 0;
+        while i < self {
+            q = q + 100 / (self - 1 - i);
+            i = i + 1;
+        }
+        return q;
+    }
+    """
+    constants, method_map = Compiler(parse(code)).compile()
+
+    def int_add(stack):
+        b = stack.pop()
+        a = stack.pop()
+        return TraxObject.from_int(a.to_int() + b.to_int())
+
+    # The helper call leaves no guard the zero check could share
+    def native_add(a, b):
+        return TraxObject.from_int(a.to_int() + b.to_int())
+
+    for threshold in (10**9, 2):
+        interpreter = Interpreter(constants, method_map, trace_threshold=threshold)
+        interpreter.add_builtin_method(0, '+', int_add, native=NativeHelper.from_python('int_add', 2, native_add))
+        # The last iteration divides by zero whether or not the loop got hot
+        with pytest.raises(ZeroDivisionError):
+            interpreter.run(TraxObject.from_int(30), 'quotients')
+        assert not interpreter.compiled_traces
+        assert len(interpreter.blacklisted_loops) == (threshold == 2)
+
+def test_trace_whose_hoisted_checks_fail_on_a_later_call():
+    code = """
+    fn Int:f(m) {
+        var sum = 0;
+        var i = 0;
+        while i < self {
+            if i < m {
+                sum = sum + 1;
+            } else {
+                sum = sum + 2;
+            }
+            i = i + 1;
+        }
+        return sum;
+    }
+    """
+    constants, method_map = Compiler(parse(code)).compile()
+    interpreter = Interpreter(constants, method_map, trace_threshold=2)
+    # The trace is recorded with i < m always true and its checks are moved
+    # in front of the loop, the second call fails them and has to finish
+    results = [interpreter.run(TraxObject.from_int(20), 'f', TraxObject.from_int(m)).to_int() for m in (100, 10)]
+    assert results == [20, 30]
+    assert interpreter.compiled_traces
+    assert interpreter.stack == [] and interpreter.call_stack == []
+
+def test_exits_back_to_the_loop_header_finish_the_loop_in_the_interpreter(capsys):
+    code = """
+    fn Int:sum_mod() {
+        var sum = 0;
+        var i = 0;
+        while i < self {
+            sum = sum + (i % 7);
+            i = i + 1;
+        }
+        return sum;
+    }
+    """
+    constants, method_map = Compiler(parse(code)).compile()
+    for n in range(105, 109):
+        expected = sum(i % 7 for i in range(n))
+        interpreter = Interpreter(constants, method_map, trace_threshold=2, unroll_factor=4, split_reductions=True)
+        assert interpreter.run(TraxObject.from_int(n), 'sum_mod').to_int() == expected
+        # The guards of the later unrolled copies go back to the loop header,
+        # after that the interpreter runs the last few iterations itself
+        assert capsys.readouterr().out.count("Entering trace") == 1
+        # Running the loop again starts it over
+        assert interpreter.run(TraxObject.from_int(n), 'sum_mod').to_int() == expected
+        assert capsys.readouterr().out.count("Entering trace") == 1
+
+def test_baseline_code_calls_methods_it_cannot_compile_through_the_interpreter():
+    code = """
+    fn Int:bump() {
+        if self < 5 {
+            var x = 1;
+        }
+        return self + 1;
+    }
+
+    fn Int:main() {
+        var total = 0;
+        var i = 0;
+        while i < self {
+            total = total + i bump();
+            i = i + 1;
+        }
+        return total;
+    }
+    """
+    constants, method_map = Compiler(parse(code)).compile()
+    # The stack is one deeper after the if than when it's skipped
+    assert method_map[(0, 'bump')].stack_heights(1) is None
+
+    results = []
+    for baseline in (False, True):
+        interpreter = Interpreter(constants, method_map, trace_threshold=10**9, baseline=baseline)
+        results.append(interpreter.run(TraxObject.from_int(10), 'main').to_int())
+        assert interpreter.call_stack == []
+    assert results[0] == results[1]
+    assert interpreter.baseline.functions[(0, 'main')] is not None
+    assert interpreter.baseline.functions[(0, 'bump')] is None
+
+def test_baseline_callees_hand_hot_loops_to_the_tracer():
+    code = """
+    fn Int:sum_to() {
+        var sum = 0;
+        var i = 0;
+        while i < self {
+            sum = sum + i;
+            i = i + 1;
+        }
+        return sum;
+    }
+
+    fn Int:main() {
+        return self sum_to() + 1;
+    }
+    """
+    constants, method_map = Compiler(parse(code)).compile()
+    for threshold in (10**9, 5):
+        interpreter = Interpreter(constants, method_map, trace_threshold=threshold, baseline=True)
+        assert interpreter.run(TraxObject.from_int(1000), 'main').to_int() == sum(range(1000)) + 1
+        assert interpreter.baseline.functions[(0, 'sum_to')] is not None
+        assert interpreter.call_stack == []
+        # Only the call to sum_to went over to the interpreter
+        assert list(interpreter.compiled_traces) == ([] if threshold > 5 else [interpreter.method_loops[(0, 'sum_to')].key(0)])
+
+def test_frame_sizes_bound_every_method_and_baseline_calls():
+    code = """
+    fn Int:bump() {
+        if self < 5 {
+            var x = 1;
+        }
+        return self + 1;
+    }
+
+    fn Int:depth() {
+        if self < 1 {
+            return 0;
+        }
+        return self - 1 depth() + 1;
+    }
+    """
+    constants, method_map = Compiler(parse(code)).compile()
+    # The heights in bump don't agree but it still gets a frame size
+    bump = method_map[(0, 'bump')]
+    assert bump.stack_heights(1) is None
+    assert bump.max_stack >= 3
+    assert Interpreter(constants, method_map).decode((0, 'bump')).frame_size == bump.max_stack
+
+    # Recursion overflows the same stack in baseline code as in the interpreter
+    for baseline in (False, True):
+        interpreter = Interpreter(constants, method_map, baseline=baseline)
+        assert interpreter.run(TraxObject.from_int(50), 'depth').to_int() == 50
+        interpreter = Interpreter(constants, method_map, baseline=baseline, stack_size=20)
+        with pytest.raises(ValueError, match="Stack overflow calling depth"):
+            interpreter.run(TraxObject.from_int(50), 'depth')
+        assert interpreter.baseline_height == 0
+
+def test_loop_values_hoisted_into_the_preamble_match_the_interpreter():
+    code = """
+    fn Int:carry(a) {
+        var x = a;
+        var z = a;
+        var y = 0;
+        var j = 0;
+        while j < self {
+            if a > 5 {
+                z = x;
+            } else {
+                x = j;
+            }
+            y = (x + z);
+            z = (3 * a);
+            j = j + 1;
+        }
+        return y;
+    }
+    """
+    constants, method_map = Compiler(parse(code)).compile()
+    # 3 * a doesn't change in the loop, so z is carried around it in a
+    # register the preamble fills in
+    for a in (2, 7):
+        results = []
+        for threshold in (10**9, 1):
+            interpreter = Interpreter(constants, method_map, trace_threshold=threshold)
+            results.append(interpreter.run(TraxObject.from_int(10), 'carry', TraxObject.from_int(a)).to_int())
+        assert results[0] == results[1]
+        assert interpreter.compiled_traces
+
+def test_loop_state_narrowed_by_range_propagation_matches_the_interpreter():
+    code = """
+    fn Int:narrow(a) {
+        var y = 0;
+        var z = 0;
+        var i = 0;
+        while i < self {
+            y = 3;
+            y = ((self / 2) % ((z % a) - (3 + 2)));
+            i = i + 1;
+        }
+        return y;
+    }
+    """
+    constants, method_map = Compiler(parse(code)).compile()
+    # Range propagation rewrites a preamble value that's copied into the loop
+    for a in (1, 4):
+        results = []
+        for threshold in (10**9, 2):
+            interpreter = Interpreter(constants, method_map, trace_threshold=threshold)
+            results.append(interpreter.run(TraxObject.from_int(18), 'narrow', TraxObject.from_int(a)).to_int())
+        assert results[0] == results[1]
+        assert interpreter.compiled_traces
+
+def test_compares_against_constants_too_big_for_an_immediate():
+    code = """
+    fn Int:pick(a) {
+        var x = 3;
+        var j = 0;
+        while j < self {
+            x = 5000;
+            if x < (5000 - a) {
+                x = 1;
+            } else {
+                x = 2;
+            }
+            j = j + 1;
+        }
+        return x;
+    }
+    """
+    constants, method_map = Compiler(parse(code)).compile()
+    # The tagged 5000 is both compared against and kept for the guard's exit
+    for a in (6, -6):
+        results = []
+        for threshold in (10**9, 2):
+            interpreter = Interpreter(constants, method_map, trace_threshold=threshold)
+            results.append(interpreter.run(TraxObject.from_int(3), 'pick', TraxObject.from_int(a)).to_int())
+        assert results[0] == results[1]
+        assert interpreter.compiled_traces
@@ -12,3 +12,365 @@ def test_trace_compiler():
     result = compiler.add(x_input, temp)
 
     trace = compiler.get_instructions()
+
+def test_remove_allocations():
+    compiler = TraceCompiler()
+
+    # A point that gets built from the inputs and read back every iteration
+    x_input = compiler.input(0)
+    y_input = compiler.input(1)
+    compiler.guard_int(0, x_input, [x_input, y_input])
+    point = compiler.new(3, 2)
+    compiler.set_field(point, 0, x_input)
+    compiler.set_field(point, 1, y_input)
+    x = compiler.get_field(point, 0)
+    y = compiler.get_field(point, 1)
+    total = compiler.add(x, y)
+    compiler.guard_true(1, total, [point, total])
+    x_input.phi = total
+
+    compiler.optimize([])
+
+    instructions = compiler.preamble + compiler.body
+    assert not any(isinstance(inst, (NewInstruction, SetFieldInstruction, GetFieldInstruction)) for inst in instructions)
+
+    guard = [inst for inst in compiler.preamble if isinstance(inst, GuardTrue)][0]
+    assert guard.values_to_keep == [x_input, y_input, guard.operand]
+    virtual, total_slot = guard.resume
+    assert isinstance(virtual, VirtualObject)
+    assert virtual.type_index == 3
+    assert virtual.fields == [0, 1]
+    assert total_slot == 2
+
+def test_escaping_allocation_is_forced():
+    compiler = TraceCompiler()
+
+    x_input = compiler.input(0)
+    point = compiler.new(3, 1)
+    compiler.set_field(point, 0, x_input)
+    compiler.guard_true(0, x_input, [point])
+    # The point is carried to the next iteration so it has to exist by then
+    x_input.phi = point
+
+    compiler.optimize([])
+
+    news = [inst for inst in compiler.preamble if isinstance(inst, NewInstruction)]
+    assert news == [point]
+    guard = [inst for inst in compiler.preamble if isinstance(inst, GuardTrue)][0]
+    assert compiler.preamble.index(guard) < compiler.preamble.index(point)
+    assert isinstance(guard.resume[0], VirtualObject)
+
+def test_fold_constants():
+    from trax_obj import TraxObject
+    constants = [TraxObject(TraxObject.NIL_TAG), TraxObject.from_int(6), TraxObject.from_int(7)]
+    compiler = TraceCompiler()
+
+    x_input = compiler.input(0)
+    six = compiler.constant(1, 0)
+    seven = compiler.constant(2, 0)
+    product = compiler.mul(six, seven)
+    total = compiler.add(x_input, product)
+    x_input.phi = total
+
+    compiler.optimize(constants)
+
+    folded = [inst for inst in compiler.preamble if isinstance(inst, AddInstruction)][0].right
+    assert isinstance(folded, ConstantInstruction)
+    assert constants[folded.constant_index].to_int() == 42
+    assert not any(isinstance(inst, MulInstruction) for inst in compiler.preamble + compiler.body)
+
+def test_algebraic_simplification():
+    from trax_obj import TraxObject
+    constants = [TraxObject.from_int(0), TraxObject.from_int(1), TraxObject.from_int(8)]
+    compiler = TraceCompiler()
+
+    x_input = compiler.input(0)
+    zero = compiler.constant(0, 0)
+    one = compiler.constant(1, 0)
+    eight = compiler.constant(2, 0)
+    same = compiler.mul(compiler.add(x_input, zero), one)
+    shifted = compiler.mul(same, eight)
+    x_input.phi = shifted
+
+    compiler.optimize(constants)
+
+    body = compiler.body
+    assert len(body) == 1
+    assert isinstance(body[0], ShiftLeftInstruction)
+    assert body[0].shift == 3
+    # x is carried around the loop as a raw integer
+    raw_x = body[0].operand
+    assert raw_x.input_index is None and raw_x.raw
+    assert raw_x.phi is body[0]
+
+def test_unbox_integers():
+    from trax_obj import TraxObject
+    constants = [TraxObject.from_int(3)]
+    compiler = TraceCompiler()
+    compiler.loop_header_guard_id = 7
+
+    x_input = compiler.input(0)
+    y_input = compiler.input(1)
+    compiler.guard_int(0, x_input, [x_input, y_input])
+    compiler.guard_int(1, y_input, [x_input, y_input])
+    three = compiler.constant(0, 0)
+    product = compiler.mul(x_input, three)
+    quotient = compiler.div(product, y_input)
+    x_input.phi = quotient
+
+    compiler.optimize(constants)
+
+    body = compiler.body
+    # Everything in the loop works on raw integers, nothing gets tagged
+    assert not any(isinstance(inst, TagInstruction) for inst in body)
+    mul = [inst for inst in body if isinstance(inst, MulInstruction)][0]
+    div = [inst for inst in body if isinstance(inst, DivInstruction)][0]
+    assert mul.raw and div.raw
+    raw_x = mul.left
+    assert raw_x.input_index is None and raw_x.phi is div
+    # y doesn't change so it's only untagged and checked for zero once, before the loop
+    assert isinstance(div.right, UntagInstruction) and div.right in compiler.preamble
+    assert not any(isinstance(inst, GuardNonZero) for inst in body)
+    guard = [inst for inst in compiler.preamble if isinstance(inst, GuardNonZero)][0]
+    assert guard.operand is div.right
+
+def test_raw_input_carrying_an_invariant_value():
+    from trax_obj import TraxObject
+    constants = [TraxObject.from_int(3)]
+    compiler = TraceCompiler()
+    compiler.loop_header_guard_id = 9
+
+    a_input = compiler.input(0)
+    x_input = compiler.input(1)
+    y_input = compiler.input(2)
+    values = [a_input, x_input, y_input]
+    for guard_id, value in enumerate(values):
+        compiler.guard_int(guard_id, value, values)
+    y_input.phi = compiler.add(y_input, x_input)
+    # x is a * 3 after the first trip, which doesn't change in the loop
+    x_input.phi = compiler.mul(a_input, compiler.constant(0, 0))
+
+    compiler.optimize(constants)
+
+    preamble = compiler.preamble
+    raw_x = [inst for inst in compiler.body if isinstance(inst, AddInstruction)][0].right
+    assert raw_x.raw and raw_x.input_index is None
+    assert isinstance(raw_x.phi, MulInstruction) and raw_x.phi in preamble
+    # The raw input comes before the hoisted value it carries, which stays
+    # in its register until the back edge
+    assert preamble.index(raw_x) < preamble.index(raw_x.phi)
+    instructions = preamble + compiler.body
+    liveness = get_liveness_ranges(instructions, len(preamble))
+    assert liveness[raw_x.phi][1] == len(instructions)
+
+def test_closed_form_loop():
+    from trax_obj import TraxObject
+    constants = [TraxObject.from_int(1)]
+    compiler = TraceCompiler()
+    compiler.loop_header_guard_id = 9
+
+    n_input = compiler.input(0)
+    sum_input = compiler.input(1)
+    i_input = compiler.input(2)
+    values = [n_input, sum_input, i_input]
+    for guard_id, value in enumerate(values):
+        compiler.guard_int(guard_id, value, values)
+    compiler.guard_true(3, compiler.lt(i_input, n_input), values)
+    one = compiler.constant(0, 0)
+    sum_input.phi = compiler.add(sum_input, i_input)
+    i_input.phi = compiler.add(i_input, one)
+
+    compiler.optimize(constants)
+
+    # Once the guard passes the loop jumps straight to its last iteration, so
+    # the next time around the guard fails
+    body = compiler.body
+    assert len([inst for inst in body if isinstance(inst, GuardInstruction)]) == 1
+    raw_sum, raw_i = [inst for inst in compiler.preamble if isinstance(inst, InputInstruction) and inst.raw]
+    # i ends up at n
+    assert isinstance(raw_i.phi, AddInstruction) and raw_i.phi.left is raw_i
+    trip_count = raw_i.phi.right
+    assert isinstance(trip_count, SubInstruction) and isinstance(trip_count.left, UntagInstruction)
+    assert trip_count.left.operand is n_input
+    # sum picks up count * i plus the triangle number for the rest
+    assert isinstance(raw_sum.phi, AddInstruction) and isinstance(raw_sum.phi.left, AddInstruction)
+    assert raw_sum.phi.left.left is raw_sum
+
+def test_strength_reduction():
+    from trax_obj import TraxObject
+    constants = [TraxObject.from_int(1), TraxObject.from_int(3)]
+    compiler = TraceCompiler()
+    compiler.loop_header_guard_id = 9
+
+    n_input = compiler.input(0)
+    sum_input = compiler.input(1)
+    i_input = compiler.input(2)
+    values = [n_input, sum_input, i_input]
+    for guard_id, value in enumerate(values):
+        compiler.guard_int(guard_id, value, values)
+    compiler.guard_true(3, compiler.lt(i_input, n_input), values)
+    # A second exit keeps the loop from being skipped over entirely
+    compiler.guard_true(4, compiler.lt(sum_input, n_input), values)
+    one = compiler.constant(0, 0)
+    three = compiler.constant(1, 0)
+    sum_input.phi = compiler.add(sum_input, compiler.mul(i_input, three))
+    i_input.phi = compiler.add(i_input, one)
+
+    compiler.optimize(constants)
+
+    # i * 3 becomes its own loop input that goes up by 3 each time
+    body = compiler.body
+    assert not any(isinstance(inst, MulInstruction) for inst in body)
+    raw_sum, raw_i, raw_product = [inst for inst in compiler.preamble if isinstance(inst, InputInstruction) and inst.raw]
+    assert raw_sum.phi.right is raw_product
+    assert raw_product.phi.left is raw_product
+    assert constants[raw_product.phi.right.constant_index].to_int() == 3
+    # It starts out at i * 3, worked out before the loop
+    copy = [inst for inst in compiler.preamble if isinstance(inst, CopyInstruction) and inst.input is raw_product][0]
+    assert isinstance(copy.value, MulInstruction)
+
+def test_propagate_ranges():
+    from trax_obj import TraxObject
+    constants = [TraxObject.from_int(0), TraxObject.from_int(1), TraxObject.from_int(2)]
+    compiler = TraceCompiler()
+    compiler.loop_header_guard_id = 9
+
+    n_input = compiler.input(0)
+    sum_input = compiler.input(1)
+    i_input = compiler.input(2)
+    values = [n_input, sum_input, i_input]
+    for guard_id, value in enumerate(values):
+        compiler.guard_int(guard_id, value, values)
+    compiler.guard_true(3, compiler.lt(i_input, n_input), values)
+    zero = compiler.constant(0, 0)
+    one = compiler.constant(1, 0)
+    two = compiler.constant(2, 0)
+    compiler.guard_true(4, compiler.lt(zero, compiler.add(i_input, one)), values)
+    sum_input.phi = compiler.add(sum_input, two)
+    i_input.phi = compiler.add(i_input, one)
+
+    compiler.optimize(constants)
+
+    # i starts at 0 or more and only goes up, so only the loop condition is left
+    body = compiler.body
+    guards = [inst for inst in body if isinstance(inst, GuardInstruction)]
+    assert len(guards) == 1 and guards[0].guard_id == 3
+    # i can't wrap before reaching n so the compare is on raw integers
+    raw_i = [inst for inst in compiler.preamble if isinstance(inst, InputInstruction) and inst.raw][1]
+    assert guards[0].operand is raw_i
+    assert isinstance(guards[0].right, UntagInstruction) and guards[0].right in compiler.preamble
+    assert not any(isinstance(inst, TagInstruction) for inst in body)
+
+def test_unroll():
+    from trax_obj import TraxObject
+    constants = [TraxObject.from_int(1)]
+
+    def product_loop(compiler):
+        compiler.loop_header_guard_id = 9
+        n_input = compiler.input(0)
+        product_input = compiler.input(1)
+        i_input = compiler.input(2)
+        values = [n_input, product_input, i_input]
+        for guard_id, value in enumerate(values):
+            compiler.guard_int(guard_id, value, values)
+        compiler.guard_true(3, compiler.lt(i_input, n_input), values)
+        one = compiler.constant(0, 0)
+        product_input.phi = compiler.mul(product_input, i_input)
+        i_input.phi = compiler.add(i_input, one)
+        compiler.optimize(constants)
+        raw_product, raw_i = [inst for inst in compiler.preamble if isinstance(inst, InputInstruction) and inst.raw]
+        return raw_product, raw_i, [inst for inst in compiler.body if isinstance(inst, GuardInstruction)]
+
+    # Each copy of the body checks the loop condition on its own value of i
+    compiler = TraceCompiler(unroll_factor=2)
+    raw_product, raw_i, guards = product_loop(compiler)
+    assert [guard.guard_id for guard in guards] == [3, 3]
+    assert guards[0].operand is raw_i and guards[1].operand is raw_i.phi.left
+    assert raw_product.phi.left.left is raw_product
+
+    # The accumulator is only updated once, the second guard exits to the top of the loop
+    compiler = TraceCompiler(unroll_factor=2, split_reductions=True)
+    raw_product, raw_i, guards = product_loop(compiler)
+    assert guards[1].guard_id == 9 and guards[1].values_to_keep == compiler.loop_state
+    assert raw_product in compiler.loop_state
+    assert isinstance(raw_product.phi, MulInstruction) and raw_product.phi.left is raw_product
+    assert isinstance(raw_product.phi.right, MulInstruction) and raw_product.phi.right.left is raw_i
+
+def test_hoist_invariants():
+    from trax_obj import TraxObject
+    constants = [TraxObject.from_int(1)]
+    compiler = TraceCompiler()
+    compiler.loop_header_guard_id = 9
+
+    config_input = compiler.input(0)
+    i_input = compiler.input(1)
+    values = [config_input, i_input]
+    compiler.guard_index(0, config_input, 3, values)
+    compiler.guard_int(1, i_input, values)
+    limit = compiler.get_field(config_input, 0)
+    compiler.guard_int(2, limit, values)
+    compiler.guard_true(3, compiler.lt(i_input, limit), values)
+    # An if on a flag in the config that wasn't taken
+    compiler.guard_false(4, compiler.get_field(config_input, 1), values)
+    compiler.set_field(config_input, 2, i_input)
+    i_input.phi = compiler.add(i_input, compiler.constant(0, 0))
+
+    compiler.optimize(constants)
+
+    # The flag and the limit are read and checked once, before the loop
+    body = compiler.body
+    assert not any(isinstance(inst, GetFieldInstruction) for inst in body)
+    guards = [inst for inst in body if isinstance(inst, GuardInstruction)]
+    assert len(guards) == 1 and isinstance(guards[0], GuardLT)
+    assert guards[0].right in compiler.preamble
+    flag_guard = [inst for inst in compiler.preamble if isinstance(inst, GuardFalse)][0]
+    assert isinstance(flag_guard.operand, GetFieldInstruction) and flag_guard.guard_id == 4
+
+def test_guard_on_stored_compare_stays_in_loop():
+    from trax_obj import TraxObject
+    constants = [TraxObject.from_int(1), TraxObject.from_int(3)]
+    compiler = TraceCompiler()
+    compiler.loop_header_guard_id = 9
+
+    n_input = compiler.input(0)
+    i_input = compiler.input(1)
+    flag_input = compiler.input(2)
+    values = [n_input, i_input, flag_input]
+    compiler.guard_int(0, n_input, values)
+    compiler.guard_int(1, i_input, values)
+    compiler.guard_true(2, compiler.lt(i_input, n_input), values)
+    # flag = i < 3; if flag { ... }, the compare is kept around so it can't
+    # become a compare guard
+    flag = compiler.lt(i_input, compiler.constant(1, 0))
+    compiler.guard_true(3, flag, values + [flag])
+    flag_input.phi = flag
+    i_input.phi = compiler.add(i_input, compiler.constant(0, 0))
+
+    compiler.optimize(constants)
+
+    guards = [inst for inst in compiler.body if isinstance(inst, GuardTrue)]
+    assert len(guards) == 1 and guards[0].guard_id == 3
+
+def test_schedule_instructions():
+    x_input = InputInstruction(0)
+    obj_input = InputInstruction(1)
+    values = [x_input, obj_input]
+    check_x = GuardInt(0, x_input, values)
+    check_obj = GuardIndex(1, obj_input, 3, values)
+    doubled = AddInstruction(x_input, x_input)
+    squared = MulInstruction(doubled, doubled)
+    field = GetFieldInstruction(obj_input, 0)
+    check_field = GuardInt(2, field, values)
+    instructions = [x_input, obj_input, check_x, check_obj, doubled, squared, field, check_field]
+
+    def latency(inst):
+        return {GetFieldInstruction: 4, MulInstruction: 3}.get(type(inst), 1)
+
+    scheduled = schedule_instructions(instructions, latency)
+    assert sorted(scheduled, key=instructions.index) == instructions
+    # Guards stay in order and the load can't go above the guard that checks
+    # the object, but it does go right after it to hide its latency
+    guards = [inst for inst in scheduled if isinstance(inst, GuardInstruction)]
+    assert guards == [check_x, check_obj, check_field]
+    assert scheduled.index(field) == scheduled.index(check_obj) + 1
+    assert scheduled.index(field) < scheduled.index(squared)
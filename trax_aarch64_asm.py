@@ -1,30 +1,15 @@
+import ctypes
+from array import array
+
 # TODO: We're asssuming little endian here but ideally we'd allow
 #       for big endian as well...still only like router use big endian
 #       so lets ignore that for now
-class Relocation:
-    def __init__(self, offset: int, size: int, func):
-        self.offset = offset
-        self.size = size
-        self.func = func
-
-    @staticmethod
-    def instruction(offset, func):
-        def wrapper_func(bytes):
-            inst = int.from_bytes(bytes, byteorder='little')
-            new_inst: int = func(inst)
-            return new_inst.to_bytes(4, byteorder='little')
-
-        return Relocation(offset, 4, wrapper_func)
-
-    def apply(self, bytes: bytearray):
-        sub = bytes[self.offset:(self.offset + self.size)]
-        new_sub = self.func(sub)
-        bytes[self.offset:(self.offset + self.size)] = new_sub
-
-class RelocVar:
-    def __init__(self):
-        self.value = 0
 
+# Branch offsets are in instructions. Each kind of branch says how many bits
+# its offset has and where they go.
+BRANCH_IMM26 = (26, 0)  # b
+BRANCH_IMM19 = (19, 5)  # b.cond, cbz, cbnz
+BRANCH_IMM14 = (14, 5)  # tbz, tbnz
 class AArch64Assembler:
     # Condition codes
     EQ = 0  # Equal
@@ -35,14 +20,32 @@ class AArch64Assembler:
     LE = 13 # Less than or equal
 
     def __init__(self):
-        self.code = bytearray()
-        self.relocations = []
-
-    def assign_label(self, var: RelocVar):
-        var.value = len(self.code)
+        self.words = array('I')
+        # Labels are indexes into this table, which holds the instruction
+        # each one points at or None if it hasn't been placed yet
+        self.labels = []
+        # (instruction index, branch kind, label) for every branch
+        self.fixups = []
+        # (instruction index, note) pairs that say what the code from there
+        # on is for, see TraceListing
+        self.marks = []
+
+    @property
+    def code(self):
+        return self.words.tobytes()
+
+    def new_label(self):
+        self.labels.append(None)
+        return len(self.labels) - 1
+
+    def assign_label(self, label):
+        self.labels[label] = len(self.words)
+
+    def mark(self, note):
+        self.marks.append((len(self.words), note))
 
     def _append_instruction(self, instruction):
-        self.code.extend(instruction.to_bytes(4, byteorder='little'))
+        self.words.append(instruction)
 
     def add(self, rd, rn, rm):
         instruction = 0x8B000000 | (rm << 16) | (rn << 5) | rd
@@ -52,6 +55,21 @@ class AArch64Assembler:
         instruction = 0xCB000000 | (rm << 16) | (rn << 5) | rd
         self._append_instruction(instruction)
 
+    def madd(self, rd, rn, rm, ra):
+        instruction = 0x9B000000 | (rm << 16) | (ra << 10) | (rn << 5) | rd
+        self._append_instruction(instruction)
+
+    def msub(self, rd, rn, rm, ra):
+        instruction = 0x9B008000 | (rm << 16) | (ra << 10) | (rn << 5) | rd
+        self._append_instruction(instruction)
+
+    def mul(self, rd, rn, rm):
+        self.madd(rd, rn, rm, 31)
+
+    def sdiv(self, rd, rn, rm):
+        instruction = 0x9AC00C00 | (rm << 16) | (rn << 5) | rd
+        self._append_instruction(instruction)
+
     def sub_imm(self, rd, rn, imm):
         assert 0 <= imm < 4096
         instruction = 0xD1000000 | (imm << 10) | (rn << 5) | rd
@@ -71,6 +89,26 @@ class AArch64Assembler:
         instruction = 0xF1000000 | (imm << 10) | (rn << 5) | 0x1F
         self._append_instruction(instruction)
 
+    def cmn_imm(self, rn, imm):
+        assert 0 <= imm < 4096
+        instruction = 0xB1000000 | (imm << 10) | (rn << 5) | 0x1F
+        self._append_instruction(instruction)
+
+    # Compares rn to rm if cond holds, otherwise sets the flags to nzcv
+    def ccmp(self, rn, rm, nzcv, cond):
+        instruction = 0xFA400000 | (rm << 16) | (cond << 12) | (rn << 5) | nzcv
+        self._append_instruction(instruction)
+
+    def ccmp_imm(self, rn, imm, nzcv, cond):
+        assert 0 <= imm < 32
+        instruction = 0xFA400800 | (imm << 16) | (cond << 12) | (rn << 5) | nzcv
+        self._append_instruction(instruction)
+
+    def ccmn_imm(self, rn, imm, nzcv, cond):
+        assert 0 <= imm < 32
+        instruction = 0xBA400800 | (imm << 16) | (cond << 12) | (rn << 5) | nzcv
+        self._append_instruction(instruction)
+
     def mov(self, rd, rm):
         instruction = 0xAA0003E0 | (rm << 16) | rd
         self._append_instruction(instruction)
@@ -80,6 +118,47 @@ class AArch64Assembler:
         instruction = 0xD2800000 | (imm << 5) | rd
         self._append_instruction(instruction)
 
+    def movz(self, rd, imm, shift=0):
+        assert 0 <= imm < 65536 and shift in (0, 16, 32, 48)
+        instruction = 0xD2800000 | ((shift // 16) << 21) | (imm << 5) | rd
+        self._append_instruction(instruction)
+
+    def movn(self, rd, imm, shift=0):
+        assert 0 <= imm < 65536 and shift in (0, 16, 32, 48)
+        instruction = 0x92800000 | ((shift // 16) << 21) | (imm << 5) | rd
+        self._append_instruction(instruction)
+
+    def movk(self, rd, imm, shift=0):
+        assert 0 <= imm < 65536 and shift in (0, 16, 32, 48)
+        instruction = 0xF2800000 | ((shift // 16) << 21) | (imm << 5) | rd
+        self._append_instruction(instruction)
+
+    # Picks between a movz or a movn based sequence for a 64-bit constant
+    @staticmethod
+    def _mov_const_plan(value):
+        value &= 0xFFFFFFFFFFFFFFFF
+        halves = [(value >> shift) & 0xFFFF for shift in (0, 16, 32, 48)]
+        movz_count = max(1, sum(1 for h in halves if h != 0))
+        movn_count = max(1, sum(1 for h in halves if h != 0xFFFF))
+        if movz_count <= movn_count:
+            return False, halves, movz_count
+        return True, halves, movn_count
+
+    @staticmethod
+    def mov_const_length(value):
+        return AArch64Assembler._mov_const_plan(value)[2]
+
+    def mov_const(self, rd, value):
+        inverted, halves, _ = self._mov_const_plan(value)
+        skip = 0xFFFF if inverted else 0
+        parts = [i for i, half in enumerate(halves) if half != skip] or [0]
+        if inverted:
+            self.movn(rd, halves[parts[0]] ^ 0xFFFF, parts[0] * 16)
+        else:
+            self.movz(rd, halves[parts[0]], parts[0] * 16)
+        for i in parts[1:]:
+            self.movk(rd, halves[i], i * 16)
+
     def ldr(self, rt, rn, imm=0):
         assert imm % 8 == 0
         instruction = 0xF9400000 | ((imm >> 3) << 10) | (rn << 5) | rt
@@ -90,44 +169,64 @@ class AArch64Assembler:
         instruction = 0xF9000000 | ((imm >> 3) << 10) | (rn << 5) | rt
         self._append_instruction(instruction)
 
-    def b(self, label: RelocVar):
-        current_offset = len(self.code)
-        def reloc_func(inst):
-            # TODO: there could be an off by 1 error here
-            assert current_offset % 4 == 0
-            assert label.value % 4 == 0
-            offset = label.value - current_offset
-            return inst | ((offset >> 2) & 0x3FFFFFF)
-        self.relocations.append(Relocation.instruction(current_offset, reloc_func))
-        self._append_instruction(0x14000000)
-
-    def _b_cond(self, cond, label: RelocVar):
-        current_offset = len(self.code)
-        def reloc_func(inst):
-            assert current_offset % 4 == 0
-            assert label.value % 4 == 0
-            offset = label.value - current_offset
-            return inst | (((offset >> 2) & 0x7FFFF) << 5)
-        self.relocations.append(Relocation.instruction(current_offset, reloc_func))
-        instruction = 0x54000000 | (cond & 0xF)
-        self._append_instruction(instruction)
-
-    def beq(self, label: RelocVar):
+    # Loads and stores with an unscaled signed 9 bit offset
+    def ldur(self, rt, rn, imm=0):
+        assert -256 <= imm < 256
+        instruction = 0xF8400000 | ((imm & 0x1FF) << 12) | (rn << 5) | rt
+        self._append_instruction(instruction)
+
+    def stur(self, rt, rn, imm=0):
+        assert -256 <= imm < 256
+        instruction = 0xF8000000 | ((imm & 0x1FF) << 12) | (rn << 5) | rt
+        self._append_instruction(instruction)
+
+    def blr(self, rn):
+        instruction = 0xD63F0000 | (rn << 5)
+        self._append_instruction(instruction)
+
+    def _branch(self, instruction, kind, label):
+        self.fixups.append((len(self.words), kind, label))
+        self._append_instruction(instruction)
+
+    def b(self, label):
+        self._branch(0x14000000, BRANCH_IMM26, label)
+
+    def _b_cond(self, cond, label):
+        self._branch(0x54000000 | (cond & 0xF), BRANCH_IMM19, label)
+
+    def cbz(self, rt, label):
+        self._branch(0xB4000000 | rt, BRANCH_IMM19, label)
+
+    def cbnz(self, rt, label):
+        self._branch(0xB5000000 | rt, BRANCH_IMM19, label)
+
+    # Branches if a single bit of rt is zero (tbz) or one (tbnz)
+    def _test_branch(self, instruction, rt, bit, label):
+        assert 0 <= bit < 64
+        self._branch(instruction | ((bit >> 5) << 31) | ((bit & 0x1F) << 19) | rt, BRANCH_IMM14, label)
+
+    def tbz(self, rt, bit, label):
+        self._test_branch(0x36000000, rt, bit, label)
+
+    def tbnz(self, rt, bit, label):
+        self._test_branch(0x37000000, rt, bit, label)
+
+    def beq(self, label):
         self._b_cond(self.EQ, label)
 
-    def bne(self, label: RelocVar):
+    def bne(self, label):
         self._b_cond(self.NE, label)
 
-    def bge(self, label: RelocVar):
+    def bge(self, label):
         self._b_cond(self.GE, label)
 
-    def blt(self, label: RelocVar):
+    def blt(self, label):
         self._b_cond(self.LT, label)
 
-    def bgt(self, label: RelocVar):
+    def bgt(self, label):
         self._b_cond(self.GT, label)
 
-    def ble(self, label: RelocVar):
+    def ble(self, label):
         self._b_cond(self.LE, label)
 
     def ret(self):
@@ -136,16 +235,72 @@ class AArch64Assembler:
 
     def add_data(self, data):
         if isinstance(data, int):
-            self.code.extend(data.to_bytes(4, byteorder='little'))
+            self._append_instruction(data)
         elif isinstance(data, bytes):
-            self.code.extend(data)
+            assert len(data) % 4 == 0
+            self.words.frombytes(data)
         else:
             raise ValueError("Data must be int or bytes")
 
+    # A conditional branch whose target is too far away becomes the opposite
+    # branch over an unconditional one. That moves everything after it, which
+    # can push other branches out of range, so keep going until nothing changes.
+    def _relax_branches(self):
+        for index, _, label in self.fixups:
+            if self.labels[label] is None:
+                raise ValueError(f"Branch at {index * 4} goes to a label that was never assigned")
+        while True:
+            long_branches = []
+            for index, (bits, _), label in self.fixups:
+                if bits != 26 and not -(1 << (bits - 1)) <= self.labels[label] - index < 1 << (bits - 1):
+                    long_branches.append(index)
+            if not long_branches:
+                return
+
+            words, fixups = array('I'), []
+            moved = [0] * (len(self.words) + 1) # where each old instruction ends up
+            long_branches = set(long_branches)
+            for index, word in enumerate(self.words):
+                moved[index] = len(words)
+                if index in long_branches:
+                    # b.cond flips the low bit of its condition, tbz/tbnz and
+                    # cbz/cbnz flip bit 24. Either way it skips the next word.
+                    words.append((word ^ 1 if word >> 24 == 0x54 else word ^ (1 << 24)) | (2 << 5))
+                    words.append(0x14000000)
+                else:
+                    words.append(word)
+            moved[len(self.words)] = len(words)
+            for index, kind, label in self.fixups:
+                if index in long_branches:
+                    fixups.append((moved[index] + 1, BRANCH_IMM26, label))
+                else:
+                    fixups.append((moved[index], kind, label))
+            self.labels = [None if position is None else moved[position] for position in self.labels]
+            self.marks = [(moved[index], note) for index, note in self.marks]
+            self.words, self.fixups = words, fixups
+
+    # Fills in every branch offset. Call this once all code has been emitted.
+    def finalize(self):
+        self._relax_branches()
+        words, labels = self.words, self.labels
+        for index, (bits, shift), label in self.fixups:
+            offset = labels[label] - index
+            if not -(1 << (bits - 1)) <= offset < 1 << (bits - 1):
+                raise ValueError(f"Branch at {index * 4} can't reach {labels[label] * 4}")
+            words[index] |= (offset & ((1 << bits) - 1)) << shift
+        self.fixups = []
+        return words
+
     def to_bytes(self):
-        for reloc in self.relocations:
-            reloc.apply(self.code)
-        return bytes(self.code)
+        return self.finalize().tobytes()
+
+    # Copies the finished code straight to memory we own, like an executable
+    # mapping that is still writable
+    def write_to(self, address):
+        words = self.finalize()
+        buffer_address, length = words.buffer_info()
+        ctypes.memmove(address, buffer_address, length * words.itemsize)
+        return length * words.itemsize
 
     def and_imm(self, rd, rn, imm):
         assert 0 <= imm < 4096
@@ -154,17 +309,23 @@ class AArch64Assembler:
 
     def lsl(self, rd, rn, shift):
         assert 0 <= shift < 64
-        instruction = 0xD3400000 | ((64 - shift) << 16) | (rn << 5) | rd
+        instruction = 0xD3400000 | (((64 - shift) % 64) << 16) | ((63 - shift) << 10) | (rn << 5) | rd
         self._append_instruction(instruction)
 
     def lsr(self, rd, rn, shift):
         assert 0 <= shift < 64
-        instruction = 0xD3400000 | (shift << 16) | (rn << 5) | rd
+        instruction = 0xD3400000 | (shift << 16) | (63 << 10) | (rn << 5) | rd
         self._append_instruction(instruction)
 
     def asr(self, rd, rn, shift):
         assert 0 <= shift < 64
-        instruction = 0x93400000 | (shift << 16) | (rn << 5) | rd
+        instruction = 0x93400000 | (shift << 16) | (63 << 10) | (rn << 5) | rd
+        self._append_instruction(instruction)
+
+    # Sign extends the `width` bits starting at `lsb`
+    def sbfx(self, rd, rn, lsb, width):
+        assert 0 <= lsb < 64 and 0 < width <= 64 - lsb
+        instruction = 0x93400000 | (lsb << 16) | ((lsb + width - 1) << 10) | (rn << 5) | rd
         self._append_instruction(instruction)
 
     def ands(self, rd, rn, immr, imms):
@@ -0,0 +1,195 @@
+from trax_aarch64_sim import SimulatorError, decode_bit_masks
+from trax_tracing import GuardInstruction, ValueInstruction, value_namer
+
+# Turns the instructions AArch64Assembler emits back into assembly text.
+# Anything else comes out as a .word directive.
+
+CONDITIONS = ['eq', 'ne', 'hs', 'lo', 'mi', 'pl', 'vs', 'vc', 'hi', 'ls', 'ge', 'lt', 'gt', 'le', 'al', 'nv']
+
+def _sext(value, bits):
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value & (1 << (bits - 1)) else value
+
+# Register 31 is the stack pointer in some places and the zero register in others
+def _x(r, sp=False):
+    if r == 31:
+        return 'sp' if sp else 'xzr'
+    return f'x{r}'
+
+def _imm(value):
+    return f'#{value}' if -10 < value < 10 else f'#{value:#x}' if value >= 0 else f'#-{-value:#x}'
+
+def _address(base, offset, sp=True):
+    return f'[{_x(base, sp)}]' if offset == 0 else f'[{_x(base, sp)}, #{offset}]'
+
+def disassemble_instruction(word, address=0):
+    rd = word & 0x1F
+    rn = (word >> 5) & 0x1F
+    rm = (word >> 16) & 0x1F
+    op = word >> 24
+
+    if word == 0xD503201F:
+        return 'nop'
+    if word & 0xFFFFFC1F == 0xD65F0000:
+        return 'ret' if rn == 30 else f'ret {_x(rn)}'
+    if word & 0xFFFFFC1F == 0xD63F0000:
+        return f'blr {_x(rn)}'
+    if word & 0xFC000000 == 0x14000000:
+        return f'b {address + _sext(word, 26) * 4:#x}'
+    if word & 0xFF000010 == 0x54000000:
+        return f'b.{CONDITIONS[word & 0xF]} {address + _sext(word >> 5, 19) * 4:#x}'
+    if word & 0xFE000000 == 0xB4000000:
+        name = 'cbnz' if word & (1 << 24) else 'cbz'
+        return f'{name} {_x(rd)}, {address + _sext(word >> 5, 19) * 4:#x}'
+    if word & 0x7E000000 == 0x36000000:
+        name = 'tbnz' if word & (1 << 24) else 'tbz'
+        bit = ((word >> 31) << 5) | ((word >> 19) & 0x1F)
+        return f'{name} {_x(rd)}, #{bit}, {address + _sext(word >> 5, 14) * 4:#x}'
+    if op in (0x91, 0xB1, 0xD1, 0xF1):
+        imm = ((word >> 10) & 0xFFF) << (12 if word & (1 << 22) else 0)
+        subtract, setflags = op in (0xD1, 0xF1), op in (0xB1, 0xF1)
+        if setflags and rd == 31:
+            return f'{"cmp" if subtract else "cmn"} {_x(rn, sp=True)}, {_imm(imm)}'
+        name = ('sub' if subtract else 'add') + ('s' if setflags else '')
+        return f'{name} {_x(rd, sp=not setflags)}, {_x(rn, sp=True)}, {_imm(imm)}'
+    if op in (0x8B, 0xAB, 0xCB, 0xEB) and not word & (1 << 21) and not word & 0xFC00:
+        subtract, setflags = op in (0xCB, 0xEB), op in (0xAB, 0xEB)
+        if setflags and rd == 31:
+            return f'{"cmp" if subtract else "cmn"} {_x(rn)}, {_x(rm)}'
+        name = ('sub' if subtract else 'add') + ('s' if setflags else '')
+        return f'{name} {_x(rd)}, {_x(rn)}, {_x(rm)}'
+    if word & 0xFFE08000 in (0x9B000000, 0x9B008000):
+        ra = (word >> 10) & 0x1F
+        if word & 0x8000:
+            return f'msub {_x(rd)}, {_x(rn)}, {_x(rm)}, {_x(ra)}'
+        if ra == 31:
+            return f'mul {_x(rd)}, {_x(rn)}, {_x(rm)}'
+        return f'madd {_x(rd)}, {_x(rn)}, {_x(rm)}, {_x(ra)}'
+    if word & 0xFFE0FC00 == 0x9AC00C00:
+        return f'sdiv {_x(rd)}, {_x(rn)}, {_x(rm)}'
+    if word & 0xBFE00410 == 0xBA400000:
+        name = 'ccmp' if word & (1 << 30) else 'ccmn'
+        operand = f'#{rm}' if word & (1 << 11) else _x(rm)
+        return f'{name} {_x(rn)}, {operand}, #{word & 0xF}, {CONDITIONS[(word >> 12) & 0xF]}'
+    if word & 0xFFE0FC00 == 0xAA000000:
+        if rn == 31:
+            return f'mov {_x(rd)}, {_x(rm)}'
+        return f'orr {_x(rd)}, {_x(rn)}, {_x(rm)}'
+    if word & 0xFFE0FC00 == 0xCA000000:
+        return f'eor {_x(rd)}, {_x(rn)}, {_x(rm)}'
+    if word & 0xFF800000 in (0xD2800000, 0x92800000, 0xF2800000):
+        name = {0xD2: 'movz', 0x92: 'movn', 0xF2: 'movk'}[op]
+        imm = (word >> 5) & 0xFFFF
+        shift = ((word >> 21) & 0x3) * 16
+        if name == 'movz' and shift == 0:
+            return f'mov {_x(rd)}, {_imm(imm)}'
+        return f'{name} {_x(rd)}, {_imm(imm)}' + (f', lsl #{shift}' if shift else '')
+    if word & 0xFF800000 in (0x92000000, 0xF2000000):
+        try:
+            imm = decode_bit_masks((word >> 22) & 1, (word >> 10) & 0x3F, (word >> 16) & 0x3F)
+        except SimulatorError:
+            return f'.word {word:#010x}'
+        if op == 0xF2:
+            if rd == 31:
+                return f'tst {_x(rn)}, #{imm:#x}'
+            return f'ands {_x(rd)}, {_x(rn)}, #{imm:#x}'
+        return f'and {_x(rd, sp=True)}, {_x(rn)}, #{imm:#x}'
+    if word & 0xFFC00000 in (0x93400000, 0xD3400000):
+        immr = (word >> 16) & 0x3F
+        imms = (word >> 10) & 0x3F
+        if op == 0x93:
+            if imms == 63:
+                return f'asr {_x(rd)}, {_x(rn)}, #{immr}'
+            if imms >= immr:
+                return f'sbfx {_x(rd)}, {_x(rn)}, #{immr}, #{imms - immr + 1}'
+            return f'sbfm {_x(rd)}, {_x(rn)}, #{immr}, #{imms}'
+        if imms == 63:
+            return f'lsr {_x(rd)}, {_x(rn)}, #{immr}'
+        if imms + 1 == immr:
+            return f'lsl {_x(rd)}, {_x(rn)}, #{63 - imms}'
+        return f'ubfm {_x(rd)}, {_x(rn)}, #{immr}, #{imms}'
+    if word & 0xFFC00000 in (0xF9400000, 0xF9000000):
+        name = 'ldr' if word & (1 << 22) else 'str'
+        return f'{name} {_x(rd)}, {_address(rn, ((word >> 10) & 0xFFF) * 8)}'
+    if word & 0xFFE00C00 in (0xF8400000, 0xF8000000):
+        name = 'ldur' if word & (1 << 22) else 'stur'
+        return f'{name} {_x(rd)}, {_address(rn, _sext(word >> 12, 9))}'
+    if word & 0xFFE00C00 == 0x9A800000:
+        return f'csel {_x(rd)}, {_x(rn)}, {_x(rm)}, {CONDITIONS[(word >> 12) & 0xF]}'
+    return f'.word {word:#010x}'
+
+def disassemble(code: bytes, address=0):
+    lines = []
+    for offset in range(0, len(code) - len(code) % 4, 4):
+        word = int.from_bytes(code[offset:offset + 4], byteorder='little')
+        lines.append(disassemble_instruction(word, address + offset))
+    return lines
+
+# The machine code of a trace next to the IR it came from. The backend fills
+# one in while compiling when it's passed to compile_trace. Marks are
+# (instruction index, note) pairs, where the note is one of
+#   ('section', name)      code from here on belongs to that part of the trace
+#   ('ir', instruction)    code from here on implements that IR instruction
+#   ('exit', guard)        the exit stub of a guard starts here
+#   ('spill', registers)   registers being saved to the stack
+#   ('reload', registers)  registers being restored from the stack
+class TraceListing:
+    def __init__(self):
+        self.code = b''
+        self.marks = []
+        self.ir_text = {}
+        self.register_allocation = {}
+        self.immediates = set()
+
+    def record(self, trace_compiler, code, marks, register_allocation, immediates):
+        self.code = code
+        self.marks = sorted(marks, key=lambda mark: mark[0])
+        self.register_allocation = register_allocation
+        self.immediates = immediates
+        # Name values the same way TraceCompiler.pretty_print does
+        namer = value_namer()
+        for inst in trace_compiler.preamble + trace_compiler.body:
+            self.ir_text[inst] = inst.pretty_print(namer)
+
+    def _location(self, inst):
+        if inst in self.register_allocation:
+            return _x(self.register_allocation[inst])
+        if inst in self.immediates:
+            return 'immediate'
+        return None
+
+    # Byte size of each section in order
+    def section_sizes(self):
+        starts = [(index, note[1]) for index, note in self.marks if note[0] == 'section']
+        ends = [index for index, _ in starts[1:]] + [len(self.code) // 4]
+        return [(name, (end - start) * 4) for (start, name), end in zip(starts, ends)]
+
+    def __str__(self):
+        sizes = dict(self.section_sizes())
+        exits = {index * 4: note[1] for index, note in self.marks if note[0] == 'exit'}
+        lines = [f'; {len(self.code)} bytes']
+        marks = iter(self.marks)
+        mark = next(marks, None)
+        for offset, text in zip(range(0, len(self.code), 4), disassemble(self.code)):
+            while mark is not None and mark[0] * 4 <= offset:
+                kind, value = mark[1]
+                if kind == 'section':
+                    lines.append(f'{value}: ; {sizes[value]} bytes')
+                elif kind == 'ir':
+                    location = self._location(value) if isinstance(value, ValueInstruction) else None
+                    lines.append(f'  {self.ir_text.get(value, value)}' + (f'  ; -> {location}' if location else ''))
+                elif kind == 'exit':
+                    lines.append(f'  ; exit for guard_id={value.guard_id}, keeps {len(value.values_to_keep)} values')
+                else:
+                    lines.append(f'  ; {kind} {", ".join(_x(r) for r in value)}')
+                mark = next(marks, None)
+            word = int.from_bytes(self.code[offset:offset + 4], byteorder='little')
+            target = text.rsplit(' ', 1)[-1]
+            if target.startswith('0x') and int(target, 16) in exits:
+                text += f'  ; exit guard_id={exits[int(target, 16)].guard_id}'
+            lines.append(f'    {offset:04x}  {word:08x}  {text}')
+        # Marks past the end of the code, like IR that didn't need any
+        for _, (kind, value) in ([mark] if mark else []) + list(marks):
+            if kind == 'ir':
+                lines.append(f'  {self.ir_text.get(value, value)}')
+        return '\n'.join(lines)
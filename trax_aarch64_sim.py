@@ -0,0 +1,555 @@
+import ctypes
+from trax_obj import ffi, TraxObject
+from trax_aarch64_asm import AArch64Assembler
+from trax_backend import AppleSiliconBackend, TraceEntry
+from trax_tracing import CallHelperInstruction
+
+# A small interpreter for the subset of AArch64 that AArch64Assembler emits. It
+# runs against real process memory, so inputs, const tables, return buffers and
+# heap objects are shared with the rest of the runtime exactly like on hardware.
+
+MASK64 = (1 << 64) - 1
+
+def _sext(value, bits):
+    value &= (1 << bits) - 1
+    if value & (1 << (bits - 1)):
+        value -= 1 << bits
+    return value
+
+def _signed(value):
+    return value - (1 << 64) if value & (1 << 63) else value
+
+def _ror(value, amount, width=64):
+    amount %= width
+    mask = (1 << width) - 1
+    return ((value >> amount) | (value << (width - amount))) & mask
+
+def decode_bit_masks(n, imms, immr):
+    # The logical immediate encoding from the ARM ARM (DecodeBitMasks)
+    length = (n << 6 | (~imms & 0x3F)).bit_length() - 1
+    if length < 1:
+        raise SimulatorError("Reserved logical immediate")
+    size = 1 << length
+    levels = size - 1
+    s = imms & levels
+    r = immr & levels
+    if s == levels:
+        raise SimulatorError("Reserved logical immediate")
+    pattern = _ror((1 << (s + 1)) - 1, r, size)
+    while size < 64:
+        pattern |= pattern << size
+        size *= 2
+    return pattern & MASK64
+
+class SimulatorError(Exception):
+    pass
+
+# Latencies (in cycles) for the simple in-order cost model. Everything not
+# listed here takes a single cycle.
+LATENCIES = {
+    'load': 4,
+    'mul': 3,
+    'div': 12,
+}
+
+TAKEN_BRANCH_PENALTY = 1
+
+# The address we put in x30 so that the final `ret` stops the simulation
+RETURN_SENTINEL = 0xFFFFFFFFFFFFFFFC
+
+class SimulatorStats:
+    def __init__(self):
+        self.instructions = 0
+        self.cycles = 0
+        self.loads = 0
+        self.stores = 0
+        self.branches = 0
+        self.taken_branches = 0
+        self.calls = 0
+
+    def __repr__(self):
+        return (f"SimulatorStats(instructions={self.instructions}, cycles={self.cycles}, loads={self.loads}, "
+                f"stores={self.stores}, branches={self.branches}, taken_branches={self.taken_branches}, calls={self.calls})")
+
+class AArch64Simulator:
+    def __init__(self, stack_size=64 * 1024, max_steps=100_000_000):
+        self.regs = [0] * 32 # x0-x30, and index 31 is sp
+        self.n = self.z = self.c = self.v = 0
+        self.stack = ffi.new(f"char[{stack_size}]")
+        self.stack_top = (int(ffi.cast("uintptr_t", self.stack)) + stack_size) & ~0xF
+        self.max_steps = max_steps
+        self.stats = SimulatorStats()
+        self.ready = [0] * 33 # Cycle at which each register (and the flags, index 32) becomes available
+        self.decoded = {}
+
+    # Memory goes straight to the host process
+    def load64(self, address):
+        self.stats.loads += 1
+        return ctypes.c_uint64.from_address(address).value
+
+    def store64(self, address, value):
+        self.stats.stores += 1
+        ctypes.c_uint64.from_address(address).value = value & MASK64
+
+    def reg(self, r):
+        return 0 if r == 31 else self.regs[r]
+
+    def reg_sp(self, r):
+        return self.regs[r]
+
+    def set_reg(self, r, value):
+        if r != 31:
+            self.regs[r] = value & MASK64
+
+    def set_reg_sp(self, r, value):
+        self.regs[r] = value & MASK64
+
+    def set_nzcv_sub(self, a, b):
+        result = (a - b) & MASK64
+        self.n = result >> 63
+        self.z = int(result == 0)
+        self.c = int(a >= b)
+        self.v = int(((a ^ b) & (a ^ result)) >> 63)
+        return result
+
+    def set_nzcv_add(self, a, b):
+        full = a + b
+        result = full & MASK64
+        self.n = result >> 63
+        self.z = int(result == 0)
+        self.c = int(full > MASK64)
+        self.v = int((~(a ^ b) & (a ^ result) & (1 << 63)) != 0)
+        return result
+
+    def condition_holds(self, cond):
+        base = cond >> 1
+        if base == 0:
+            result = self.z == 1
+        elif base == 1:
+            result = self.c == 1
+        elif base == 2:
+            result = self.n == 1
+        elif base == 3:
+            result = self.v == 1
+        elif base == 4:
+            result = self.c == 1 and self.z == 0
+        elif base == 5:
+            result = self.n == self.v
+        elif base == 6:
+            result = self.n == self.v and self.z == 0
+        else:
+            result = True
+        if cond & 1 and cond != 0xF:
+            result = not result
+        return result
+
+    def shift_reg(self, value, shift, amount):
+        if shift == 0:
+            return (value << amount) & MASK64
+        elif shift == 1:
+            return value >> amount
+        elif shift == 2:
+            return (_signed(value) >> amount) & MASK64
+        return _ror(value, amount)
+
+    def decode(self, inst):
+        decoded = self.decoded.get(inst)
+        if decoded is None:
+            decoded = self._decode(inst)
+            self.decoded[inst] = decoded
+        return decoded
+
+    # Returns (kind, fields, uses, defs). `uses` and `defs` list register
+    # numbers (32 stands for the flags) and feed the cycle model.
+    def _decode(self, inst):
+        rd = inst & 0x1F
+        rn = (inst >> 5) & 0x1F
+        rm = (inst >> 16) & 0x1F
+        op = inst >> 24
+        if inst == 0xD503201F:
+            return ('nop', (), (), ())
+        if inst & 0xFFFFFC1F == 0xD65F0000:
+            return ('ret', (rn,), (rn,), ())
+        if inst & 0xFFFFFC1F == 0xD63F0000:
+            return ('blr', (rn,), (rn,), (30,))
+        if inst & 0xFFFFFC1F == 0xD61F0000:
+            return ('br', (rn,), (rn,), ())
+        if inst & 0xFC000000 == 0x14000000:
+            return ('b', (_sext(inst, 26) * 4,), (), ())
+        if inst & 0xFC000000 == 0x94000000:
+            return ('bl', (_sext(inst, 26) * 4,), (), (30,))
+        if inst & 0xFF000010 == 0x54000000:
+            return ('b.cond', (inst & 0xF, _sext(inst >> 5, 19) * 4), (32,), ())
+        if inst & 0xFE000000 == 0xB4000000:
+            return ('cbz' if not inst & 0x01000000 else 'cbnz', (rd, _sext(inst >> 5, 19) * 4), (rd,), ())
+        if inst & 0x7E000000 == 0x36000000:
+            bit = ((inst >> 31) << 5) | ((inst >> 19) & 0x1F)
+            return ('tbz' if not inst & 0x01000000 else 'tbnz', (rd, bit, _sext(inst >> 5, 14) * 4), (rd,), ())
+        if op in (0x91, 0xB1, 0xD1, 0xF1):
+            imm = ((inst >> 10) & 0xFFF) << (12 if inst & (1 << 22) else 0)
+            setflags = op in (0xB1, 0xF1)
+            defs = (rd, 32) if setflags else (rd,)
+            return ('sub_imm' if op in (0xD1, 0xF1) else 'add_imm', (rd, rn, imm, setflags), (rn,), defs)
+        if op in (0x8B, 0xAB, 0xCB, 0xEB) and not inst & (1 << 21):
+            shift = (inst >> 22) & 0x3
+            amount = (inst >> 10) & 0x3F
+            setflags = op in (0xAB, 0xEB)
+            defs = (rd, 32) if setflags else (rd,)
+            return ('sub' if op in (0xCB, 0xEB) else 'add', (rd, rn, rm, shift, amount, setflags), (rn, rm), defs)
+        if op in (0x8A, 0xAA, 0xCA, 0xEA):
+            shift = (inst >> 22) & 0x3
+            amount = (inst >> 10) & 0x3F
+            negate = (inst >> 21) & 1
+            kind = {0x8A: 'and', 0xAA: 'orr', 0xCA: 'eor', 0xEA: 'ands'}[op]
+            defs = (rd, 32) if kind == 'ands' else (rd,)
+            return (kind, (rd, rn, rm, shift, amount, negate), (rn, rm), defs)
+        if op in (0x92, 0xB2, 0xD2, 0xF2) and not inst & (1 << 23):
+            imm = decode_bit_masks((inst >> 22) & 1, (inst >> 10) & 0x3F, (inst >> 16) & 0x3F)
+            kind = {0x92: 'and_imm', 0xB2: 'orr_imm', 0xD2: 'eor_imm', 0xF2: 'ands_imm'}[op]
+            defs = (rd, 32) if kind == 'ands_imm' else (rd,)
+            return (kind, (rd, rn, imm), (rn,), defs)
+        if op in (0x92, 0xD2, 0xF2) and inst & (1 << 23):
+            hw = (inst >> 21) & 0x3
+            imm = (inst >> 5) & 0xFFFF
+            kind = {0x92: 'movn', 0xD2: 'movz', 0xF2: 'movk'}[op]
+            uses = (rd,) if kind == 'movk' else ()
+            return (kind, (rd, imm << (hw * 16), hw * 16), uses, (rd,))
+        if op in (0x93, 0xB3, 0xD3) and inst & (1 << 22):
+            immr = (inst >> 16) & 0x3F
+            imms = (inst >> 10) & 0x3F
+            kind = {0x93: 'sbfm', 0xB3: 'bfm', 0xD3: 'ubfm'}[op]
+            uses = (rn, rd) if kind == 'bfm' else (rn,)
+            return (kind, (rd, rn, immr, imms), uses, (rd,))
+        if inst & 0xFFC00000 == 0xF9400000:
+            return ('ldr', (rd, rn, ((inst >> 10) & 0xFFF) * 8), (rn,), (rd,))
+        if inst & 0xFFC00000 == 0xF9000000:
+            return ('str', (rd, rn, ((inst >> 10) & 0xFFF) * 8), (rn, rd), ())
+        if inst & 0xFFE00C00 == 0xF8400000:
+            return ('ldr', (rd, rn, _sext(inst >> 12, 9)), (rn,), (rd,))
+        if inst & 0xFFE00C00 == 0xF8000000:
+            return ('str', (rd, rn, _sext(inst >> 12, 9)), (rn, rd), ())
+        if inst & 0xFF000000 == 0x58000000:
+            return ('ldr_literal', (rd, _sext(inst >> 5, 19) * 4), (), (rd,))
+        if inst & 0xFE000000 == 0xA8000000 or inst & 0xFE000000 == 0xA9000000:
+            rt2 = (inst >> 10) & 0x1F
+            offset = _sext(inst >> 15, 7) * 8
+            index_mode = (inst >> 23) & 0x3 # 1 = post, 2 = offset, 3 = pre
+            is_load = (inst >> 22) & 1
+            if is_load:
+                return ('ldp', (rd, rt2, rn, offset, index_mode), (rn,), (rd, rt2, rn))
+            return ('stp', (rd, rt2, rn, offset, index_mode), (rn, rd, rt2), (rn,))
+        if inst & 0xFFE00C00 == 0x9A800000 or inst & 0xFFE00C00 == 0x9A800400 or \
+           inst & 0xFFE00C00 == 0xDA800000 or inst & 0xFFE00C00 == 0xDA800400:
+            cond = (inst >> 12) & 0xF
+            variant = ((inst >> 30) & 1) << 1 | ((inst >> 10) & 1)
+            kind = ('csel', 'csinc', 'csinv', 'csneg')[variant]
+            return (kind, (rd, rn, rm, cond), (rn, rm, 32), (rd,))
+        if inst & 0xBFE00410 == 0xBA400000:
+            cond = (inst >> 12) & 0xF
+            is_imm = (inst >> 11) & 1
+            is_sub = (inst >> 30) & 1
+            uses = (rn, 32) if is_imm else (rn, rm, 32)
+            return ('ccmp' if is_sub else 'ccmn', (rn, rm, is_imm, cond, inst & 0xF), uses, (32,))
+        if inst & 0xFFE08000 == 0x9B000000:
+            return ('madd', (rd, rn, rm, (inst >> 10) & 0x1F), (rn, rm, (inst >> 10) & 0x1F), (rd,))
+        if inst & 0xFFE08000 == 0x9B008000:
+            return ('msub', (rd, rn, rm, (inst >> 10) & 0x1F), (rn, rm, (inst >> 10) & 0x1F), (rd,))
+        if inst & 0xFFE0FC00 == 0x9B407C00:
+            return ('smulh', (rd, rn, rm), (rn, rm), (rd,))
+        if inst & 0xFFE0FC00 == 0x9AC00C00:
+            return ('sdiv', (rd, rn, rm), (rn, rm), (rd,))
+        if inst & 0xFFE0FC00 == 0x9AC00800:
+            return ('udiv', (rd, rn, rm), (rn, rm), (rd,))
+        if inst & 0xFFE0F000 == 0x9AC02000:
+            kind = ('lslv', 'lsrv', 'asrv', 'rorv')[(inst >> 10) & 0x3]
+            return (kind, (rd, rn, rm), (rn, rm), (rd,))
+        raise SimulatorError(f"Unsupported instruction 0x{inst:08x}")
+
+    def latency(self, kind):
+        if kind in ('ldr', 'ldp', 'ldr_literal'):
+            return LATENCIES['load']
+        if kind in ('madd', 'msub', 'smulh'):
+            return LATENCIES['mul']
+        if kind in ('sdiv', 'udiv'):
+            return LATENCIES['div']
+        return 1
+
+    def run(self, code: bytes, args=(), helpers=None):
+        words = [int.from_bytes(code[i:i + 4], byteorder='little') for i in range(0, len(code), 4)]
+        decoded = [self.decode(w) for w in words]
+        code_base = 0x1000 # Code addresses only matter for pc relative instructions
+        self.regs = [0] * 32
+        for i, arg in enumerate(args):
+            self.regs[i] = arg & MASK64
+        self.regs[30] = RETURN_SENTINEL
+        self.regs[31] = self.stack_top
+        helpers = helpers or {}
+        stats = self.stats
+        ready = self.ready
+        cycle = stats.cycles
+        pc = 0
+        steps = 0
+        while True:
+            if steps >= self.max_steps:
+                raise SimulatorError("Step limit exceeded")
+            steps += 1
+            if not 0 <= pc < len(decoded) * 4:
+                raise SimulatorError(f"pc out of range: {pc}")
+            kind, f, uses, defs = decoded[pc >> 2]
+            stats.instructions += 1
+
+            # In-order issue: wait for operands, then account for the result latency
+            start = cycle + 1
+            for r in uses:
+                if ready[r] > start:
+                    start = ready[r]
+            cycle = start
+            done = cycle + self.latency(kind) - 1
+            for r in defs:
+                ready[r] = done
+
+            next_pc = pc + 4
+            if kind == 'add_imm' or kind == 'sub_imm':
+                rd, rn, imm, setflags = f
+                a = self.reg_sp(rn)
+                if setflags:
+                    result = self.set_nzcv_add(a, imm) if kind == 'add_imm' else self.set_nzcv_sub(a, imm)
+                    self.set_reg(rd, result)
+                else:
+                    self.set_reg_sp(rd, a + imm if kind == 'add_imm' else a - imm)
+            elif kind == 'add' or kind == 'sub':
+                rd, rn, rm, shift, amount, setflags = f
+                a = self.reg(rn)
+                b = self.shift_reg(self.reg(rm), shift, amount)
+                if setflags:
+                    result = self.set_nzcv_add(a, b) if kind == 'add' else self.set_nzcv_sub(a, b)
+                else:
+                    result = a + b if kind == 'add' else a - b
+                self.set_reg(rd, result)
+            elif kind in ('and', 'orr', 'eor', 'ands'):
+                rd, rn, rm, shift, amount, negate = f
+                b = self.shift_reg(self.reg(rm), shift, amount)
+                if negate:
+                    b = ~b & MASK64
+                a = self.reg(rn)
+                if kind == 'orr':
+                    result = a | b
+                elif kind == 'eor':
+                    result = a ^ b
+                else:
+                    result = a & b
+                if kind == 'ands':
+                    self.n, self.z, self.c, self.v = result >> 63, int(result == 0), 0, 0
+                self.set_reg(rd, result)
+            elif kind in ('and_imm', 'orr_imm', 'eor_imm', 'ands_imm'):
+                rd, rn, imm = f
+                a = self.reg(rn)
+                if kind == 'orr_imm':
+                    self.set_reg_sp(rd, a | imm)
+                elif kind == 'eor_imm':
+                    self.set_reg_sp(rd, a ^ imm)
+                elif kind == 'and_imm':
+                    self.set_reg_sp(rd, a & imm)
+                else:
+                    result = a & imm
+                    self.n, self.z, self.c, self.v = result >> 63, int(result == 0), 0, 0
+                    self.set_reg(rd, result)
+            elif kind == 'movz':
+                self.set_reg(f[0], f[1])
+            elif kind == 'movn':
+                self.set_reg(f[0], ~f[1])
+            elif kind == 'movk':
+                rd, imm, shift = f
+                self.set_reg(rd, (self.reg(rd) & ~(0xFFFF << shift)) | imm)
+            elif kind in ('ubfm', 'sbfm', 'bfm'):
+                rd, rn, immr, imms = f
+                src = self.reg(rn)
+                if imms >= immr:
+                    width = imms - immr + 1
+                    field = (src >> immr) & ((1 << width) - 1)
+                    if kind == 'sbfm':
+                        field = _sext(field, width) & MASK64
+                    if kind == 'bfm':
+                        mask = (1 << width) - 1
+                        field = (self.reg(rd) & ~mask) | field
+                else:
+                    width = imms + 1
+                    pos = 64 - immr
+                    field = src & ((1 << width) - 1)
+                    if kind == 'sbfm':
+                        field = _sext(field, width) & MASK64
+                    field = (field << pos) & MASK64
+                    if kind == 'bfm':
+                        mask = ((1 << width) - 1) << pos
+                        field = (self.reg(rd) & ~mask) | field
+                self.set_reg(rd, field)
+            elif kind == 'ldr':
+                rt, rn, offset = f
+                self.set_reg(rt, self.load64(self.reg_sp(rn) + offset))
+            elif kind == 'str':
+                rt, rn, offset = f
+                self.store64(self.reg_sp(rn) + offset, self.reg(rt))
+            elif kind == 'ldr_literal':
+                rt, offset = f
+                index = (pc + offset) >> 2
+                stats.loads += 1
+                self.set_reg(rt, words[index] | (words[index + 1] << 32))
+            elif kind == 'ldp' or kind == 'stp':
+                rt, rt2, rn, offset, index_mode = f
+                base = self.reg_sp(rn)
+                address = base if index_mode == 1 else base + offset
+                if kind == 'ldp':
+                    self.set_reg(rt, self.load64(address))
+                    self.set_reg(rt2, self.load64(address + 8))
+                else:
+                    self.store64(address, self.reg(rt))
+                    self.store64(address + 8, self.reg(rt2))
+                if index_mode in (1, 3):
+                    self.set_reg_sp(rn, base + offset)
+            elif kind in ('csel', 'csinc', 'csinv', 'csneg'):
+                rd, rn, rm, cond = f
+                if self.condition_holds(cond):
+                    result = self.reg(rn)
+                else:
+                    result = self.reg(rm)
+                    if kind == 'csinc':
+                        result += 1
+                    elif kind == 'csinv':
+                        result = ~result
+                    elif kind == 'csneg':
+                        result = -result
+                self.set_reg(rd, result)
+            elif kind == 'ccmp' or kind == 'ccmn':
+                rn, rm, is_imm, cond, nzcv = f
+                if self.condition_holds(cond):
+                    b = rm if is_imm else self.reg(rm)
+                    if kind == 'ccmp':
+                        self.set_nzcv_sub(self.reg(rn), b)
+                    else:
+                        self.set_nzcv_add(self.reg(rn), b)
+                else:
+                    self.n, self.z, self.c, self.v = (nzcv >> 3) & 1, (nzcv >> 2) & 1, (nzcv >> 1) & 1, nzcv & 1
+            elif kind == 'madd' or kind == 'msub':
+                rd, rn, rm, ra = f
+                product = self.reg(rn) * self.reg(rm)
+                self.set_reg(rd, self.reg(ra) + product if kind == 'madd' else self.reg(ra) - product)
+            elif kind == 'smulh':
+                rd, rn, rm = f
+                self.set_reg(rd, (_signed(self.reg(rn)) * _signed(self.reg(rm))) >> 64)
+            elif kind == 'sdiv' or kind == 'udiv':
+                rd, rn, rm = f
+                if kind == 'sdiv':
+                    a, b = _signed(self.reg(rn)), _signed(self.reg(rm))
+                else:
+                    a, b = self.reg(rn), self.reg(rm)
+                if b == 0:
+                    result = 0
+                else:
+                    result = abs(a) // abs(b)
+                    if (a < 0) != (b < 0):
+                        result = -result
+                self.set_reg(rd, result)
+            elif kind in ('lslv', 'lsrv', 'asrv', 'rorv'):
+                rd, rn, rm = f
+                amount = self.reg(rm) & 0x3F
+                self.set_reg(rd, self.shift_reg(self.reg(rn), ('lslv', 'lsrv', 'asrv', 'rorv').index(kind), amount))
+            elif kind == 'b':
+                next_pc = pc + f[0]
+            elif kind == 'bl':
+                self.set_reg(30, code_base + pc + 4)
+                next_pc = pc + f[0]
+            elif kind == 'b.cond':
+                stats.branches += 1
+                if self.condition_holds(f[0]):
+                    next_pc = pc + f[1]
+            elif kind == 'cbz' or kind == 'cbnz':
+                stats.branches += 1
+                rt, offset = f
+                if (self.reg(rt) == 0) == (kind == 'cbz'):
+                    next_pc = pc + offset
+            elif kind == 'tbz' or kind == 'tbnz':
+                stats.branches += 1
+                rt, bit, offset = f
+                if ((self.reg(rt) >> bit) & 1) == (kind == 'tbnz'):
+                    next_pc = pc + offset
+            elif kind == 'blr':
+                target = self.reg(f[0])
+                if target not in helpers:
+                    raise SimulatorError(f"Call to unknown helper at 0x{target:x}")
+                stats.calls += 1
+                result = helpers[target](*[self.regs[i] for i in range(8)])
+                for r in range(0, 18):
+                    self.regs[r] = 0xDEADBEEF # Model the clobbering of caller saved registers
+                self.regs[0] = result & MASK64
+            elif kind == 'br':
+                raise SimulatorError("Indirect branches are not supported")
+            elif kind == 'ret':
+                target = self.reg(f[0])
+                if target == RETURN_SENTINEL:
+                    stats.cycles = cycle
+                    return _signed(self.regs[0])
+                next_pc = target - code_base
+            elif kind == 'nop':
+                pass
+            else:
+                raise SimulatorError(f"Unhandled instruction kind {kind}")
+
+            if next_pc != pc + 4:
+                stats.taken_branches += 1
+                cycle += TAKEN_BRANCH_PENALTY
+            pc = next_pc
+
+def _address(cdata):
+    return int(ffi.cast("uintptr_t", cdata))
+
+# A trace entry whose code runs in the simulator. It has the same persistent
+# buffers as a native one, the simulator just stands in for the function pointer.
+class SimulatorTraceEntry(TraceEntry):
+    def __init__(self, backend: "SimulatorBackend", code: bytes, num_inputs: int, num_exit_values: int, const_table):
+        super().__init__(0, num_inputs, num_exit_values, const_table)
+        self.backend = backend
+        self.code = code
+        self.function = self._run
+
+    def _run(self, inputs, const_table, exits):
+        args = (_address(inputs), _address(const_table), _address(exits))
+        return self.backend.simulator.run(self.code, args, self.backend.helpers)
+
+# Generates the same code as AppleSiliconBackend but runs it in the simulator,
+# so traces can be tested and measured on hosts that aren't AArch64. The
+# simulator's stats add up over every run.
+class SimulatorBackend(AppleSiliconBackend):
+    def __init__(self, **simulator_args):
+        super().__init__()
+        self.simulator = AArch64Simulator(**simulator_args)
+        # The runtime functions traces can call, by address. The simulator
+        # passes x0-x7 to them.
+        self.helpers = {
+            _address(self.allocate_object): lambda type_index, num_fields, *_: self._allocate_object(type_index, num_fields),
+        }
+
+    @property
+    def stats(self) -> SimulatorStats:
+        return self.simulator.stats
+
+    # Helpers a trace calls become callable from simulated code too
+    def compile_trace(self, trace_compiler, const_table, listing=None):
+        for inst in trace_compiler.preamble + trace_compiler.body:
+            if isinstance(inst, CallHelperInstruction):
+                helper = inst.helper
+                self.helpers[helper.address] = lambda *regs, helper=helper: helper.call([_signed(r) for r in regs[:helper.num_args]], regs[helper.num_args])
+        return super().compile_trace(trace_compiler, const_table, listing)
+
+    # Nothing runs natively so the code just stays as bytes
+    def create_executable_memory(self, code_bytes):
+        if isinstance(code_bytes, AArch64Assembler):
+            return code_bytes.to_bytes()
+        return bytes(code_bytes)
+
+    def call_function(self, func_ptr, args: list[TraxObject], const_table, return_buffer_size: int = 0):
+        entry = self.prepare_trace(func_ptr, len(args), return_buffer_size, const_table)
+        return_value = entry.enter(args)
+        return return_value, entry.exit_values(return_buffer_size)
+
+    def prepare_trace(self, func_ptr, num_inputs: int, num_exit_values: int, const_table):
+        return SimulatorTraceEntry(self, func_ptr, num_inputs, num_exit_values, const_table)
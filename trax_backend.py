@@ -1,11 +1,80 @@
 import mmap
 import ctypes
+import platform
 import sys
 import os
 from trax_aarch64_asm import AArch64Assembler
 from trax_obj import ffi, TraxObject
 from trax_tracing import *
 
+# Raised when a trace uses something the backend can't generate code for.
+# The interpreter gives up on compiling that loop and keeps interpreting it.
+class CompilationError(Exception):
+    pass
+
+# The signature of compiled traces: (inputs, const table, return buffer) -> guard id
+TRACE_FUNCTION_TYPE = ffi.typeof("int(*)(trax_value*, trax_value*, trax_value*)")
+
+# A compiled trace ready to be entered over and over. The function pointer is
+# cast once, and the inputs and the exit values go through buffers that are
+# allocated once, sized for the trace's inputs and its largest guard exit.
+class TraceEntry:
+    def __init__(self, func_ptr, num_inputs: int, num_exit_values: int, const_table):
+        self.function = ffi.cast(TRACE_FUNCTION_TYPE, func_ptr)
+        self.inputs = ffi.new(f"trax_value[{max(num_inputs, 1)}]")
+        self.exits = ffi.new(f"trax_value[{max(num_exit_values, 1)}]")
+        self.num_inputs = num_inputs
+        self.const_table = const_table
+
+    # Runs the trace on the given stack and returns the id of the guard it left through
+    def enter(self, args: list[TraxObject]) -> int:
+        assert len(args) == self.num_inputs
+        self.inputs[0:len(args)] = [arg.value for arg in args]
+        return self.function(self.inputs, self.const_table, self.exits)
+
+    # The first `count` values the last exit stored
+    def exit_values(self, count: int) -> list[TraxObject]:
+        return [TraxObject(value) for value in self.exits[0:count]]
+
+# A native function that compiled traces can call, see CallHelperInstruction.
+# It's called as status = function(arg_0, ..., arg_n-1, &result) on
+# trax_values and returns 0 once it has stored its result. Anything else
+# means it couldn't handle these arguments and the trace exits so the
+# interpreter can. Arguments go in registers, with the last one holding the
+# result pointer, so there can be at most 7.
+class NativeHelper:
+    MAX_ARGS = 7
+
+    def __init__(self, name: str, function, num_args: int):
+        if num_args > self.MAX_ARGS:
+            raise ValueError(f"Helpers take at most {self.MAX_ARGS} arguments, {name} takes {num_args}")
+        self.name = name
+        self.function = function
+        self.num_args = num_args
+
+    # Wraps a Python function taking and returning TraxObjects. Returning
+    # None reports failure.
+    @staticmethod
+    def from_python(name: str, num_args: int, func):
+        signature = f"int64_t({', '.join(['trax_value'] * num_args + ['trax_value*'])})"
+
+        def call(*args):
+            result = func(*[TraxObject(arg) for arg in args[:-1]])
+            if result is None:
+                return 1
+            args[-1][0] = result.value
+            return 0
+
+        return NativeHelper(name, ffi.callback(signature, call), num_args)
+
+    @property
+    def address(self) -> int:
+        return int(ffi.cast("uintptr_t", self.function))
+
+    # Calls the helper with raw trax_values and a pointer to the result
+    def call(self, args, result) -> int:
+        return self.function(*args, ffi.cast("trax_value *", result))
+
 class Backend:
     def create_executable_memory(self, code_bytes: bytes):
         raise NotImplementedError("Subclasses must implement create_executable_memory")
@@ -16,6 +85,9 @@ class Backend:
     def call_function(self, func_ptr, args: list[TraxObject], const_table, return_buffer_size: int):
         raise NotImplementedError("Subclasses must implement call_function")
 
+    def prepare_trace(self, func_ptr, num_inputs: int, num_exit_values: int, const_table) -> TraceEntry:
+        raise NotImplementedError("Subclasses must implement prepare_trace")
+
     def compile_trace(self, trace_compiler: TraceCompiler, const_table):
         raise NotImplementedError("Subclasses must implement compile_trace")
 
@@ -23,15 +95,40 @@ class Backend:
     def apple_silicon():
         return AppleSiliconBackend()
 
+    # Traces run natively on Apple Silicon and in the simulator everywhere else
+    @staticmethod
+    def default():
+        if sys.platform == "darwin" and platform.machine() == "arm64":
+            return AppleSiliconBackend()
+        from trax_aarch64_sim import SimulatorBackend
+        return SimulatorBackend()
+
 # NOTE: Nice to haves later
 #         > spill the inputs to a different register in the preamble (backend specific)
 #         > allocate anything needed for spills (backend specific)
 #         > add instruction for small constants
 
 class AppleSiliconBackend(Backend):
+    # Registers a called function has to preserve
+    CALLEE_SAVED = [19, 20, 21, 22, 23, 24, 25, 26, 27, 28]
+
+    def __init__(self):
+        # Traces call back into the runtime to allocate objects that escape
+        self.allocate_object = ffi.callback("trax_value(int64_t, int64_t)", self._allocate_object)
+
+    @staticmethod
+    def _allocate_object(type_index, num_fields):
+        obj = TraxObject.new(type_index, [TraxObject.from_int(0)] * num_fields)
+        return obj.value
+
+    # Takes finished code, or an assembler that then writes its code straight
+    # into the new mapping without making a copy first
     def create_executable_memory(self, code_bytes):
         page_size = mmap.PAGESIZE
-        code_size = len(code_bytes)
+        if isinstance(code_bytes, AArch64Assembler):
+            code_size = len(code_bytes.finalize()) * 4
+        else:
+            code_size = len(code_bytes)
         aligned_size = (code_size + page_size - 1) & ~(page_size - 1)
 
         libc = ctypes.CDLL(None)
@@ -59,7 +156,10 @@ class AppleSiliconBackend(Backend):
             raise OSError(os.strerror(errno.value))
 
         # Copy code to the allocated memory
-        ctypes.memmove(addr, code_bytes, len(code_bytes))
+        if isinstance(code_bytes, AArch64Assembler):
+            code_bytes.write_to(addr)
+        else:
+            ctypes.memmove(addr, code_bytes, code_size)
 
         # Change memory protection to executable
         err = mprotect_function(addr, aligned_size, mmap.PROT_EXEC | mmap.PROT_READ)
@@ -102,67 +202,135 @@ class AppleSiliconBackend(Backend):
 
         return return_value, return_values
 
-    # TODO TODO TODO: This needs to be tested!!!
-    def compile_trace(self, trace_compiler: TraceCompiler, const_table):
-        from trax_aarch64_asm import AArch64Assembler, RelocVar
+    def prepare_trace(self, func_ptr, num_inputs: int, num_exit_values: int, const_table):
+        return TraceEntry(func_ptr, num_inputs, num_exit_values, const_table)
 
+    # TODO TODO TODO: This needs to be tested!!!
+    # Pass a TraceListing to get the code annotated with where it came from
+    def compile_trace(self, trace_compiler: TraceCompiler, const_table, listing=None):
         asm = AArch64Assembler()
 
-        # Create RelocVars for all guard exits
-        guard_exits = {inst.guard_id: RelocVar() for inst in trace_compiler.get_instructions() if isinstance(inst, GuardInstruction)}
+        # Create labels for all guard exits. The preamble and body copies of
+        # a guard, and guards the optimizer added, can share a guard_id while
+        # keeping different values so each guard instruction gets its own exit.
+        instructions = trace_compiler.preamble + trace_compiler.body
+        guard_exits = {inst: asm.new_label() for inst in instructions if isinstance(inst, GuardInstruction)}
+        # Helper calls check their own status, exiting through the guard on it
+        for inst in instructions:
+            if isinstance(inst, GuardSuccess):
+                guard_exits[inst.operand] = guard_exits[inst]
+        # sdiv gives 0 for a division by zero instead of failing, so every
+        # divisor has to be a constant other than 0 or checked by a guard
+        checked_divisors = {inst.operand for inst in instructions if isinstance(inst, GuardNonZero)}
+        for inst in instructions:
+            if isinstance(inst, (DivInstruction, ModInstruction)) and inst.right not in checked_divisors:
+                if not isinstance(inst.right, ConstantInstruction) or self._constant_bits(inst.right, const_table) == 0:
+                    raise CompilationError(f"{type(inst).__name__} divides by a value that isn't checked for zero")
+
+        # Constants that can be encoded directly into the instructions using them don't need a register
+        immediates = self._find_immediates(instructions, const_table)
+
+        # The preamble and the body are each scheduled on their own. If that
+        # keeps too many values alive at once we stick to the original order.
+        copies = [inst for inst in trace_compiler.preamble if isinstance(inst, CopyInstruction)]
+        preamble = [inst for inst in trace_compiler.preamble if not isinstance(inst, CopyInstruction)]
+        body = trace_compiler.body
+        latency = lambda inst: self._latency(inst, immediates, const_table)
+        scheduled_preamble = schedule_instructions(preamble, latency)
+        carried = {inst.phi: inst for inst in preamble if isinstance(inst, InputInstruction) and inst.phi is not inst}
+        scheduled_body = schedule_instructions(body, latency, carried)
 
         # Perform register allocation
         allowed_registers = [3, 4, 5, 6, 7, 9, 10, 11, 12, 13, 14, 15, 8, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28]
-        instructions = trace_compiler.preamble + trace_compiler.body
-        register_allocation = allocate_registers(instructions, allowed_registers)
+        loop_start = len(trace_compiler.preamble)
+        try:
+            instructions = scheduled_preamble + copies + scheduled_body
+            register_allocation = allocate_registers(instructions, allowed_registers, loop_start=loop_start, skip=immediates)
+            preamble, body = scheduled_preamble, scheduled_body
+        except ValueError:
+            instructions = preamble + copies + body
+            try:
+                register_allocation = allocate_registers(instructions, allowed_registers, loop_start=loop_start, skip=immediates)
+            except ValueError as e:
+                raise CompilationError(str(e))
 
         # Find all registers that are caller-save and used
-        used_caller_save = set(register_allocation.values()) & set([8, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28])
-        stack_size = len(used_caller_save) * 8
+        used_caller_save = set(register_allocation.values()) & set([8] + self.CALLEE_SAVED)
+
+        # Calls into the runtime can clobber the arguments, the link register
+        # and every register the callee doesn't have to preserve, so those get
+        # stack slots above the ones for the caller-save registers
+        call_saves = []
+        if any(isinstance(inst, (NewInstruction, CallHelperInstruction)) for inst in instructions):
+            clobbered = [0, 1, 2, 30] + sorted(set(register_allocation.values()) - set(self.CALLEE_SAVED))
+            call_saves = [(reg, (len(used_caller_save) + i) * 8) for i, reg in enumerate(clobbered)]
+
+        # Helpers store their result in the slot after those
+        frame_slots = len(used_caller_save) + len(call_saves)
+        if any(isinstance(inst, CallHelperInstruction) for inst in instructions):
+            frame_slots += 1
+
+        # The stack pointer has to stay 16 byte aligned
+        stack_size = (frame_slots * 8 + 15) & ~15
 
         # Save caller-save registers
+        asm.mark(('section', 'prologue'))
+        if used_caller_save:
+            asm.mark(('spill', sorted(used_caller_save)))
         if stack_size > 0:
             asm.sub_imm(31, 31, stack_size)
         for i, reg in enumerate(used_caller_save):
             asm.str(reg, 31, imm=i * 8)
 
-        # Compile the preamble first
-        for inst in trace_compiler.preamble:
-            self._compile_instruction(asm, inst, register_allocation, guard_exits)
-
-        # Create a RelocVar for the trace entry point
-        trace_entry = RelocVar()
+        # Compile the preamble first. The copies into the loop inputs all
+        # happen at once at the end of it.
+        asm.mark(('section', 'preamble'))
+        self._compile_block(asm, preamble, register_allocation, guard_exits, const_table, call_saves)
+        asm.mark(('section', 'loop inputs'))
+        for copy in copies:
+            asm.mark(('ir', copy))
+        self._emit_parallel_move(asm, [(copy.input, copy.value) for copy in copies], register_allocation, const_table)
+
+        # Create a label for the trace entry point
+        trace_entry = asm.new_label()
         asm.assign_label(trace_entry)
-        for inst in trace_compiler.body:
-            self._compile_instruction(asm, inst, register_allocation, guard_exits)
+        asm.mark(('section', 'body'))
+        self._compile_block(asm, body, register_allocation, guard_exits, const_table, call_saves)
 
         # Handle any movs needed for phi nodes
-        for input_inst in trace_compiler.body:
-            if not isinstance(input_inst, InputInstruction):
-                continue
-            rd = register_allocation[input_inst] # This is about to be live
-            rm = register_allocation[input_inst.phi] # This is assured to be live
-            # Do not emit a mov if we don't have to
-            if rd != rm:
-                asm.mov(rd, rm)
+        phi_moves = []
+        for input_inst in trace_compiler.preamble:
+            if isinstance(input_inst, InputInstruction) and input_inst.phi is not input_inst:
+                phi_moves.append((input_inst, input_inst.phi))
+        asm.mark(('section', 'back edge'))
+        self._emit_parallel_move(asm, phi_moves, register_allocation, const_table)
         asm.b(trace_entry)
 
-        # Create a RelocVar for the final cleanup
-        final_cleanup = RelocVar()
+        # Create a label for the final cleanup
+        final_cleanup = asm.new_label()
 
-        # Compile guard exits
+        # Compile guard exits, guards that were fused share the exit of the first one
+        asm.mark(('section', 'exit stubs'))
+        emitted_exits = set()
         for guard_inst in instructions:
-            if not isinstance(guard_inst, GuardInstruction):
+            if not isinstance(guard_inst, GuardInstruction) or guard_exits[guard_inst] in emitted_exits:
                 continue
 
             guard_id = guard_inst.guard_id
-            exit_label = guard_exits[guard_id]
+            emitted_exits.add(guard_exits[guard_inst])
+            asm.assign_label(guard_exits[guard_inst])
+            asm.mark(('exit', guard_inst))
 
-            asm.assign_label(exit_label)
-
-            # Store values in the return buffer
+            # Store values in the return buffer, the interpreter only knows about tagged values
             for i, value in enumerate(guard_inst.values_to_keep):
-                asm.str(register_allocation[value], 2, imm=i * 8) # x2 points to the return buffer
+                if value not in register_allocation:
+                    self._materialize_constant(asm, 16, value, const_table, tagged=True)
+                    asm.str(16, 2, imm=i * 8)
+                elif value.raw:
+                    asm.lsl(16, register_allocation[value], 1)
+                    asm.str(16, 2, imm=i * 8)
+                else:
+                    asm.str(register_allocation[value], 2, imm=i * 8) # x2 points to the return buffer
 
             # Set x0 to the guard_id
             asm.mov_imm(0, imm=guard_id)
@@ -172,8 +340,11 @@ class AppleSiliconBackend(Backend):
 
         # Final cleanup
         asm.assign_label(final_cleanup)
+        asm.mark(('section', 'epilogue'))
 
         # Restore caller-save registers
+        if used_caller_save:
+            asm.mark(('reload', sorted(used_caller_save)))
         for i, reg in enumerate(used_caller_save):
             asm.ldr(reg, 31, i * 8)
         if stack_size > 0:
@@ -181,87 +352,477 @@ class AppleSiliconBackend(Backend):
 
         asm.ret()
 
-        return asm.to_bytes()
+        try:
+            code = asm.to_bytes()
+        except ValueError as e:
+            raise CompilationError(str(e))
+        if listing is not None:
+            listing.record(trace_compiler, code, asm.marks, register_allocation, immediates)
+        return code
+
+    # The 64-bit pattern of a constant as a signed integer. Raw constants are
+    # the integer itself rather than the tagged value.
+    @staticmethod
+    def _constant_bits(inst: ConstantInstruction, const_table, tagged=False):
+        constant = const_table[inst.constant_index]
+        if inst.raw and not tagged:
+            return constant.to_int()
+        return constant.value
+
+    # Rough latencies of an in-order core like the Cortex-A55, for scheduling
+    LOAD_LATENCY = 4
+    MUL_LATENCY = 3
+    DIV_LATENCY = 12
+
+    # Cycles from when an instruction starts to when its result can be used.
+    # Instructions that don't produce any code take none.
+    def _latency(self, inst, immediates, const_table):
+        if inst in immediates or (isinstance(inst, InputInstruction) and inst.input_index is None):
+            return 0
+        if isinstance(inst, ConstantInstruction):
+            bits = self._constant_bits(inst, const_table)
+            return self.LOAD_LATENCY if AArch64Assembler.mov_const_length(bits) > 2 else 1
+        if isinstance(inst, GuardSuccess):
+            return 0
+        if isinstance(inst, (InputInstruction, GetFieldInstruction)):
+            return self.LOAD_LATENCY
+        if isinstance(inst, MulInstruction):
+            return self.MUL_LATENCY + (0 if inst.raw else 1)
+        if isinstance(inst, (DivInstruction, ModInstruction)):
+            return self.DIV_LATENCY + (0 if inst.raw else 2)
+        return 1
+
+    # Figures out which constants never need to be in a register. That's the
+    # case when every use is an arithmetic or compare operand small enough to
+    # be an immediate, or a move/store where we can build the value on the spot.
+    def _find_immediates(self, instructions, const_table):
+        def fits(value):
+            return isinstance(value, ConstantInstruction) and -4096 < self._constant_bits(value, const_table) < 4096
+
+        candidates = {inst for inst in instructions if isinstance(inst, ConstantInstruction)}
+        for inst in instructions:
+            allowed = set()
+            compared = set() # What a guard can compare against as an immediate
+            if isinstance(inst, GuardInstruction):
+                allowed.update(v for v in inst.values_to_keep if isinstance(v, ConstantInstruction))
+                if isinstance(inst, GuardCond) and fits(inst.right) != fits(inst.operand):
+                    compared.add(inst.right if fits(inst.right) else inst.operand)
+                allowed.update(compared)
+            elif isinstance(inst, (AddInstruction, BoolBinInstruction)):
+                if fits(inst.right) != fits(inst.left):
+                    allowed.add(inst.right if fits(inst.right) else inst.left)
+            elif isinstance(inst, SubInstruction):
+                if fits(inst.right) and not fits(inst.left):
+                    allowed.add(inst.right)
+            elif isinstance(inst, CopyInstruction):
+                allowed.add(inst.value)
+
+            for value in inst.get_live_values():
+                if value not in allowed:
+                    candidates.discard(value)
+            if isinstance(inst, GuardInstruction):
+                # The values compared are never immediates unless they fit,
+                # even if the same constant is also one of the exit values
+                for value in (inst.operand, getattr(inst, 'right', None)):
+                    if value not in compared:
+                        candidates.discard(value)
+        return candidates
+
+    def _materialize_constant(self, asm: AArch64Assembler, rd, inst: ConstantInstruction, const_table, tagged=False):
+        bits = self._constant_bits(inst, const_table, tagged)
+        if AArch64Assembler.mov_const_length(bits) <= 2:
+            asm.mov_const(rd, bits)
+        elif inst.raw and not tagged:
+            asm.ldr(rd, 1, inst.constant_index * 8) # x1 points to const array
+            asm.asr(rd, rd, 1)
+        else:
+            asm.ldr(rd, 1, inst.constant_index * 8)
+
+    # Moves values into the registers of other values as if all the moves
+    # happened at the same time
+    def _emit_parallel_move(self, asm: AArch64Assembler, moves, register_allocation, const_table):
+        register_moves = []
+        constant_moves = []
+        for dest, source in moves:
+            if source in register_allocation:
+                if register_allocation[dest] != register_allocation[source]:
+                    register_moves.append((register_allocation[dest], register_allocation[source]))
+            else:
+                constant_moves.append((register_allocation[dest], source))
+
+        while register_moves:
+            sources = [source for _, source in register_moves]
+            for move in register_moves:
+                if move[0] not in sources:
+                    asm.mov(move[0], move[1])
+                    register_moves.remove(move)
+                    break
+            else:
+                # Everything left is a cycle, so park one value in a scratch register
+                dest = register_moves[0][0]
+                asm.mov(16, dest)
+                register_moves = [(d, 16 if s == dest else s) for d, s in register_moves]
+
+        # Constants don't read any registers so they can go last
+        for dest, source in constant_moves:
+            self._materialize_constant(asm, dest, source, const_table)
+
+    # Sets the flags for comparing left to right. Returns True if the operands
+    # ended up swapped because the left one was an immediate.
+    def _emit_compare(self, asm: AArch64Assembler, left, right, register_allocation, const_table):
+        swapped = False
+        if left not in register_allocation:
+            left, right = right, left
+            swapped = True
+        rn = register_allocation[left]
+        if right in register_allocation:
+            asm.cmp(rn, register_allocation[right])
+        else:
+            bits = self._constant_bits(right, const_table)
+            if 0 <= bits < 4096:
+                asm.cmp_imm(rn, bits)
+            elif -4096 < bits < 0:
+                asm.cmn_imm(rn, -bits)
+            else:
+                self._materialize_constant(asm, 16, right, const_table)
+                asm.cmp(rn, 16)
+        return swapped
+
+    SWAPPED_CONDITIONS = {
+        AArch64Assembler.EQ: AArch64Assembler.EQ,
+        AArch64Assembler.NE: AArch64Assembler.NE,
+        AArch64Assembler.LT: AArch64Assembler.GT,
+        AArch64Assembler.GT: AArch64Assembler.LT,
+        AArch64Assembler.LE: AArch64Assembler.GE,
+        AArch64Assembler.GE: AArch64Assembler.LE,
+    }
+
+    # The condition under which each compare guard fails
+    GUARD_FAIL_CONDITIONS = {
+        GuardLT: AArch64Assembler.GE,
+        GuardLE: AArch64Assembler.GT,
+        GuardGT: AArch64Assembler.LE,
+        GuardGE: AArch64Assembler.LT,
+        GuardEQ: AArch64Assembler.NE,
+        GuardNE: AArch64Assembler.EQ,
+    }
+
+    # The condition under which each compare is true
+    COMPARE_CONDITIONS = {
+        LtInstruction: AArch64Assembler.LT,
+        LeInstruction: AArch64Assembler.LE,
+        GtInstruction: AArch64Assembler.GT,
+        GeInstruction: AArch64Assembler.GE,
+        EqInstruction: AArch64Assembler.EQ,
+        NeInstruction: AArch64Assembler.NE,
+    }
+
+    # Flags that make each condition false, for a ccmp whose own condition
+    # didn't hold because an earlier guard in the chain already failed
+    FAILING_NZCV = {
+        AArch64Assembler.EQ: 0b0000,
+        AArch64Assembler.NE: 0b0100,
+        AArch64Assembler.LT: 0b0000,
+        AArch64Assembler.GE: 0b1000,
+        AArch64Assembler.GT: 0b0100,
+        AArch64Assembler.LE: 0b0000,
+    }
+
+    # Compiles straight line code. Most instructions are handled one at a
+    # time but a few patterns spanning more than one get better code.
+    def _compile_block(self, asm: AArch64Assembler, instructions, register_allocation, guard_exits, const_table, call_saves=()):
+        i = 0
+        while i < len(instructions):
+            inst = instructions[i]
+            chain = self._guard_chain(instructions, i, register_allocation, const_table)
+            if len(chain) > 1:
+                for guard in chain:
+                    asm.mark(('ir', guard))
+                self._emit_guard_chain(asm, chain, register_allocation, guard_exits, const_table)
+                i += len(chain)
+                continue
+            following = instructions[i + 1] if i + 1 < len(instructions) else None
+            if isinstance(inst, BoolBinInstruction) and isinstance(following, (GuardTrue, GuardFalse)) and following.operand is inst:
+                # The guard branches on the flags the compare already set
+                asm.mark(('ir', inst))
+                asm.mark(('ir', following))
+                cond = self._emit_bool(asm, inst, register_allocation, const_table)
+                asm._b_cond(cond ^ 1 if isinstance(following, GuardTrue) else cond, guard_exits[following])
+                i += 2
+                continue
+            asm.mark(('ir', inst))
+            self._compile_instruction(asm, inst, register_allocation, guard_exits, const_table, call_saves)
+            i += 1
+
+    # Guards that are checked with a compare, as (left, right, condition
+    # under which the guard passes). right is a value or a plain integer, or
+    # None for testing the tag bit of an integer, which only the first guard
+    # in a chain can do.
+    def _guard_compare(self, inst):
+        if isinstance(inst, GuardInt):
+            return inst.operand, None, AArch64Assembler.EQ
+        if isinstance(inst, GuardCond):
+            return inst.operand, inst.right, self.GUARD_FAIL_CONDITIONS[type(inst)] ^ 1
+        if isinstance(inst, GuardNil):
+            return inst.operand, TraxObject.NIL_TAG, AArch64Assembler.EQ
+        if isinstance(inst, GuardTrue):
+            return inst.operand, TraxObject.FALSE_TAG, AArch64Assembler.NE
+        if isinstance(inst, GuardFalse):
+            return inst.operand, TraxObject.FALSE_TAG, AArch64Assembler.EQ
+        if isinstance(inst, GuardNonZero):
+            return inst.operand, 0, AArch64Assembler.NE
+        return None
+
+    # The register, the register or immediate to compare it with and the
+    # passing condition, with the operands swapped if only the left one is an
+    # immediate
+    def _compare_operands(self, compare, register_allocation, const_table):
+        left, right, cond = compare
+        if right is None:
+            return register_allocation[left], None, None, cond
+        if left not in register_allocation:
+            left, right, cond = right, left, self.SWAPPED_CONDITIONS[cond]
+        if isinstance(right, int):
+            return register_allocation[left], None, right, cond
+        if right in register_allocation:
+            return register_allocation[left], register_allocation[right], None, cond
+        return register_allocation[left], None, self._constant_bits(right, const_table), cond
+
+    # Guards right next to each other can be checked with one compare and a
+    # chain of ccmps, branching once at the end. They all exit through the
+    # first guard. That's fine if they'd all exit the same way, or if the
+    # first one goes back and redoes its instruction: nothing has happened
+    # in between so the interpreter just runs into the failing check itself.
+    def _guard_chain(self, instructions, start, register_allocation, const_table):
+        chain = []
+        for inst in instructions[start:]:
+            compare = self._guard_compare(inst) if isinstance(inst, GuardInstruction) else None
+            if compare is None:
+                break
+            if chain:
+                first = chain[0]
+                same_exit = inst.guard_id == first.guard_id and inst.values_to_keep == first.values_to_keep and inst.resume is first.resume
+                if not (first.redoes_instruction or same_exit):
+                    break
+                _, rm, imm, _ = self._compare_operands(compare, register_allocation, const_table)
+                if rm is None and (imm is None or not -32 < imm < 32):
+                    break
+            chain.append(inst)
+        return chain
+
+    def _emit_guard_chain(self, asm: AArch64Assembler, chain, register_allocation, guard_exits, const_table):
+        exit_label = guard_exits[chain[0]]
+        passing = None
+        for inst in chain:
+            rn, rm, imm, cond = self._compare_operands(self._guard_compare(inst), register_allocation, const_table)
+            if passing is None:
+                if rm is None and imm is None:
+                    asm.ands(31, rn, immr=0, imms=0)
+                elif rm is not None:
+                    asm.cmp(rn, rm)
+                elif imm >= 0:
+                    asm.cmp_imm(rn, imm)
+                else:
+                    asm.cmn_imm(rn, -imm)
+            elif rm is not None:
+                asm.ccmp(rn, rm, self.FAILING_NZCV[cond], passing)
+            elif imm >= 0:
+                asm.ccmp_imm(rn, imm, self.FAILING_NZCV[cond], passing)
+            else:
+                asm.ccmn_imm(rn, -imm, self.FAILING_NZCV[cond], passing)
+            passing = cond
+            guard_exits[inst] = exit_label
+        asm._b_cond(passing ^ 1, exit_label)
+
+    # Sets the register of a compare to true or false. Returns the condition
+    # the flags are left in when it's true.
+    def _emit_bool(self, asm: AArch64Assembler, inst, register_allocation, const_table):
+        swapped = self._emit_compare(asm, inst.left, inst.right, register_allocation, const_table)
+        cond = self.COMPARE_CONDITIONS[type(inst)]
+        if swapped:
+            cond = self.SWAPPED_CONDITIONS[cond]
+        if inst in register_allocation:
+            asm.mov_imm(17, imm=TraxObject.FALSE_TAG)
+            asm.mov_imm(16, imm=TraxObject.TRUE_TAG)
+            asm.csel(register_allocation[inst], 16, 17, cond=cond)
+        return cond
+
+    # rd = rn + imm for a signed immediate that fits in 12 bits
+    @staticmethod
+    def _add_signed_imm(asm: AArch64Assembler, rd, rn, imm):
+        if imm >= 0:
+            asm.add_imm(rd, rn, imm)
+        else:
+            asm.sub_imm(rd, rn, -imm)
 
     # TODO: Things would be a lot better if we used high-order pointer tagging instead
-    def _compile_instruction(self, asm: AArch64Assembler, inst, register_allocation, guard_exits):
+    def _compile_instruction(self, asm: AArch64Assembler, inst, register_allocation, guard_exits, const_table, call_saves=()):
         if isinstance(inst, GuardInstruction):
+            if isinstance(inst, GuardCond):
+                swapped = self._emit_compare(asm, inst.operand, inst.right, register_allocation, const_table)
+                cond = self.GUARD_FAIL_CONDITIONS[type(inst)]
+                if swapped:
+                    cond = self.SWAPPED_CONDITIONS[cond]
+                asm._b_cond(cond, guard_exits[inst])
+                return
+            if isinstance(inst, GuardSuccess):
+                return # The call checked its status already
             reg = register_allocation[inst.operand]
+            exit_label = guard_exits[inst]
             if isinstance(inst, GuardInt):
-                asm.ands(31, reg, immr=0, imms=0)
-                asm.bne(guard_exits[inst.guard_id])
+                asm.tbnz(reg, 0, exit_label)
             elif isinstance(inst, GuardNil):
-                asm.ands(17, reg, immr=0, imms=2)
-                asm.cmp_imm(17, TraxObject.NIL_TAG)
-                asm.bne(guard_exits[inst.guard_id])
+                asm.cmp_imm(reg, TraxObject.NIL_TAG)
+                asm.bne(exit_label)
+            elif isinstance(inst, (GuardTrue, GuardFalse)) and isinstance(inst.operand, BoolBinInstruction):
+                # Compares only ever give true or false, which differ in bit 2
+                if isinstance(inst, GuardTrue):
+                    asm.tbz(reg, 2, exit_label)
+                else:
+                    asm.tbnz(reg, 2, exit_label)
             elif isinstance(inst, GuardTrue):
-                asm.ands(17, reg, immr=0, imms=2)
-                asm.cmp_imm(17, TraxObject.TRUE_TAG)
-                asm.bne(guard_exits[inst.guard_id])
+                asm.cmp_imm(reg, TraxObject.FALSE_TAG)
+                asm.beq(exit_label)
+            elif isinstance(inst, GuardFalse):
+                asm.cmp_imm(reg, TraxObject.FALSE_TAG)
+                asm.bne(exit_label)
             elif isinstance(inst, GuardBool):
-                asm.ands(17, reg, immr=0, imms=1)
-                asm.cmp_imm(17, imm=0b11)
-                asm.bne(guard_exits[inst.guard_id])
+                # Both booleans have the two low bits set, nothing else does
+                asm.tbz(reg, 0, exit_label)
+                asm.tbz(reg, 1, exit_label)
+            elif isinstance(inst, GuardNonZero):
+                asm.cbz(reg, exit_label)
             elif isinstance(inst, GuardIndex):
-                asm.ands(16, reg, immr=60, imms=60)
-                asm.ldr(16, 16) # Load as early as possible
-                asm.ands(17, reg, immr=0, imms=2) # Follow up with parallel inst
-                asm.cmp_imm(17, TraxObject.OBJECT_TAG) # Do some compute while loading
-                asm.bne(guard_exits[inst.guard_id]) # Should be ~free
-                asm.cmp_imm(16, inst.type_index) # After load is  done one more cycle
-                asm.bne(guard_exits[inst.guard_id]) # Should be ~free
-            elif isinstance(inst, GuardLT):
-                reg2 = register_allocation[inst.right]
-                asm.cmp(reg, reg2)
-                asm.bge(guard_exits[inst.guard_id])
-            elif isinstance(inst, GuardLE):
-                reg2 = register_allocation[inst.right]
-                asm.cmp(reg, reg2)
-                asm.bgt(guard_exits[inst.guard_id])
-            elif isinstance(inst, GuardGT):
-                reg2 = register_allocation[inst.right]
-                asm.cmp(reg, reg2)
-                asm.ble(guard_exits[inst.guard_id])
-            elif isinstance(inst, GuardGE):
-                reg2 = register_allocation[inst.right]
-                asm.cmp(reg, reg2)
-                asm.blt(guard_exits[inst.guard_id])
-            elif isinstance(inst, GuardEQ):
-                reg2 = register_allocation[inst.right]
-                asm.cmp(reg, reg2)
-                asm.bne(guard_exits[inst.guard_id])
-            elif isinstance(inst, GuardNE):
-                reg2 = register_allocation[inst.right]
-                asm.cmp(reg, reg2)
-                asm.beq(guard_exits[inst.guard_id])
-            # Add more guard types as needed
+                # Only load the type once we know it's an object
+                asm.sub_imm(16, reg, TraxObject.OBJECT_TAG)
+                asm.ands(31, 16, immr=0, imms=2)
+                asm.bne(exit_label)
+                asm.ldr(17, 16)
+                asm.cmp_imm(17, inst.type_index)
+                asm.bne(exit_label)
+            else:
+                raise CompilationError(f"No implementation for {type(inst).__name__} in {type(self).__name__}")
         elif isinstance(inst, BinaryOpInstruction):
+            if isinstance(inst, BoolBinInstruction):
+                self._emit_bool(asm, inst, register_allocation, const_table)
+                return
             rd = register_allocation[inst]
-            rn = register_allocation[inst.left]
-            rm = register_allocation[inst.right]
+            left, right = inst.left, inst.right
+            if isinstance(inst, AddInstruction) and left not in register_allocation:
+                left, right = right, left
+            rn = register_allocation[left]
+            if right not in register_allocation:
+                # Only adds and subtracts take an immediate, see _find_immediates
+                imm = self._constant_bits(right, const_table)
+                if isinstance(inst, AddInstruction):
+                    self._add_signed_imm(asm, rd, rn, imm)
+                else:
+                    self._add_signed_imm(asm, rd, rn, -imm)
+                return
+            rm = register_allocation[right]
             if isinstance(inst, AddInstruction):
                 asm.add(rd, rn, rm)
             elif isinstance(inst, SubInstruction):
                 asm.sub(rd, rn, rm)
-            elif isinstance(inst, LtInstruction):
-                asm.mov_imm(17, imm=TraxObject.FALSE_TAG)
-                asm.mov_imm(16, imm=TraxObject.TRUE_TAG)
-                asm.cmp(rn, rm)
-                asm.csel(rd, 16, 17, cond=AArch64Assembler.LT)
-            # Add more binary operations as needed
+            elif isinstance(inst, MulInstruction):
+                if not inst.raw:
+                    # (2a >> 1) * 2b is the tagged product
+                    asm.asr(16, rn, 1)
+                    rn = 16
+                asm.mul(rd, rn, rm)
+            elif isinstance(inst, (DivInstruction, ModInstruction)):
+                quotient = rd if isinstance(inst, DivInstruction) else 16
+                if inst.raw:
+                    asm.sdiv(quotient, rn, rm)
+                else:
+                    asm.asr(16, rn, 1)
+                    asm.asr(17, rm, 1)
+                    asm.sdiv(16, 16, 17)
+                    if isinstance(inst, DivInstruction):
+                        asm.lsl(rd, 16, 1)
+                if isinstance(inst, ModInstruction):
+                    # 2a - q * 2b is the tagged remainder so this works either way
+                    asm.msub(rd, 16, rm, rn)
+            else:
+                raise CompilationError(f"No implementation for {type(inst).__name__} in {type(self).__name__}")
+        elif isinstance(inst, ShiftLeftInstruction):
+            asm.lsl(register_allocation[inst], register_allocation[inst.operand], inst.shift)
+        elif isinstance(inst, UntagInstruction):
+            asm.asr(register_allocation[inst], register_allocation[inst.operand], 1)
+        elif isinstance(inst, TagInstruction):
+            asm.lsl(register_allocation[inst], register_allocation[inst.operand], 1)
+        elif isinstance(inst, NormalizeInstruction):
+            asm.sbfx(register_allocation[inst], register_allocation[inst.operand], 0, 63)
         elif isinstance(inst, ConstantInstruction):
-            rd = register_allocation[inst]
-            asm.ldr(rd, 1, inst.constant_index * 8) # x1 points to const array
+            if inst in register_allocation:
+                self._materialize_constant(asm, register_allocation[inst], inst, const_table)
         elif isinstance(inst, InputInstruction):
-            rd = register_allocation[inst]
-            asm.ldr(rd, 0, inst.input_index * 8) # x0 points to inputs array
-            pass
+            # Inputs without an index are loop variables the preamble sets up
+            if inst.input_index is not None:
+                asm.ldr(register_allocation[inst], 0, inst.input_index * 8) # x0 points to inputs array
         elif isinstance(inst, CopyInstruction):
-            rd = register_allocation[inst.input]
-            rm = register_allocation[inst.value]
-            if rd != rm:
-                asm.mov(rd, rm)
-            pass
+            self._emit_parallel_move(asm, [(inst.input, inst.value)], register_allocation, const_table)
+        elif isinstance(inst, (GetFieldInstruction, SetFieldInstruction)):
+            if isinstance(inst, GetFieldInstruction) and inst not in register_allocation:
+                return
+            rt = register_allocation[inst if isinstance(inst, GetFieldInstruction) else inst.value]
+            reg = register_allocation[inst.obj]
+            # Fields start one word past the header, taking the tag off the
+            # pointer is folded into the offset when it fits
+            offset = (inst.field_index + 1) * 8 - TraxObject.OBJECT_TAG
+            if offset < 256:
+                (asm.ldur if isinstance(inst, GetFieldInstruction) else asm.stur)(rt, reg, offset)
+            elif offset + TraxObject.OBJECT_TAG < 32768:
+                asm.sub_imm(16, reg, TraxObject.OBJECT_TAG)
+                (asm.ldr if isinstance(inst, GetFieldInstruction) else asm.str)(rt, 16, offset + TraxObject.OBJECT_TAG)
+            else:
+                raise CompilationError(f"Field {inst.field_index} is out of range")
+        elif isinstance(inst, NewInstruction):
+            # The runtime allocates the object, with every field set to 0
+            asm.mark(('spill', [reg for reg, _ in call_saves]))
+            for reg, offset in call_saves:
+                asm.str(reg, 31, imm=offset)
+            asm.mov_const(0, inst.type_index)
+            asm.mov_const(1, inst.num_fields)
+            asm.mov_const(16, int(ffi.cast("uintptr_t", self.allocate_object)))
+            asm.blr(16)
+            rd = register_allocation.get(inst)
+            if rd is not None:
+                asm.mov(rd, 0)
+            asm.mark(('reload', [reg for reg, _ in call_saves if reg != rd]))
+            for reg, offset in call_saves:
+                if reg != rd:
+                    asm.ldr(reg, 31, offset)
+        elif isinstance(inst, CallHelperInstruction):
+            if inst not in guard_exits:
+                raise CompilationError(f"Call to {inst.helper.name} doesn't check its status")
+            if len(inst.args) != inst.helper.num_args:
+                raise CompilationError(f"{inst.helper.name} takes {inst.helper.num_args} arguments, not {len(inst.args)}")
+            asm.mark(('spill', [reg for reg, _ in call_saves]))
+            for reg, offset in call_saves:
+                asm.str(reg, 31, imm=offset)
+            # Filling x0-x6 can overwrite other arguments, but every register
+            # that could be is saved, so those are read back from the stack
+            saved = dict(call_saves)
+            for i, arg in enumerate(inst.args):
+                if arg not in register_allocation:
+                    self._materialize_constant(asm, i, arg, const_table, tagged=True)
+                elif register_allocation[arg] in saved:
+                    asm.ldr(i, 31, saved[register_allocation[arg]])
+                else:
+                    asm.mov(i, register_allocation[arg])
+            result_offset = call_saves[-1][1] + 8
+            asm.add_imm(len(inst.args), 31, result_offset)
+            asm.mov_const(16, inst.helper.address)
+            asm.blr(16)
+            asm.mov(17, 0)
+            rd = register_allocation.get(inst)
+            asm.mark(('reload', [reg for reg, _ in call_saves if reg != rd]))
+            for reg, offset in call_saves:
+                if reg != rd:
+                    asm.ldr(reg, 31, offset)
+            asm.cbnz(17, guard_exits[inst])
+            if rd is not None:
+                asm.ldr(rd, 31, result_offset)
         else:
-            raise NotImplemented(f"No implementation for {type(inst)} in {type(self)}")
-        # Add more instruction types as needed
+            raise CompilationError(f"No implementation for {type(inst).__name__} in {type(self).__name__}")
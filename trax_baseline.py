@@ -0,0 +1,154 @@
+from trax_obj import TraxObject, INT_OPERATIONS, type_index_of
+
+# A baseline tier that turns a method's bytecode into a Python function.
+# Stack slots become locals s0, s1, ... since the stack height at every
+# instruction is known ahead of time. Python has no goto, so the basic blocks
+# sit in one `while True` loop and a jump just picks the next block to run.
+# Builtins are called directly and fields are read and written in place.
+#
+# Loop headers still count towards tracing. Once a loop is hot the function
+# raises LeaveBaseline with its stack, and the interpreter picks up at the
+# loop header where it can record a trace or enter a compiled one. For a
+# method called from baseline code the interpreter finishes just that call.
+
+class LeaveBaseline(Exception):
+    def __init__(self, pc: int, stack: list[TraxObject]):
+        self.pc = pc
+        self.stack = stack
+
+class BaselineCompiler:
+    def __init__(self, interpreter):
+        self.interpreter = interpreter
+        self.functions = {} # MethodKey -> function, or None if it can't be compiled
+
+    # The function for a method, generating it the first time
+    def function(self, method_key):
+        if method_key not in self.functions:
+            source = self.generate_source(method_key)
+            function = None
+            if source is not None:
+                namespace = self.namespace()
+                namespace['loops'] = self.interpreter.loops(method_key)
+                exec(compile(source, f"<baseline {method_key}>", "exec"), namespace)
+                function = namespace['method']
+            self.functions[method_key] = function
+        return self.functions[method_key]
+
+    def namespace(self):
+        namespace = {
+            'TraxObject': TraxObject,
+            'LeaveBaseline': LeaveBaseline,
+            'type_index_of': type_index_of,
+            'vtables': self.interpreter.vtables,
+            'call_method': self.call_method,
+            'count_loop': self.interpreter.count_baseline_loop,
+        }
+        namespace.update(INT_OPERATIONS)
+        for i, constant in enumerate(self.interpreter.constants):
+            namespace[f'k{i}'] = constant
+        return namespace
+
+    # Calls a method that isn't a builtin, the receiver comes first. Methods
+    # without baseline code run in the interpreter.
+    def call_method(self, function_key, *args):
+        interpreter = self.interpreter
+        if function_key not in interpreter.method_map:
+            raise ValueError(f"Method {function_key[1]} not found for type {function_key[0]}")
+        function = self.function(function_key)
+        if function is None:
+            return interpreter.run_frame(function_key, 0, list(args))
+        # The frame counts against the stack size like an interpreted one,
+        # its arguments are already counted in the caller's frame
+        frame_size = interpreter.decode(function_key).frame_size - len(args)
+        if len(interpreter.stack) + interpreter.baseline_height + frame_size > interpreter.stack_size:
+            raise ValueError(f"Stack overflow calling {function_key[1]}")
+        interpreter.baseline_height += frame_size
+        try:
+            return function(*args)
+        except LeaveBaseline as leave:
+            pc, stack = leave.pc, leave.stack
+        finally:
+            interpreter.baseline_height -= frame_size
+        return interpreter.run_frame(function_key, pc, stack)
+
+    def generate_source(self, method_key):
+        bytecode = self.interpreter.method_map[method_key]
+        code = list(bytecode)
+        # Every method ends by returning nil, which says how many arguments it takes
+        if not code or code[-1][0] != 'return':
+            return None
+        num_args = code[-1][1][0]
+        heights = bytecode.stack_heights(num_args)
+        if heights is None:
+            return None
+
+        leaders = {0}
+        for pc, (opcode, operands) in enumerate(code):
+            if opcode in ('jmp', 'jmp_if_not'):
+                leaders.add(pc + 1 + operands[0])
+            if opcode in ('jmp', 'jmp_if_not', 'return'):
+                leaders.add(pc + 1)
+
+        slots = lambda low, high: ', '.join(f's{i}' for i in range(low, high))
+        lines = [f"def method({slots(0, num_args)}):", "    b = 0", "    while True:"]
+        keyword = 'if'
+        for start in sorted(pc for pc in leaders if pc < len(code) and heights[pc] is not None):
+            lines.append(f"        {keyword} b == {start}:")
+            keyword = 'elif'
+            body = []
+            pc = start
+            while True:
+                opcode, operands = code[pc]
+                h = heights[pc]
+                if opcode == 'push_const':
+                    body.append(f"s{h} = k{operands[0]}")
+                elif opcode == 'dup':
+                    body.append(f"s{h} = s{h - 1 - operands[0]}")
+                elif opcode == 'set':
+                    body.append(f"s{h - 2 - operands[0]} = s{h - 1}")
+                elif opcode == 'call':
+                    selector, n = operands
+                    args = slots(h - n - 1, h)
+                    # The top of the stack picks the method, like Interpreter.execute_call
+                    body.append(f"f, _, key = vtables[type_index_of(s{h - 1}.value)][{selector}]")
+                    body.append(f"s{h - n - 1} = f([{args}]) if f is not None else call_method(key, {args})")
+                elif opcode in INT_OPERATIONS and self.interpreter.uses_int_operation(operands[0]):
+                    # The same as Interpreter.execute_int_operation
+                    body.append(f"l, r = s{h - 2}.value, s{h - 1}.value")
+                    body.append("if (l | r) & 1:")
+                    body.append(f"    f, _, key = vtables[type_index_of(r)][{operands[0]}]")
+                    body.append(f"    s{h - 2} = f([s{h - 2}, s{h - 1}]) if f is not None else call_method(key, s{h - 2}, s{h - 1})")
+                    body.append("else:")
+                    body.append(f"    s{h - 2} = TraxObject({opcode}(l, r))")
+                elif opcode in INT_OPERATIONS:
+                    body.append(f"f, _, key = vtables[type_index_of(s{h - 1}.value)][{operands[0]}]")
+                    body.append(f"s{h - 2} = f([s{h - 2}, s{h - 1}]) if f is not None else call_method(key, s{h - 2}, s{h - 1})")
+                elif opcode == 'get_field':
+                    body.append(f"s{h - 1} = s{h - 1}.get_field({operands[0]})")
+                elif opcode == 'set_field':
+                    body.append(f"s{h - 2}.set_field({operands[0]}, s{h - 1})")
+                elif opcode == 'new':
+                    type_index, n = operands
+                    body.append(f"s{h - n} = TraxObject.new({type_index}, [{slots(h - n, h)}])")
+                elif opcode == 'return':
+                    body.append(f"return s{h - 1}")
+                elif opcode == 'loop_header':
+                    body.append(f"if count_loop(loops, {operands[0]}):")
+                    body.append(f"    raise LeaveBaseline({pc}, [{slots(0, h)}])")
+                elif opcode == 'jmp':
+                    body.append(f"b = {pc + 1 + operands[0]}")
+                elif opcode == 'jmp_if_not':
+                    body.append(f"b = {pc + 1 + operands[0]} if s{h - 1}.is_false() else {pc + 1}")
+                elif opcode != 'pop':
+                    return None
+                if opcode in ('jmp', 'jmp_if_not', 'return'):
+                    break
+                pc += 1
+                if pc == len(code):
+                    body.append("raise ValueError('Function ended without returning')")
+                    break
+                if pc in leaders:
+                    body.append(f"b = {pc}")
+                    break
+            lines.extend(f"            {line}" for line in body)
+        return '\n'.join(lines) + '\n'
@@ -1,14 +1,173 @@
+import struct
 from trax_ast import *
 from trax_obj import TraxObject
 
+# The operands of each opcode, in the order the interpreter's handlers take
+# them. An opcode's number in packed bytecode is its position here.
+OPCODES = {
+    'push_const': ('const_index',),
+    'dup': ('k',),
+    'pop': (),
+    'set': ('k',),
+    'call': ('selector', 'num_args'),
+    'jmp': ('offset', 'loop_back'),
+    'jmp_if_not': ('offset',),
+    'get_field': ('field_index',),
+    'set_field': ('field_index',),
+    'new': ('type_index', 'num_fields'),
+    'return': ('num_args',),
+    # Starts each loop, numbered from 0 in each method
+    'loop_header': ('loop_id',),
+    # Int operators, the selector is for when the operands aren't both Ints
+    # and it becomes an ordinary call with one argument
+    'add_int': ('selector',),
+    'sub_int': ('selector',),
+    'mul_int': ('selector',),
+    'div_int': ('selector',),
+    'mod_int': ('selector',),
+    'lt_int': ('selector',),
+    'gt_int': ('selector',),
+}
+OPCODE_NAMES = list(OPCODES)
+OPCODE_NUMBERS = {name: i for i, name in enumerate(OPCODE_NAMES)}
+
+# Method names that compile to an Int operator opcode when called with one
+# argument, unless the program defines them for Int itself
+INT_OPERATORS = {'+': 'add_int', '-': 'sub_int', '*': 'mul_int', '/': 'div_int', '%': 'mod_int', '<': 'lt_int', '>': 'gt_int'}
+
+# How each opcode changes the number of values on the stack
+def stack_effect(opcode, operands):
+    if opcode in ('push_const', 'dup'):
+        return 1
+    if opcode in ('pop', 'set', 'jmp_if_not') or opcode in INT_OPERATORS.values():
+        return -1
+    if opcode == 'call':
+        return -operands[1]
+    if opcode == 'set_field':
+        return -2
+    if opcode == 'new':
+        return 1 - operands[1]
+    return 0
+
+# A method's code packed into 8 bytes per instruction: the opcode, a padding
+# byte, the second operand as 16 bits and the first as a signed 32 bit
+# number. Calls name their method by selector, an index into the table of
+# method names that all the methods of a program share. Jump offsets count
+# instructions.
+#
+# A method's frame starts out holding its receiver and arguments, num_args
+# values in all, and max_stack is the most values it ever holds. That comes
+# from the stack heights, which should be the same on every path to an
+# instruction, see max_stack_depth for when they aren't.
+class Bytecode:
+    INSTRUCTION = struct.Struct('<BxHi')
+
+    def __init__(self, code: bytes, names: list[str], num_args: int | None = None):
+        self.code = code
+        self.names = names
+        self.num_args = num_args
+        self.max_stack = self.max_stack_depth(num_args) if num_args is not None else None
+
+    @staticmethod
+    def encode(instructions: list[dict], names: list[str], num_args: int | None = None) -> "Bytecode":
+        code = bytearray()
+        for instruction in instructions:
+            opcode = instruction['opcode']
+            if opcode not in OPCODES:
+                raise ValueError(f"Unknown opcode: {opcode}")
+            operands = [instruction[name] for name in OPCODES[opcode]]
+            first, second = (operands + [0, 0])[:2]
+            try:
+                code += Bytecode.INSTRUCTION.pack(OPCODE_NUMBERS[opcode], int(second), first)
+            except struct.error:
+                raise ValueError(f"Operands of {opcode} out of range: {operands}")
+        return Bytecode(bytes(code), names, num_args)
+
+    def __len__(self):
+        return len(self.code) // self.INSTRUCTION.size
+
+    # The opcode and operands of every instruction in order
+    def __iter__(self):
+        for number, second, first in self.INSTRUCTION.iter_unpack(self.code):
+            yield self._operands(number, first, second)
+
+    def _operands(self, number, first, second):
+        opcode = OPCODE_NAMES[number]
+        operands = (first, second)[:len(OPCODES[opcode])]
+        if opcode == 'jmp':
+            operands = (first, bool(second))
+        return opcode, operands
+
+    def fetch(self, pc: int):
+        number, second, first = self.INSTRUCTION.unpack_from(self.code, pc * self.INSTRUCTION.size)
+        return self._operands(number, first, second)
+
+    # The instruction at pc in the dict form MethodBuilder builds from
+    def __getitem__(self, pc: int) -> dict:
+        if not 0 <= pc < len(self):
+            raise IndexError(pc)
+        opcode, operands = self.fetch(pc)
+        return {'opcode': opcode, **dict(zip(OPCODES[opcode], operands))}
+
+    # The number of values on the stack before each instruction, None for
+    # instructions that can't be reached, or None for all of it if they
+    # aren't the same on every path
+    def stack_heights(self, entry_height: int) -> list[int | None] | None:
+        code = list(self)
+        heights = [None] * len(code)
+        work = [(0, entry_height)]
+        while work:
+            pc, height = work.pop()
+            if pc >= len(code):
+                continue
+            if heights[pc] is not None:
+                if heights[pc] != height:
+                    return None
+                continue
+            heights[pc] = height
+            opcode, operands = code[pc]
+            after = height + stack_effect(opcode, operands)
+            if after < 0:
+                return None
+            if opcode in ('jmp', 'jmp_if_not'):
+                work.append((pc + 1 + operands[0], after))
+            if opcode not in ('jmp', 'return'):
+                work.append((pc + 1, after))
+        return heights
+
+    def max_stack_depth(self, entry_height: int) -> int:
+        heights = self.stack_heights(entry_height)
+        if heights is None:
+            # A path that doesn't go around a loop can't hold more than every
+            # instruction that pushes adds up to
+            return entry_height + sum(max(stack_effect(opcode, operands), 0) for opcode, operands in self)
+        return max([entry_height] + [height + max(stack_effect(opcode, operands), 0)
+                                     for (opcode, operands), height in zip(self, heights) if height is not None])
+
+    def disassemble(self) -> list[str]:
+        lines = []
+        for pc, (opcode, operands) in enumerate(self):
+            if OPCODES[opcode][:1] == ('selector',):
+                operands = (self.names[operands[0]],) + operands[1:]
+            text = ' '.join(repr(v) if isinstance(v, str) else str(v) for v in operands)
+            if opcode in ('jmp', 'jmp_if_not'):
+                text += f"  ; -> {pc + 1 + operands[0]}"
+            lines.append(f"{pc:4}  {opcode} {text}".rstrip())
+        return lines
+
 class BB:
     def __init__(self, index):
         self.index = index
 
 class MethodBuilder:
-    def __init__(self, typename, method_name):
+    def __init__(self, typename, method_name, names=None, num_args=None):
         self.typename = typename
         self.method_name = method_name
+        self.num_args = num_args # Counting the receiver, see Bytecode
+        self.num_loops = 0
+        # The method name table the built code shares with other methods
+        self.names = names if names is not None else []
+        self.selectors = {name: i for i, name in enumerate(self.names)}
         self.blocks = []
         self.new_block()
         self.current_block = self.blocks[0]
@@ -43,8 +202,22 @@ class MethodBuilder:
     def set(self, k):
         self.add_instruction('set', k=k)
 
+    # The id of a method name in the name table, adding it if it's new
+    def selector(self, method_name):
+        if method_name not in self.selectors:
+            self.selectors[method_name] = len(self.names)
+            self.names.append(method_name)
+        return self.selectors[method_name]
+
     def call(self, method_name, num_args):
-        self.add_instruction('call', method_name=method_name, num_args=num_args)
+        self.add_instruction('call', selector=self.selector(method_name), num_args=num_args)
+
+    def int_operator(self, method_name):
+        self.add_instruction(INT_OPERATORS[method_name], selector=self.selector(method_name))
+
+    def loop_header(self):
+        self.add_instruction('loop_header', loop_id=self.num_loops)
+        self.num_loops += 1
 
     def jmp(self, bb, loop_back=False):
         self.add_instruction('jmp', target=bb.index, loop_back=loop_back)
@@ -72,20 +245,17 @@ class MethodBuilder:
             block_offsets[i] = offset
             offset += len(block['instructions'])
 
-        # Second pass: build instructions and resolve jumps
+        # Second pass: resolve jumps and pack the instructions
         instructions = []
         for i, block in enumerate(self.blocks):
             for instruction in block['instructions']:
-                instruction = dict(**instruction)
                 if instruction['opcode'] in ('jmp', 'jmp_if_not'):
-                    target_block = instruction['target']
-                    target_offset = block_offsets[target_block]
+                    target_offset = block_offsets[instruction['target']]
                     current_offset = len(instructions)
-                    instruction['offset'] = target_offset - current_offset - 1
-                    del instruction['target']
+                    instruction = {**instruction, 'offset': target_offset - current_offset - 1}
                 instructions.append(instruction)
 
-        return instructions
+        return Bytecode.encode(instructions, self.names, self.num_args)
 
 class Compiler:
     def __init__(self, ast):
@@ -93,6 +263,7 @@ class Compiler:
         self.types = {}
         self.constants = [TraxObject(TraxObject.NIL_TAG)]
         self.method_map = {}
+        self.names = [] # Method names defined or called anywhere in the program, indexed by selector
         self.add_builtin_type('Int')
         self.add_builtin_type('Bool')
         self.add_builtin_type('NilType')
@@ -134,7 +305,9 @@ class Compiler:
     def compile_methods(self):
         for type_name, type_info in self.types.items():
             for method_name, (args, body) in type_info['methods'].items():
-                mb = MethodBuilder(type_name, method_name)
+                mb = MethodBuilder(type_name, method_name, self.names, len(args) + 1)
+                # Methods get a selector even if nothing calls them
+                mb.selector(method_name)
 
                 # Map arguments to stack indices
                 stack_map = {'self': len(args)}
@@ -203,6 +376,7 @@ class Compiler:
             end_bb = mb.new_block()
             mb.jmp(start_bb)
             mb.switch_block(start_bb)
+            mb.loop_header()
             self.compile_expr(stmt.condition, mb, stack_map)
             mb.jmp_if_not(end_bb)
             self.compile_block(stmt.body, mb, stack_map, arg_count)
@@ -235,7 +409,10 @@ class Compiler:
             self.compile_expr(expr.obj, mb, stack_map, stack_depth)
             for arg in expr.args:
                 self.compile_expr(arg, mb, stack_map, stack_depth + 1)
-            mb.call(expr.method, len(expr.args))
+            if expr.method in INT_OPERATORS and len(expr.args) == 1 and expr.method not in self.types['Int']['methods']:
+                mb.int_operator(expr.method)
+            else:
+                mb.call(expr.method, len(expr.args))
         elif isinstance(expr, Constant):
             mb.push_const(len(self.constants))
             self.constants.append(expr.value)
@@ -1,60 +1,170 @@
-from trax_obj import TraxObject
-from trax_tracing import InputInstruction, TraceCompiler, ValueInstruction
-from typing import Tuple, Any, Callable
-from trax_backend import AppleSiliconBackend
-
+from trax_obj import TraxObject, INT_OPERATIONS, type_index_of, is_false_value
+from trax_tracing import InputInstruction, TraceCompiler, ValueInstruction, GuardInstruction, VirtualObject
+from typing import Tuple, Callable
+from trax_bc_compile import Bytecode
+from trax_baseline import BaselineCompiler, LeaveBaseline
+from trax_backend import Backend, CompilationError, NativeHelper, TraceEntry
+from trax_aarch64_disasm import TraceListing
+
+# All frames share one value stack. A frame's values start at its base,
+# which is where the receiver of the call went, and the top of the stack is
+# the end of the list. A call saves the caller's method, the pc to return to
+# and the caller's base here.
 class StackFrame:
-    def __init__(self, method_key: "MethodKey", pc: int, stack: list[TraxObject]):
-        self.method_key  = method_key
-        self.pc= pc
-        self.stack  = stack
-
+    def __init__(self, method_key: "MethodKey", pc: int, base: int):
+        self.method_key = method_key
+        self.pc = pc
+        self.base = base
+
+# Where to pick up after a guard fails. The trace stack covers the values of
+# every frame since the one the trace started in, and base says where the
+# frame of method_key starts in it.
 class GuardFrame:
-    def __init__(self, method_key, pc, trace_stack):
+    def __init__(self, method_key, pc, trace_stack, base=0):
         self.method_key: MethodKey = method_key
         self.pc: int = pc
         self.trace_stack: list[ValueInstruction] = trace_stack
+        self.base: int = base
 
 class GuardHandler:
-    def __init__(self, frame: GuardFrame, guard_frames: list[GuardFrame], values_to_keep: list[ValueInstruction]):
+    # guard_frames are the calls made since the trace started, with bases
+    # counted from the start of its frame
+    def __init__(self, frame: GuardFrame, guard_frames: list[StackFrame], values_to_keep: list[ValueInstruction]):
         self.frame = frame
         self.guard_frames = guard_frames
         self.values_to_keep = values_to_keep
+        # Filled in once the trace is optimized, see GuardInstruction.resume
+        self.resume = None
+        self.num_exit_values = len(values_to_keep)
+        # The (MethodLoops, loop id) of a trace for exits through its loop
+        # header, see MethodLoops.suspended
+        self.loop = None
+
+# What the interpreter keeps about the loops of a method, indexed by the
+# loop ids of their loop_header instructions
+class MethodLoops:
+    def __init__(self, method_key: "MethodKey", headers: list[int]):
+        self.method_key = method_key
+        self.headers = headers # The pc of each loop_header
+        self.counts = [0] * len(headers) # How many times each loop has started an iteration
+        self.traces: list[TraceEntry | None] = [None] * len(headers)
+        self.blacklisted = [False] * len(headers) # Loops the backend couldn't compile
+        # Loops whose trace exited through the loop header. Those exits are
+        # near the end of the loop or for checks that keep failing, so the
+        # interpreter runs the rest of the loop until it's started again.
+        self.suspended = [False] * len(headers)
+
+    def key(self, loop_id: int) -> "ProgramKey":
+        return (self.method_key, self.headers[loop_id])
+
+# A method's bytecode ready to run, see Interpreter.decode
+class DecodedMethod:
+    def __init__(self, instructions: list[tuple[Callable, tuple]], recording: list[tuple[Callable, tuple]], loops: MethodLoops, frame_size: int):
+        self.instructions = instructions
+        self.recording = recording # The same with the handlers that record a trace
+        self.loops = loops
+        self.frame_size = frame_size # See Bytecode.max_stack
+
+# Method tables for each type index, indexed by selector, see
+# Compiler.names. An entry is (builtin or None, trace function or None,
+# MethodKey) and says what a call with that selector runs on that type.
+# Selectors a type has no method for still get an entry, its MethodKey just
+# isn't in the method map.
+class VTables(dict):
+    def __init__(self, names: list[str]):
+        super().__init__()
+        # Our own copy, every interpreter adds selectors for its builtins
+        self.names = list(names)
+        self.selectors = {name: i for i, name in enumerate(names)}
+
+    def __missing__(self, type_index):
+        vtable = [(None, None, (type_index, name)) for name in self.names]
+        self[type_index] = vtable
+        return vtable
+
+    # The selector of a method name, adding it if it's new
+    def selector(self, name: str) -> int:
+        selector = self.selectors.get(name)
+        if selector is None:
+            selector = self.selectors[name] = len(self.names)
+            self.names.append(name)
+            for type_index, vtable in self.items():
+                vtable.append((None, None, (type_index, name)))
+        return selector
+
+    def define(self, type_index: int, name: str, builtin: Callable | None = None, trace_func: Callable | None = None):
+        self[type_index][self.selector(name)] = (builtin, trace_func, (type_index, name))
+
+# The inline cache of one call instruction, shared by its execute_ and
+# record_ handlers. Once the call has run its instruction gets rewritten to
+# a form that checks the receiver's type against what the cache has seen
+# and calls what that type resolved to without looking it up again.
+class CallSite:
+    MAX_TYPES = 4 # Past this many receiver types the call goes back to plain lookups
+
+    def __init__(self, selector: int, num_args: int, quickens: bool = True):
+        self.selector = selector
+        self.num_args = num_args
+        self.quickens = quickens # Int operator opcodes keep their instruction
+        # Receiver type index -> its VTables entry
+        self.targets: dict[int, tuple] = {}
+        self.megamorphic = False
+
+# How the Int operator opcodes are recorded
+TRACE_OPERATIONS = {
+    'add_int': TraceCompiler.add,
+    'sub_int': TraceCompiler.sub,
+    'mul_int': TraceCompiler.mul,
+    'div_int': TraceCompiler.div,
+    'mod_int': TraceCompiler.mod,
+    'lt_int': TraceCompiler.lt,
+    'gt_int': TraceCompiler.gt,
+}
 
 MethodKey = Tuple[int, str]
 ProgramKey = Tuple[MethodKey, int]
 
 class Interpreter:
     constants: list[TraxObject]
-    method_map: dict[MethodKey, list[dict]]
+    method_map: dict[MethodKey, Bytecode]
     stack: list[TraxObject]
+    frame_base: int
     method_key: MethodKey
     pc: int
-    code: list[dict]
+    code: list[tuple[Callable, tuple]]
+    decoded_methods: dict[MethodKey, DecodedMethod]
     call_stack: list[StackFrame]
     builtin_methods: dict[MethodKey, Callable]
     builtin_trace_methods: dict[MethodKey, Callable]
+    vtables: VTables
 
-    jump_counts: dict[ProgramKey, int]
+    method_loops: dict[MethodKey, MethodLoops]
     trace_compiler: TraceCompiler
     trace_stack: list[ValueInstruction]
-    compiled_traces: dict[ProgramKey, Any]
+    compiled_traces: dict[ProgramKey, TraceEntry]
+    blacklisted_loops: set[ProgramKey]
     guard_handlers: list[GuardHandler]
-    trace_call_stack: list[GuardFrame]
-    backend: AppleSiliconBackend
+    trace_call_stack: list[StackFrame]
+    backend: Backend
 
-    def __init__(self, constants, method_map, trace_threshold=1):
+    def __init__(self, constants, method_map, trace_threshold=1, unroll_factor=1, split_reductions=False, backend=None, baseline=False, stack_size=1 << 16):
         # Mappings from the bytecode compiler
         self.constants = constants
         self.method_map = method_map
 
-        # The current frame's stack
+        # The value stack of every frame, and where the current one starts
         self.stack = []
+        self.frame_base = 0
+        # Calls that could take the stack past this many values fail, using
+        # the frame sizes the bytecode compiler worked out
+        self.stack_size = stack_size
+        self.frame_size = 0
 
         # Current method and pc
         self.method_key = (-1, "<bad method>")
         self.pc = -1
         self.code = []
+        self.decoded_methods = {}
 
         # Frames we need to jump back to on return
         self.call_stack = []
@@ -63,138 +173,277 @@ class Interpreter:
         self.builtin_methods = {}
         self.builtin_trace_methods = {}
 
+        # Calls are resolved through these, the methods of a program all
+        # share one name table
+        self.vtables = VTables(next((bytecode.names for bytecode in method_map.values()), []))
+        for type_index, method_name in method_map:
+            self.vtables.define(type_index, method_name)
+
         # Tracing stuff
-        self.jump_counts = {} # Counts how many times we've jumped to a trace
+        self.method_loops = {} # Hotness counters and traces of each method's loops, they outlive decoded code
         self.trace_compiler = TraceCompiler() # The current trace compiler
         self.trace_active = None # The entry point for the current trace
+        self.trace_loop = None # The same as (MethodLoops, loop id)
         self.trace_threshold = trace_threshold # How many jumps to a location we need to start tracing
+        self.unroll_factor = unroll_factor # How many iterations compiled loops do per trip, see TraceCompiler.unroll
+        self.split_reductions = split_reductions # Whether unrolled reductions get reassociated
         self.trace_stack = [] # This is a simulated stack of ValueInstructions
-        self.compiled_traces = {} # Once a trace is complete we compile it and add it here
+        self.trace_base = 0 # Where the frame the trace started in begins on the stack
+        self.compiled_traces = {} # Every trace we've compiled, the interpreter finds them through MethodLoops
+        self.blacklisted_loops = set() # Loops the backend couldn't compile, we don't trace these again
         self.guard_handlers = [] # A mapping of guard_ids to guard handlers
-        self.trace_call_stack = [] # A simulated call stack that helps us emit guard handlers
+        self.trace_call_stack = [] # Calls made since the trace started, bases count from trace_base
+
+        # Methods can run as generated Python until their loops get hot
+        self.baseline = BaselineCompiler(self) if baseline else None
+        self.baseline_height = 0 # See check_stack
 
         # Backend for trace compilation
-        self.backend = AppleSiliconBackend()
+        self.backend = backend if backend is not None else Backend.default()
         self.const_table = self.backend.const_table(self.constants)
 
     def new_guard_handler(self, pc=None):
+        # By default resume by redoing the instruction we're in the middle of
         if pc is None:
-            pc = self.pc
+            pc = self.pc - 1
         values_to_keep = self.compute_trace_exit_values()
-        frame = GuardFrame(self.method_key, pc, list(self.trace_stack))
+        frame = GuardFrame(self.method_key, pc, list(self.trace_stack), self.frame_base - self.trace_base)
         handler = GuardHandler(frame, list(self.trace_call_stack), values_to_keep)
         guard_id = len(self.guard_handlers)
         self.guard_handlers.append(handler)
         return guard_id, values_to_keep
 
-    def add_builtin_method(self, type_index, method_name, func, trace_func):
+    # Builtins are traced with trace_func, or by calling a native
+    # implementation from the trace if they only have that
+    def add_builtin_method(self, type_index, method_name, func, trace_func=None, native: NativeHelper = None):
+        if trace_func is None:
+            if native is None:
+                raise ValueError(f"Builtin {method_name} needs a trace_func or a native implementation")
+            trace_func = lambda interpreter, args: interpreter.emit_helper_call(native, args)
         self.builtin_methods[(type_index, method_name)] = func
         self.builtin_trace_methods[(type_index, method_name)] = trace_func
+        self.vtables.define(type_index, method_name, func, trace_func)
+        # Code generated before now may use the runtime's own Int operators
+        self.decoded_methods.clear()
+        if self.baseline is not None:
+            self.baseline.functions.clear()
+
+    # Whether an Int operator opcode runs the runtime's own operator, rather
+    # than a builtin or method the program has for Int
+    def uses_int_operation(self, selector: int) -> bool:
+        builtin, _, function_key = self.vtables[0][selector]
+        return builtin is None and function_key not in self.method_map
+
+    # The loops of a method, made the first time the method is decoded
+    def loops(self, method_key: MethodKey) -> MethodLoops:
+        loops = self.method_loops.get(method_key)
+        if loops is None:
+            code = list(self.method_map[method_key])
+            headers = [0] * sum(opcode == 'loop_header' for opcode, _ in code)
+            for pc, (opcode, operands) in enumerate(code):
+                if opcode == 'loop_header':
+                    headers[operands[0]] = pc
+            loops = self.method_loops[method_key] = MethodLoops(method_key, headers)
+        return loops
+
+    # Turns a method's bytecode into (handler, operands) pairs the first time
+    # it runs so dispatch is a list lookup and a call. Jump offsets become
+    # absolute pcs and loop headers get the method's MethodLoops.
+    def decode(self, method_key: MethodKey) -> DecodedMethod:
+        decoded = self.decoded_methods.get(method_key)
+        if decoded is not None:
+            return decoded
+        instructions = []
+        recording = []
+        loops = self.loops(method_key)
+        for pc, (opcode, operands) in enumerate(self.method_map[method_key]):
+            if opcode in INT_OPERATIONS:
+                site = CallSite(operands[0], 1)
+                if self.uses_int_operation(site.selector):
+                    site.quickens = False
+                    instructions.append((self.execute_int_operation, (site, INT_OPERATIONS[opcode])))
+                    recording.append((self.record_int_operation, (site, opcode)))
+                else:
+                    instructions.append((self.execute_call, (site,)))
+                    recording.append((self.record_call, (site,)))
+                continue
+            handler = getattr(self, f"execute_{opcode}", None)
+            if handler is None:
+                instructions.append((self.execute_unknown, (opcode,)))
+                recording.append((self.execute_unknown, (opcode,)))
+                continue
+            if opcode == 'call':
+                operands = (CallSite(*operands),)
+            if opcode == 'loop_header':
+                operands = (loops,) + operands
+            if opcode in ('jmp', 'jmp_if_not'):
+                target_pc = pc + 1 + operands[0]
+                if opcode == 'jmp' and not operands[1] and target_pc in loops.headers:
+                    handler = self.execute_enter_loop
+                    operands = (target_pc, loops, loops.headers.index(target_pc))
+                else:
+                    operands = (target_pc,)
+            instructions.append((handler, operands))
+            recording.append((getattr(self, f"record_{opcode}", handler), operands))
+        # Running off the end is an error
+        instructions.append((self.execute_end, ()))
+        recording.append((self.execute_end, ()))
+        bytecode = self.method_map[method_key]
+        frame_size = bytecode.max_stack
+        if frame_size is None:
+            # Bytecode built without num_args still has it in its returns
+            frame_size = bytecode.max_stack_depth(max((operands[0] for opcode, operands in bytecode if opcode == 'return'), default=0))
+        decoded = DecodedMethod(instructions, recording, loops, frame_size)
+        self.decoded_methods[method_key] = decoded
+        return decoded
+
+    # Makes the given method the one being executed, with the handlers that
+    # record what they do while there's a trace being recorded
+    def switch_to(self, method_key: MethodKey):
+        self.method_key = method_key
+        decoded = self.decode(method_key)
+        self.code = decoded.recording if self.trace_active is not None else decoded.instructions
+        self.frame_size = decoded.frame_size
 
     def run(self, obj: TraxObject, initial_function: str, *args):
         type_index = obj.get_type_index()
-        self.method_key = (type_index, initial_function)
-        self.code = self.method_map.get(self.method_key, [])
-        for inst in self.code:
-            print(inst)
-        if not self.code:
+        method_key = (type_index, initial_function)
+        if not self.method_map.get(method_key):
             raise ValueError(f"Function {initial_function} not found for type index {type_index}")
+        for line in self.method_map[method_key].disassemble():
+            print(line)
+        self.switch_to(method_key)
         self.pc = 0
 
         # Push arguments onto the stack
+        self.frame_base = len(self.stack)
         self.stack.append(obj)
         self.stack.extend(args)
 
+        function = self.baseline.function(method_key) if self.baseline is not None and self.trace_active is None else None
+        if function is not None and function.__code__.co_argcount == len(args) + 1:
+            # Only the arguments of the frame are on the stack
+            self.baseline_height = self.frame_size - len(args) - 1
+            try:
+                return function(obj, *args)
+            except LeaveBaseline as leave:
+                # A loop got hot, carry on from its header in the interpreter
+                self.pc = leave.pc
+                self.stack[len(self.stack) - len(args) - 1:] = leave.stack
+            finally:
+                self.baseline_height = 0
+
+        return self.dispatch()
+
+    # Runs instructions until the frame at the bottom of call_stack returns
+    def dispatch(self):
         while True:
-            if self.pc >= len(self.code):
-                raise ValueError("Function ended without returning")
-
-            # TODO: check if we can jump into a trace
-            program_key = (self.method_key, self.pc)
-            if program_key in self.compiled_traces:
-                print("Entering trace: ", program_key)
-                func = self.compiled_traces[program_key]
-                max_values_to_keep = max(len(h.values_to_keep) for h in self.guard_handlers)
-                guard_id, return_values = self.backend.call_function(func, self.stack, self.const_table, max_values_to_keep)
-                print(f"Exiting trace: {guard_id=}")
-                guard_handler = self.guard_handlers[guard_id]
-                value_mapping: dict[ValueInstruction, TraxObject] = {}
-                for value, obj in zip(guard_handler.values_to_keep, return_values, strict=False):
-                    value_mapping[value] = obj
-
-                # Restore program location
-                self.pc = guard_handler.frame.pc
-                self.method_key = guard_handler.frame.method_key
-                self.code = self.method_map[self.method_key]
-                print("Now at: ", self.method_key, self.pc, self.code[self.pc])
-
-                # Restore the stack
-                self.stack = []
-                for value in guard_handler.frame.trace_stack:
-                    self.stack.append(value_mapping[value])
-
-                # Restore the call_stack
-                self.call_stack = []
-                for frame in guard_handler.guard_frames:
-                    stack = []
-                    for value in frame.trace_stack:
-                        stack.append(value_mapping[value])
-                    self.call_stack.append(StackFrame(frame.method_key, frame.pc, stack))
-
-            instruction = self.code[self.pc]
-            opcode = instruction['opcode']
+            handler, operands = self.code[self.pc]
             self.pc += 1
-
-            method = getattr(self, f"execute_{opcode}", None)
-            if method:
-                result = method(instruction)
-                if result is not None:
-                    return result
-            else:
-                raise ValueError(f"Unknown opcode: {opcode}")
-
-    def execute_push_const(self, instruction):
-        const_index = instruction['const_index']
+            result = handler(*operands)
+            if result is not None:
+                return result
+
+    # Runs a method for baseline code that can't run it itself, from pc
+    # with the given frame, and returns its result. The baseline frames
+    # calling it aren't on call_stack, so it gets one of its own.
+    def run_frame(self, method_key: MethodKey, pc: int, frame: list[TraxObject]):
+        saved = (self.method_key, self.pc, self.frame_base, self.call_stack)
+        height = len(self.stack)
+        self.call_stack = []
+        self.frame_base = height
+        self.stack.extend(frame)
+        self.switch_to(method_key)
+        self.pc = pc
+        try:
+            self.check_stack(method_key)
+            return self.dispatch()
+        finally:
+            del self.stack[height:]
+            method_key, self.pc, self.frame_base, self.call_stack = saved
+            self.switch_to(method_key)
+
+    # Runs a compiled trace and picks up where it left off
+    def enter_trace(self, trace_entry: TraceEntry):
+        print("Entering trace: ", (self.method_key, self.pc - 1))
+        base = self.frame_base
+        guard_id = trace_entry.enter(self.stack[base:])
+        print(f"Exiting trace: {guard_id=}")
+        guard_handler = self.guard_handlers[guard_id]
+        if guard_handler.loop is not None:
+            loops, loop_id = guard_handler.loop
+            loops.suspended[loop_id] = True
+        return_values = trace_entry.exit_values(guard_handler.num_exit_values)
+        value_mapping: dict[ValueInstruction, TraxObject] = {}
+        exit_values = self.materialize_exit_values(guard_handler, return_values)
+        for value, obj in zip(guard_handler.values_to_keep, exit_values, strict=False):
+            value_mapping[value] = obj
+
+        # Restore program location
+        self.pc = guard_handler.frame.pc
+        self.switch_to(guard_handler.frame.method_key)
+        print("Now at: ", self.method_key, self.pc, self.method_map[self.method_key][self.pc])
+
+        # The trace only had the frame it was entered from and the frames
+        # of calls it went into, their values go straight onto the stack
+        del self.stack[base:]
+        self.stack.extend(value_mapping[value] for value in guard_handler.frame.trace_stack)
+        for frame in guard_handler.guard_frames:
+            self.call_stack.append(StackFrame(frame.method_key, frame.pc, base + frame.base))
+        self.frame_base = base + guard_handler.frame.base
+
+    def execute_unknown(self, opcode):
+        raise ValueError(f"Unknown opcode: {opcode}")
+
+    def execute_end(self):
+        raise ValueError("Function ended without returning")
+
+    # Each opcode has an execute_ handler that only does the work and, if
+    # recording a trace needs more, a record_ handler used while a trace is
+    # being recorded. It mirrors the work onto trace_stack as instructions.
+
+    def execute_push_const(self, const_index):
+        self.stack.append(self.constants[const_index])
+
+    def record_push_const(self, const_index):
         value = self.constants[const_index]
+        self.trace_stack.append(self.trace_compiler.constant(const_index, value.get_type_index()))
         self.stack.append(value)
-        if self.trace_active is not None:
-            v = self.trace_compiler.constant(const_index, value.get_type_index())
-            self.trace_stack.append(v)
 
-    def execute_dup(self, instruction):
-        k = instruction['k']
-        value = self.stack[-k-1]
-        self.stack.append(value)
-        if self.trace_active is not None:
-            self.trace_stack.append(self.trace_stack[-k-1])
+    def execute_dup(self, k):
+        self.stack.append(self.stack[-k-1])
+
+    def record_dup(self, k):
+        self.trace_stack.append(self.trace_stack[-k-1])
+        self.stack.append(self.stack[-k-1])
 
-    def execute_pop(self, instruction):
+    def execute_pop(self):
         self.stack.pop()
-        if self.trace_active is not None:
-            self.trace_stack.pop()
 
-    def execute_set(self, instruction):
-        k = instruction['k']
+    def record_pop(self):
+        self.trace_stack.pop()
+        self.stack.pop()
+
+    def execute_set(self, k):
         value = self.stack.pop()
         self.stack[-k-1] = value
-        if self.trace_active is not None:
-            v = self.trace_stack.pop()
-            self.trace_stack[-k-1] = v
+
+    def record_set(self, k):
+        v = self.trace_stack.pop()
+        self.trace_stack[-k-1] = v
+        self.execute_set(k)
 
     def compute_trace_exit_values(self):
-        values_to_restore = list(self.trace_stack)
-        for guard_frame in self.trace_call_stack:
-            values_to_restore.extend(guard_frame.trace_stack)
-        return values_to_restore
+        return list(self.trace_stack)
 
     def emit_guard_index(self, value: ValueInstruction, type_index: int):
         guard_id, values_to_keep = self.new_guard_handler()
         if type_index == 0:
             self.trace_compiler.guard_int(guard_id, value, values_to_keep)
         elif type_index == 1:
-            self.trace_compiler.guard_nil(guard_id, value, values_to_keep)
-        elif type_index == 2:
             self.trace_compiler.guard_bool(guard_id, value, values_to_keep)
+        elif type_index == 2:
+            self.trace_compiler.guard_nil(guard_id, value, values_to_keep)
         else:
             self.trace_compiler.guard_index(guard_id, value, type_index, values_to_keep)
         return guard_id
@@ -203,147 +452,343 @@ class Interpreter:
         guard_id, values_to_keep = self.new_guard_handler(pc=pc)
         self.trace_compiler.guard_true(guard_id, value, values_to_keep)
 
-    def execute_call(self, instruction):
+    def emit_guard_false(self, value: ValueInstruction, pc=None):
+        guard_id, values_to_keep = self.new_guard_handler(pc=pc)
+        self.trace_compiler.guard_false(guard_id, value, values_to_keep)
+
+    # If the helper fails the interpreter redoes the call the slow way
+    def emit_helper_call(self, helper: NativeHelper, args: list[ValueInstruction]):
+        call = self.trace_compiler.call_helper(helper, args)
+        guard_id, values_to_keep = self.new_guard_handler()
+        self.trace_compiler.guard_success(guard_id, call, values_to_keep)
+        return call
+
+    # Finds what a call resolves to for a receiver type and remembers it in
+    # the call site's cache
+    def resolve_call(self, site: CallSite, type_index: int):
+        target = site.targets.get(type_index)
+        if target is not None:
+            return target
+        target = self.vtables[type_index][site.selector]
+        # Calls that fail aren't worth caching
+        if site.megamorphic or not site.quickens or (target[0] is None and target[2] not in self.method_map):
+            return target
+        if len(site.targets) == CallSite.MAX_TYPES:
+            site.megamorphic = True
+            site.targets.clear()
+        else:
+            site.targets[type_index] = target
+        self.quicken_call(site)
+        return target
+
+    # Rewrites the call instruction being executed to match its cache
+    def quicken_call(self, site: CallSite):
+        if site.megamorphic:
+            instruction = (self.execute_call, (site,))
+        elif len(site.targets) == 1:
+            [(type_index, (builtin, _, function_key))] = site.targets.items()
+            if builtin is not None:
+                instruction = (self.execute_call_builtin, (site, type_index, builtin))
+            else:
+                instruction = (self.execute_call_method, (site, type_index, function_key))
+        else:
+            instruction = (self.execute_call_polymorphic, (site, site.targets))
+        self.decoded_methods[self.method_key].instructions[self.pc - 1] = instruction
+
+    def execute_call(self, site: CallSite):
+        # Peek at the top of the stack
+        builtin, _, function_key = self.resolve_call(site, type_index_of(self.stack[-1].value))
+
+        # We need to handle builtins a bit differently from other things
+        if builtin is not None:
+            self.stack.append(builtin(self.stack))
+            return
+
+        self.call_method(function_key, site.num_args)
+
+    # A call that has only seen one type of receiver and resolved to a builtin
+    def execute_call_builtin(self, site: CallSite, type_index: int, builtin: Callable):
+        if type_index_of(self.stack[-1].value) != type_index:
+            return self.execute_call(site)
+        self.stack.append(builtin(self.stack))
+
+    # A call that has only seen one type of receiver and resolved to a user method
+    def execute_call_method(self, site: CallSite, type_index: int, function_key: MethodKey):
+        if type_index_of(self.stack[-1].value) != type_index:
+            return self.execute_call(site)
+        self.call_method(function_key, site.num_args)
+
+    def execute_call_polymorphic(self, site: CallSite, targets: dict):
+        target = targets.get(type_index_of(self.stack[-1].value))
+        if target is None:
+            return self.execute_call(site)
+        builtin, _, function_key = target
+        if builtin is not None:
+            self.stack.append(builtin(self.stack))
+            return
+        self.call_method(function_key, site.num_args)
+
+    def record_call(self, site: CallSite):
         # NOTE: If we enter a function already in the call stack
         #       we should cancel the trace
         # NOTE: If the trace gets too long we should cancel the trace
-        method_name = instruction['method_name']
-        obj = self.stack[-1]  # Peek at the top of the stack
-        type_index = obj.get_type_index()
-        function_key = (type_index, method_name)
+        num_args = site.num_args
+        type_index = type_index_of(self.stack[-1].value)  # Peek at the top of the stack
+        builtin, trace_func, function_key = self.resolve_call(site, type_index)
 
-        # Add a guard for this method
-        if self.trace_active is not None:
-            # NOTE: it would be great if we decided between this check
-            #       and inline caching in the future. inline caching is
-            #       great for more dynamic code
-            # TODO: The guard needs the values it has to save passed to it
-            trace_obj = self.trace_stack[-1]
-            self.emit_guard_index(trace_obj, type_index)
+        # Guard on the receiver type the call site's cache dispatched on,
+        # if it fails the trace exits to redo the call in the interpreter
+        trace_obj = self.trace_stack[-1]
+        self.emit_guard_index(trace_obj, type_index)
 
-        # We need to handle builtins a bit differently from other things
-        if function_key in self.builtin_methods:
+        if builtin is not None:
             # Call the built-in method
-            result = self.builtin_methods[function_key](self.stack)
+            result = builtin(self.stack)
             self.stack.append(result)
-            if self.trace_active is not None:
-                trace_compiler = self.trace_compiler
-                trace_func = self.builtin_trace_methods[function_key]
-                v = trace_func(self, self.trace_stack[-instruction['num_args']-1:])
-                del self.trace_stack[-instruction['num_args']-1:]
-                self.trace_stack.append(v)
+            v = trace_func(self, self.trace_stack[-num_args-1:])
+            del self.trace_stack[-num_args-1:]
+            self.trace_stack.append(v)
             return
 
-        # In the more standard case of this just being a user defined method
-        # we just have to add a stack frame and then update code, pc, and method
         if function_key in self.method_map:
-            frame = StackFrame(function_key, self.pc, self.stack)
-            self.call_stack.append(frame)
-            self.method_key = function_key
-            self.code = self.method_map[function_key]
-            self.pc = 0
-            if self.trace_active is not None:
-                frame = GuardFrame(function_key, self.pc, self.trace_stack)
-                self.trace_call_stack.append(frame)
-
-        raise ValueError(f"Method {method_name} not found for type {type_index}")
-
-    def execute_jmp(self, instruction):
-        offset = instruction['offset']
-        target_pc = self.pc + offset
-        # We only want to tag this as a loop back if there's something looping back here
-        function_key = ()
-        if instruction['loop_back']:
-            self.increment_jump_count((self.method_key, target_pc))
+            self.trace_call_stack.append(StackFrame(self.method_key, self.pc, self.frame_base - self.trace_base))
+        self.call_method(function_key, num_args)
+
+    # In the more standard case of this just being a user defined method we
+    # save where we are and the callee's frame starts at its receiver, which
+    # is already on the stack along with its arguments
+    def call_method(self, function_key: MethodKey, num_args: int):
+        if function_key not in self.method_map:
+            raise ValueError(f"Method {function_key[1]} not found for type {function_key[0]}")
+        self.call_stack.append(StackFrame(self.method_key, self.pc, self.frame_base))
+        self.frame_base = len(self.stack) - num_args - 1
+        self.switch_to(function_key)
+        self.pc = 0
+        self.check_stack(function_key)
+
+    # Baseline frames being run hold baseline_height values that aren't on
+    # the stack, the frames the interpreter runs for them go on top
+    def check_stack(self, function_key: MethodKey):
+        if self.frame_base + self.frame_size + self.baseline_height > self.stack_size:
+            raise ValueError(f"Stack overflow calling {function_key[1]}")
+
+    # Both operands of an Int operator are Ints in the common case, anything
+    # else is an ordinary call
+    def execute_int_operation(self, site: CallSite, operation: Callable):
+        right = self.stack[-1].value
+        left = self.stack[-2].value
+        if (left | right) & 1:
+            return self.execute_call(site)
+        self.stack.pop()
+        self.stack[-1] = TraxObject(operation(left, right))
+
+    def record_int_operation(self, site: CallSite, opcode: str):
+        if (self.stack[-1].value | self.stack[-2].value) & 1:
+            return self.record_call(site)
+        left, right = self.trace_stack[-2:]
+        self.emit_guard_index(left, 0)
+        self.emit_guard_index(right, 0)
+        result = TRACE_OPERATIONS[opcode](self.trace_compiler, left, right)
+        del self.trace_stack[-2:]
+        self.trace_stack.append(result)
+        self.execute_int_operation(site, INT_OPERATIONS[opcode])
+
+    def execute_jmp(self, target_pc):
         self.pc = target_pc
 
-    def execute_jmp_if_not(self, instruction):
-        condition = self.stack.pop()
-        offset = instruction['offset']
-        target_pc = self.pc + offset
-        if self.trace_active is not None:
-            self.emit_guard_true(self.trace_stack.pop(), pc=target_pc)
-        if condition.is_false():
+    # The jump into a loop from the code before it starts the loop over
+    def execute_enter_loop(self, target_pc, loops: MethodLoops, loop_id: int):
+        loops.suspended[loop_id] = False
+        self.pc = target_pc
+
+    # Traces only ever start at the top of a loop. Loops with a trace run it,
+    # otherwise they count towards recording one.
+    def execute_loop_header(self, loops: MethodLoops, loop_id: int):
+        trace_entry = loops.traces[loop_id]
+        if trace_entry is not None:
+            if loops.suspended[loop_id]:
+                return
+            return self.enter_trace(trace_entry)
+        if loops.blacklisted[loop_id]:
+            return
+        loops.counts[loop_id] += 1
+        if loops.counts[loop_id] > self.trace_threshold:
+            self.start_recording(loops, loop_id)
+
+    # Inner loops are recorded into the trace of the loop around them, the
+    # trace is done once it gets back to its own header in its own frame
+    def record_loop_header(self, loops: MethodLoops, loop_id: int):
+        if self.trace_loop == (loops, loop_id) and not self.trace_call_stack:
+            self.finish_recording()
+
+    def execute_jmp_if_not(self, target_pc):
+        if is_false_value(self.stack.pop().value):
             self.pc = target_pc
 
-    def execute_get_field(self, instruction):
-        field_index = instruction['field_index']
+    def record_jmp_if_not(self, target_pc):
+        # The trace follows the way the branch went this time, if it goes
+        # the other way we pick up on the path that wasn't recorded
+        if self.stack[-1].is_false():
+            self.emit_guard_false(self.trace_stack.pop(), pc=self.pc)
+        else:
+            self.emit_guard_true(self.trace_stack.pop(), pc=target_pc)
+        self.execute_jmp_if_not(target_pc)
+
+    def execute_get_field(self, field_index):
         obj = self.stack.pop()
-        value = obj.get_field(field_index)
-        self.stack.append(value)
-        if self.trace_active is not None:
-            obj = self.trace_stack.pop()
-            v = self.trace_compiler.get_field(obj, field_index)
-            self.trace_stack.append(v)
+        self.stack.append(obj.get_field(field_index))
+
+    def record_get_field(self, field_index):
+        obj = self.trace_stack.pop()
+        self.trace_stack.append(self.trace_compiler.get_field(obj, field_index))
+        self.execute_get_field(field_index)
 
-    def execute_set_field(self, instruction):
-        field_index = instruction['field_index']
+    def execute_set_field(self, field_index):
         value = self.stack.pop()
         obj = self.stack.pop()
         obj.set_field(field_index, value)
-        if self.trace_active is not None:
-            value = self.trace_stack.pop()
-            obj = self.trace_stack.pop()
-            self.trace_compiler.set_field(obj, field_index, value)
-
-    def execute_new(self, instruction):
-        type_index = instruction['type_index']
-        num_fields = instruction['num_fields']
+
+    def record_set_field(self, field_index):
+        value = self.trace_stack.pop()
+        obj = self.trace_stack.pop()
+        self.trace_compiler.set_field(obj, field_index, value)
+        self.execute_set_field(field_index)
+
+    def execute_new(self, type_index, num_fields):
         fields = [self.stack.pop() for _ in range(num_fields)]
-        obj = TraxObject.new(type_index, reversed(fields))
+        obj = TraxObject.new(type_index, list(reversed(fields)))
         self.stack.append(obj)
-        if self.trace_active is not None:
-            args = [self.trace_stack.pop() for _ in range(num_fields)]
-            v = self.trace_compiler.new(type_index, num_fields)
-            for field_index, field_value in enumerate(reversed(args)):
-                self.trace_compiler.set_field(v, field_index, field_value)
-            self.trace_stack.append(v)
 
-    def execute_return(self, instruction):
+    def record_new(self, type_index, num_fields):
+        args = [self.trace_stack.pop() for _ in range(num_fields)]
+        v = self.trace_compiler.new(type_index, num_fields)
+        for field_index, field_value in enumerate(reversed(args)):
+            self.trace_compiler.set_field(v, field_index, field_value)
+        self.trace_stack.append(v)
+        self.execute_new(type_index, num_fields)
+
+    def execute_return(self, num_args):
         v = self.stack.pop()
+        del self.stack[self.frame_base:]
         if not self.call_stack:
             return v
+        self.stack.append(v)
         frame = self.call_stack.pop()
-        self.method_key = frame.method_key
+        self.switch_to(frame.method_key)
         self.pc = frame.pc
-        self.stack = frame.stack
-        self.code = self.method_map[frame.method_key]
-        if self.trace_active is not None:
-            guard_frame = self.trace_call_stack.pop()
-            assert guard_frame.method_key == frame.method_key
-            assert guard_frame.pc == frame.pc
-            self.trace_stack = guard_frame.trace_stack
+        self.frame_base = frame.base
+
+    def record_return(self, num_args):
+        if not self.trace_call_stack:
+            # Leaving the method the trace started in, it didn't get back
+            # around the loop so there's nothing to compile
+            self.stop_recording()
+            return self.execute_return(num_args)
+        v = self.trace_stack.pop()
+        del self.trace_stack[self.frame_base - self.trace_base:]
+        self.trace_stack.append(v)
+        self.trace_call_stack.pop()
+        return self.execute_return(num_args)
 
     def get_stack(self):
         return self.stack
 
-    def increment_jump_count(self, key: ProgramKey):
-        if key in self.compiled_traces:
-            return
-        self.jump_counts[key] = self.jump_counts.get(key, 0) + 1
-        if self.jump_counts[key] > self.trace_threshold and self.trace_active is None:
-            # Set all tracing state to start tracing
-            self.trace_active = key
-            self.trace_compiler = TraceCompiler()
-            trace_stack: list[InputInstruction] = [self.trace_compiler.input(i) for i in range(len(self.stack))]
-            self.trace_stack = list(trace_stack)
-            self.trace_inputs = trace_stack
-            self.trace_call_stack = []
-        elif self.trace_active == key:
-            # We have to close the loop on the inputs
-            for input, value in zip(self.trace_inputs, self.trace_stack, strict=True):
-                input.phi = value
-            self.trace_compiler.optimize(self.constants)
-            print(self.trace_compiler.pretty_print())
-            print("\n")
-            compiled_trace = self.backend.compile_trace(self.trace_compiler, self.constants)
-            print(compiled_trace.hex(), flush=True)
-            compiled_trace = self.backend.create_executable_memory(compiled_trace)
-            self.trace_compiler = TraceCompiler()
-            self.compiled_traces[key] = compiled_trace
-            self.trace_active = None
-            self.trace_stack = []
-            self.trace_call_stack = []
+    # Turns what a trace exit wrote to the return buffer back into the values
+    # the guard handler expects, allocating any objects the trace kept virtual
+    def materialize_exit_values(self, guard_handler: GuardHandler, return_values: list[TraxObject]):
+        if guard_handler.resume is None:
+            return return_values
+        allocated = {}
+
+        def materialize(entry):
+            if entry is None:
+                return TraxObject(0)
+            if not isinstance(entry, VirtualObject):
+                return return_values[entry]
+            if entry not in allocated:
+                # Allocate before filling in fields so cycles work out
+                obj = TraxObject.new(entry.type_index, [TraxObject(0)] * len(entry.fields))
+                allocated[entry] = obj
+                for field_index, field in enumerate(entry.fields):
+                    if field is not None:
+                        obj.set_field(field_index, materialize(field))
+            return allocated[entry]
+
+        return [materialize(entry) for entry in guard_handler.resume]
+
+    def update_guard_handlers(self, trace_compiler: TraceCompiler):
+        for instruction in trace_compiler.preamble + trace_compiler.body:
+            if isinstance(instruction, GuardInstruction):
+                guard_handler = self.guard_handlers[instruction.guard_id]
+                guard_handler.resume = instruction.resume
+                guard_handler.num_exit_values = len(instruction.values_to_keep)
+
+    # Counts a trip around a loop in baseline code. Returns whether the
+    # interpreter should take over, because there's a trace to enter or it's
+    # time to record one.
+    def count_baseline_loop(self, loops: MethodLoops, loop_id: int) -> bool:
+        if loops.blacklisted[loop_id]:
+            return False
+        if loops.traces[loop_id] is not None:
+            # Baseline code only runs loops from the start
+            loops.suspended[loop_id] = False
+            return True
+        loops.counts[loop_id] += 1
+        return loops.counts[loop_id] > self.trace_threshold
+
+    def start_recording(self, loops: MethodLoops, loop_id: int):
+        # Set all tracing state to start tracing
+        key = loops.key(loop_id)
+        self.trace_active = key
+        self.trace_loop = (loops, loop_id)
+        self.trace_compiler = TraceCompiler(self.unroll_factor, self.split_reductions)
+        # The trace takes the values of the frame it starts in
+        self.trace_base = self.frame_base
+        trace_stack: list[InputInstruction] = [self.trace_compiler.input(i) for i in range(len(self.stack) - self.frame_base)]
+        self.trace_stack = list(trace_stack)
+        self.trace_inputs = trace_stack
+        self.trace_call_stack = []
+        # The optimizer can send guards back to the top of the loop
+        self.trace_compiler.loop_header_guard_id, _ = self.new_guard_handler(pc=key[1])
+        self.guard_handlers[self.trace_compiler.loop_header_guard_id].loop = self.trace_loop
+        self.switch_to(self.method_key)
+
+    def finish_recording(self):
+        key = self.trace_active
+        loops, loop_id = self.trace_loop
+        # We have to close the loop on the inputs
+        for input, value in zip(self.trace_inputs, self.trace_stack, strict=True):
+            input.phi = value
+        self.trace_compiler.optimize(self.constants)
+        self.update_guard_handlers(self.trace_compiler)
+        # Constant folding may have added new constants
+        self.const_table = self.backend.const_table(self.constants)
+        print(self.trace_compiler.pretty_print())
+        print("\n")
+        listing = TraceListing()
+        try:
+            compiled_trace = self.backend.compile_trace(self.trace_compiler, self.constants, listing)
+        except CompilationError as e:
+            print(f"Not compiling trace {key}: {e}", flush=True)
+            loops.blacklisted[loop_id] = True
+            self.blacklisted_loops.add(key)
+        else:
+            print(listing, flush=True)
+            func_ptr = self.backend.create_executable_memory(compiled_trace)
+            guards = [inst for inst in self.trace_compiler.preamble + self.trace_compiler.body if isinstance(inst, GuardInstruction)]
+            num_exit_values = max((len(guard.values_to_keep) for guard in guards), default=0)
+            trace_entry = self.backend.prepare_trace(func_ptr, len(self.trace_inputs), num_exit_values, self.const_table)
+            loops.traces[loop_id] = trace_entry
+            self.compiled_traces[key] = trace_entry
+        self.stop_recording()
+
+    def stop_recording(self):
+        self.trace_compiler = TraceCompiler()
+        self.trace_active = None
+        self.trace_loop = None
+        self.trace_stack = []
+        self.trace_call_stack = []
+        self.switch_to(self.method_key)
 
     def compile_trace(self, trace):
         bytes = self.backend.compile_trace(trace, self.constants)
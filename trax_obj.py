@@ -5,67 +5,126 @@ ffi.cdef("""
     typedef int64_t trax_value;
 """)
 
+# Integer division and modulo truncate toward zero, the same as AArch64's sdiv
+def trunc_div(a, b):
+    quotient = abs(a) // abs(b)
+    return -quotient if (a < 0) != (b < 0) else quotient
+
+def trunc_mod(a, b):
+    return a - trunc_div(a, b) * b
+
+INTEGER_TAG = 0b000
+NIL_TAG = 0b001
+OBJECT_TAG = 0b101
+FALSE_TAG = 0b011
+TRUE_TAG = 0b111
+
+# Keeps the memory behind every allocated object alive until it is freed,
+# keyed by address
+heap = {}
+
+# Values are 64-bit tagged words, held as plain Python ints outside of
+# traces and the heap. These work on the ints directly.
+
+# Wraps an int around to a signed 64-bit value, like storing it would
+def to_word(value):
+    if -0x8000000000000000 <= value <= 0x7FFFFFFFFFFFFFFF:
+        return value
+    return ((value + 0x8000000000000000) & 0xFFFFFFFFFFFFFFFF) - 0x8000000000000000
+
+def is_integer_value(value):
+    return value & 0b1 == 0
+
+def is_false_value(value):
+    return value & 0b111 == FALSE_TAG
+
+# A pointer to the header word of the object a value points at
+def object_words(value):
+    address = value & 0xFFFFFFFFFFFFFFF8
+    ptr = heap.get(address)
+    return ptr if ptr is not None else ffi.cast("trax_value *", address)
+
+def type_index_of(value):
+    if value & 0b1 == 0:
+        return 0
+    tag = value & 0b111
+    if tag == TRUE_TAG or tag == FALSE_TAG:
+        return 1
+    if tag == NIL_TAG:
+        return 2
+    if tag == OBJECT_TAG:
+        return object_words(value)[0]
+    raise ValueError("Unknown object type")
+
+# The runtime's own Int operators, by the opcodes the compiler emits for
+# them (see trax_bc_compile.INT_OPERATORS). Each takes two tagged ints and
+# gives back a tagged value.
+INT_OPERATIONS = {
+    'add_int': lambda a, b: a + b,
+    'sub_int': lambda a, b: a - b,
+    'mul_int': lambda a, b: (a >> 1) * b,
+    'div_int': lambda a, b: trunc_div(a >> 1, b >> 1) << 1,
+    'mod_int': lambda a, b: trunc_mod(a >> 1, b >> 1) << 1,
+    'lt_int': lambda a, b: TRUE_TAG if a < b else FALSE_TAG,
+    'gt_int': lambda a, b: TRUE_TAG if a > b else FALSE_TAG,
+}
+
 class TraxObject:
-    INTEGER_TAG = 0b000
-    NIL_TAG = 0b001
-    OBJECT_TAG = 0b101
-    FALSE_TAG = 0b011
-    TRUE_TAG = 0b111
+    __slots__ = ('value',)
+
+    INTEGER_TAG = INTEGER_TAG
+    NIL_TAG = NIL_TAG
+    OBJECT_TAG = OBJECT_TAG
+    FALSE_TAG = FALSE_TAG
+    TRUE_TAG = TRUE_TAG
 
-    nil = ffi.cast("trax_value", NIL_TAG)
-    true = ffi.cast("trax_value", TRUE_TAG)
-    false = ffi.cast("trax_value", FALSE_TAG)
+    heap = heap
+
+    nil = NIL_TAG
+    true = TRUE_TAG
+    false = FALSE_TAG
 
     @staticmethod
     def from_int(value):
-        return TraxObject(ffi.cast("trax_value", value << 1))
+        return TraxObject(value << 1)
 
     def to_int(self):
         assert self.is_integer()
-        return int(self.value) >> 1
+        return self.value >> 1
 
+    # Takes an int, or anything int() accepts like a cffi trax_value
     def __init__(self, value):
-        self.value = ffi.cast("trax_value", value)
+        self.value = to_word(int(value))
 
     def is_integer(self):
-        return (int(self.value) & 0b1) == 0
+        return self.value & 0b1 == 0
 
     def is_nil(self):
-        return (int(self.value) & 0b111) == self.NIL_TAG
+        return self.value & 0b111 == NIL_TAG
 
     def is_true(self):
-        return (int(self.value) & 0b111) == self.TRUE_TAG
+        return self.value & 0b111 == TRUE_TAG
 
     def is_false(self):
-        return (int(self.value) & 0b111) == self.FALSE_TAG
+        return self.value & 0b111 == FALSE_TAG
 
     def is_boolean(self):
         return self.is_true() or self.is_false()
 
     def is_object(self):
-        return (int(self.value) & 0b111) == self.OBJECT_TAG
+        return self.value & 0b111 == OBJECT_TAG
 
     def get_object_address(self):
         if not self.is_object():
             raise ValueError("Not an object")
-        return int(self.value) & 0xFFFFFFFFFFFFFFF8  # Mask out the lowest 3 bits
+        return self.value & 0xFFFFFFFFFFFFFFF8  # Mask out the lowest 3 bits
 
     def get_type_index(self):
-        if self.is_integer():
-            return 0
-        elif self.is_boolean():
-            return 1
-        elif self.is_nil():
-            return 2
-        elif self.is_object():
-            ptr = ffi.cast("trax_value *", self.get_object_address())
-            return int(ptr[0])
-        else:
-            raise ValueError("Unknown object type")
+        return type_index_of(self.value)
 
     def __repr__(self):
         if self.is_integer():
-            return f"Integer({int(self.value) >> 1})"
+            return f"Integer({self.value >> 1})"
         elif self.is_nil():
             return "Nil"
         elif self.is_true():
@@ -75,34 +134,31 @@ class TraxObject:
         elif self.is_object():
             return f"Object(address=0x{self.get_object_address():x}, type={self.get_type_index()})"
         else:
-            return f"Unknown(0x{int(self.value):x})"
+            return f"Unknown(0x{self.value:x})"
 
     @staticmethod
     def new(type_index, values):
-        size = (len(values) + 1) * ffi.sizeof("trax_value")
         ptr = ffi.new(f"trax_value[{len(values) + 1}]")
-        ptr[0] = ffi.cast("trax_value", type_index)
+        ptr[0] = type_index
         for i, value in enumerate(values, 1):
             ptr[i] = value.value
-        iptr = ffi.cast("trax_value", ptr)
-        iptr_tag = int(iptr) | TraxObject.OBJECT_TAG
-        return TraxObject(ffi.cast("trax_value", iptr_tag))
+        address = int(ffi.cast("uintptr_t", ptr))
+        heap[address] = ptr
+        return TraxObject(address | OBJECT_TAG)
 
     @staticmethod
     def free(obj):
         if not obj.is_object():
             raise ValueError("Cannot free a non-object")
-        ptr = ffi.cast("trax_value *", obj.get_object_address())
+        ptr = heap.pop(obj.get_object_address())
         ffi.release(ptr)
 
     def get_field(self, field_index):
         if not self.is_object():
             raise ValueError("Cannot get field of a non-object")
-        ptr = ffi.cast("trax_value *", self.get_object_address())
-        return TraxObject(ptr[field_index + 1])
+        return TraxObject(object_words(self.value)[field_index + 1])
 
     def set_field(self, field_index, value):
         if not self.is_object():
             raise ValueError("Cannot set field of a non-object")
-        ptr = ffi.cast("trax_value *", self.get_object_address())
-        ptr[field_index + 1] = value.value
+        object_words(self.value)[field_index + 1] = value.value
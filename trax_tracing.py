@@ -1,3 +1,5 @@
+from trax_obj import TraxObject, trunc_div, trunc_mod
+
 class TraceInstruction:
     def __hash__(self):
         return id(self)
@@ -14,20 +16,54 @@ class TraceInstruction:
     def copy(self, value_map):
         return self.__class__()
 
+# Objects that the trace never allocated are described to the interpreter
+# with these. Each field is either an index into the guard's values_to_keep,
+# another VirtualObject, or None if the field was never set.
+class VirtualObject:
+    def __init__(self, type_index, fields):
+        self.type_index = type_index
+        self.fields = fields
+
+    def pretty_print(self):
+        fields = ', '.join(resume_entry_to_str(f) for f in self.fields)
+        return f"Virtual(type_index={self.type_index}, fields=[{fields}])"
+
+def resume_entry_to_str(entry):
+    if isinstance(entry, VirtualObject):
+        return entry.pretty_print()
+    return str(entry)
+
 class GuardInstruction(TraceInstruction):
+    # Whether the interpreter resumes by redoing the instruction that emitted
+    # this guard, rather than carrying on from the other side of a branch
+    redoes_instruction = True
+
     def __init__(self, guard_id: int, operand: "ValueInstruction", values_to_keep: list["ValueInstruction"]):
         self.guard_id = guard_id
         self.operand = operand
         self.values_to_keep = values_to_keep
+        # When this is None values_to_keep lines up 1:1 with the values the
+        # interpreter needs back. Otherwise it has one entry per interpreter
+        # value: an index into values_to_keep or a VirtualObject.
+        self.resume = None
 
     def get_live_values(self):
         return [self.operand] + self.values_to_keep
 
     def pretty_print(self, value_to_name):
-        return f"{self.__class__.__name__}(guard_id={self.guard_id}, operand={value_to_name(self.operand)}, values_to_keep=[{', '.join(value_to_name(v) for v in self.values_to_keep)}])"
+        return f"{self.__class__.__name__}(guard_id={self.guard_id}, operand={value_to_name(self.operand)}, values_to_keep=[{', '.join(value_to_name(v) for v in self.values_to_keep)}]{self.pretty_print_resume()})"
+
+    def pretty_print_resume(self):
+        if self.resume is None:
+            return ""
+        return f", resume=[{', '.join(resume_entry_to_str(e) for e in self.resume)}]"
+
+    def copy_resume(self, other):
+        other.resume = self.resume
+        return other
 
     def copy(self, value_map):
-        return self.__class__(self.guard_id, value_map(self.operand), [value_map(v) for v in self.values_to_keep])
+        return self.copy_resume(self.__class__(self.guard_id, value_map(self.operand), [value_map(v) for v in self.values_to_keep]))
 
 class GuardNil(GuardInstruction):
     pass
@@ -38,8 +74,13 @@ class GuardInt(GuardInstruction):
 class GuardBool(GuardInstruction):
     pass
 
+# Branches go the way they went while recording. Anything but false counts
+# as true, and if the guard fails the interpreter picks up on the other side.
 class GuardTrue(GuardInstruction):
-    pass
+    redoes_instruction = False
+
+class GuardFalse(GuardInstruction):
+    redoes_instruction = False
 
 class GuardIndex(GuardInstruction):
     def __init__(self, guard_id: int, operand: "ValueInstruction", type_index: int, values_to_keep: list["ValueInstruction"]):
@@ -47,24 +88,36 @@ class GuardIndex(GuardInstruction):
         self.type_index = type_index
 
     def pretty_print(self, value_to_name):
-        return f"{self.__class__.__name__}(guard_id={self.guard_id}, operand={value_to_name(self.operand)}, type_index={self.type_index}, values_to_keep=[{', '.join(value_to_name(v) for v in self.values_to_keep)}])"
+        return f"{self.__class__.__name__}(guard_id={self.guard_id}, operand={value_to_name(self.operand)}, type_index={self.type_index}, values_to_keep=[{', '.join(value_to_name(v) for v in self.values_to_keep)}]{self.pretty_print_resume()})"
 
     def copy(self, value_map):
-        return self.__class__(self.guard_id, value_map(self.operand), self.type_index, [value_map(v) for v in self.values_to_keep])
+        return self.copy_resume(self.__class__(self.guard_id, value_map(self.operand), self.type_index, [value_map(v) for v in self.values_to_keep]))
+
+# Fails if a division would be by zero
+class GuardNonZero(GuardInstruction):
+    pass
+
+# Fails if the helper call it checks reported that it couldn't do the work,
+# see CallHelperInstruction. The interpreter redoes the call itself.
+class GuardSuccess(GuardInstruction):
+    pass
 
 class GuardCond(GuardInstruction):
     def __init__(self, guard_id: int, operand: "ValueInstruction", right: "ValueInstruction", values_to_keep: list["ValueInstruction"]):
         super().__init__(guard_id, operand, values_to_keep)
         self.right = right
 
+    # These come from branches, see optimize_guards
+    redoes_instruction = False
+
     def get_live_values(self):
         return [self.operand, self.right] + self.values_to_keep
 
     def pretty_print(self, value_to_name):
-        return f"{self.__class__.__name__}(guard_id={self.guard_id}, operand={value_to_name(self.operand)}, right={value_to_name(self.right)}, values_to_keep=[{', '.join(value_to_name(v) for v in self.values_to_keep)}])"
+        return f"{self.__class__.__name__}(guard_id={self.guard_id}, operand={value_to_name(self.operand)}, right={value_to_name(self.right)}, values_to_keep=[{', '.join(value_to_name(v) for v in self.values_to_keep)}]{self.pretty_print_resume()})"
 
     def copy(self, value_map):
-        return self.__class__(self.guard_id, value_map(self.operand), value_map(self.right), [value_map(v) for v in self.values_to_keep])
+        return self.copy_resume(self.__class__(self.guard_id, value_map(self.operand), value_map(self.right), [value_map(v) for v in self.values_to_keep]))
 
 class GuardLT(GuardCond):
     pass
@@ -85,12 +138,22 @@ class GuardNE(GuardCond):
     pass
 
 class ValueInstruction(TraceInstruction):
+    # Raw values are untagged machine integers, see unbox_integers
+    raw = False
+
     def pretty_print(self, value_to_name):
         return f"{value_to_name(self)} = {self.__class__.__name__}"
 
     def copy(self, value_map):
         return self.__class__()
 
+    def raw_suffix(self):
+        return ", raw" if self.raw else ""
+
+    def copy_raw(self, other):
+        other.raw = self.raw
+        return other
+
 class ConstantInstruction(ValueInstruction):
     def __init__(self, constant_index, type_index):
         self.constant_index = constant_index
@@ -100,10 +163,10 @@ class ConstantInstruction(ValueInstruction):
         return []
 
     def pretty_print(self, value_to_name):
-        return f"{value_to_name(self)} = {self.__class__.__name__}(constant_index={self.constant_index})"
+        return f"{value_to_name(self)} = {self.__class__.__name__}(constant_index={self.constant_index}{self.raw_suffix()})"
 
     def copy(self, value_map):
-        return self.__class__(self.constant_index, self.type_index)
+        return self.copy_raw(self.__class__(self.constant_index, self.type_index))
 
 class BinaryOpInstruction(ValueInstruction):
     def __init__(self, left, right, type_index):
@@ -115,10 +178,10 @@ class BinaryOpInstruction(ValueInstruction):
         return [self.left, self.right]
 
     def pretty_print(self, value_to_name):
-        return f"{value_to_name(self)} = {self.__class__.__name__}({value_to_name(self.left)}, {value_to_name(self.right)})"
+        return f"{value_to_name(self)} = {self.__class__.__name__}({value_to_name(self.left)}, {value_to_name(self.right)}{self.raw_suffix()})"
 
     def copy(self, value_map):
-        return self.__class__(value_map(self.left), value_map(self.right), self.type_index)
+        return self.copy_raw(self.__class__(value_map(self.left), value_map(self.right), self.type_index))
 
 class BoolBinInstruction(BinaryOpInstruction):
     def __init__(self, left, right):
@@ -154,7 +217,7 @@ class IntBinInstruction(BinaryOpInstruction):
         self.type_index = 0
 
     def copy(self, value_map):
-        return self.__class__(value_map(self.left), value_map(self.right))
+        return self.copy_raw(self.__class__(value_map(self.left), value_map(self.right)))
 
 class AddInstruction(IntBinInstruction):
     pass
@@ -171,6 +234,50 @@ class DivInstruction(IntBinInstruction):
 class ModInstruction(IntBinInstruction):
     pass
 
+# Multiplication by a power of two. Shifting a tagged integer keeps the tag
+# bit clear so this works on tagged values directly.
+class ShiftLeftInstruction(ValueInstruction):
+    def __init__(self, operand, shift):
+        self.operand = operand
+        self.shift = shift
+        self.type_index = 0
+
+    def get_live_values(self):
+        return [self.operand]
+
+    def pretty_print(self, value_to_name):
+        return f"{value_to_name(self)} = {self.__class__.__name__}({value_to_name(self.operand)}, shift={self.shift}{self.raw_suffix()})"
+
+    def copy(self, value_map):
+        return self.copy_raw(self.__class__(value_map(self.operand), self.shift))
+
+# Conversions between tagged and raw integers
+class ConvertInstruction(ValueInstruction):
+    def __init__(self, operand):
+        self.operand = operand
+        self.type_index = 0
+
+    def get_live_values(self):
+        return [self.operand]
+
+    def pretty_print(self, value_to_name):
+        return f"{value_to_name(self)} = {self.__class__.__name__}({value_to_name(self.operand)})"
+
+    def copy(self, value_map):
+        return self.__class__(value_map(self.operand))
+
+class UntagInstruction(ConvertInstruction):
+    raw = True
+
+class TagInstruction(ConvertInstruction):
+    pass
+
+# Raw arithmetic wraps at 64 bits but tagged integers wrap at 63. This wraps a
+# raw integer the way the tagged one would have been, which compares and
+# division need to get the same answer.
+class NormalizeInstruction(ConvertInstruction):
+    raw = True
+
 class InputInstruction(ValueInstruction):
     phi: ValueInstruction
     input_index: int
@@ -183,7 +290,7 @@ class InputInstruction(ValueInstruction):
         return []
 
     def pretty_print(self, value_to_name):
-        return f"{value_to_name(self)} = {self.__class__.__name__}(input_index={self.input_index})"
+        return f"{value_to_name(self)} = {self.__class__.__name__}(input_index={self.input_index}{self.raw_suffix()})"
 
     def copy(self, value_map):
         raise ValueError("You cannot copy an input instruction")
@@ -231,6 +338,23 @@ class NewInstruction(ValueInstruction):
     def copy(self, value_map):
         return self.__class__(self.type_index, self.num_fields)
 
+# Calls a native function on tagged values, see trax_backend.NativeHelper.
+# The helper might have side effects, and it's always followed by a
+# GuardSuccess on the call.
+class CallHelperInstruction(ValueInstruction):
+    def __init__(self, helper, args):
+        self.helper = helper
+        self.args = args
+
+    def get_live_values(self):
+        return list(self.args)
+
+    def pretty_print(self, value_to_name):
+        return f"{value_to_name(self)} = {self.__class__.__name__}({self.helper.name}, args=[{', '.join(value_to_name(v) for v in self.args)}])"
+
+    def copy(self, value_map):
+        return self.__class__(self.helper, [value_map(v) for v in self.args])
+
 # Copy instructions are for creating copies from the preamble to the body which may sometimes be needed
 class CopyInstruction(TraceInstruction):
     input: InputInstruction
@@ -244,14 +368,28 @@ class CopyInstruction(TraceInstruction):
         return [self.value, self.input]
 
     def pretty_print(self, value_to_name):
-        return f"{self.__class__.__name__}(input={value_to_name(self.value)}, value={value_to_name(self.value)})"
+        return f"{self.__class__.__name__}(input={value_to_name(self.input)}, value={value_to_name(self.value)})"
 
     def copy(self, value_map):
         raise ValueError("You cannot copy a copy instruction")
 
 class TraceCompiler:
-    def __init__(self):
+    # Bodies longer than this aren't unrolled, the jump back is cheap next to them
+    MAX_UNROLLED_BODY = 12
+
+    def __init__(self, unroll_factor=1, split_reductions=False):
         self.instructions = []
+        self.inputs = []
+        self.preamble = None
+        # Set by the interpreter, this guard resumes at the top of the loop
+        # with just the inputs on the stack
+        self.loop_header_guard_id = None
+        # The loop inputs holding what the interpreter has on the stack at the
+        # top of the loop, one for each of self.inputs. Set by unbox_integers.
+        self.loop_state = None
+        # How many iterations each trip around the loop does, see unroll
+        self.unroll_factor = unroll_factor
+        self.split_reductions = split_reductions
 
     def add_instruction(self, instruction):
         self.instructions.append(instruction)
@@ -268,9 +406,15 @@ class TraceCompiler:
     def guard_true(self, guard_id, operand, values_to_keep):
         self.add_instruction(GuardTrue(guard_id, operand, values_to_keep))
 
+    def guard_false(self, guard_id, operand, values_to_keep):
+        self.add_instruction(GuardFalse(guard_id, operand, values_to_keep))
+
     def guard_index(self, guard_id, operand, type_index, values_to_keep):
         self.add_instruction(GuardIndex(guard_id, operand, type_index, values_to_keep))
 
+    def guard_success(self, guard_id, operand, values_to_keep):
+        self.add_instruction(GuardSuccess(guard_id, operand, values_to_keep))
+
     def constant(self, constant_index, type_index):
          instruction = ConstantInstruction(constant_index, type_index)
          self.add_instruction(instruction)
@@ -279,6 +423,7 @@ class TraceCompiler:
     def input(self, input_index):
         instruction = InputInstruction(input_index)
         self.add_instruction(instruction)
+        self.inputs.append(instruction)
         return instruction
 
     def add(self, left, right):
@@ -351,16 +496,28 @@ class TraceCompiler:
         self.add_instruction(instruction)
         return instruction
 
+    def call_helper(self, helper, args):
+        instruction = CallHelperInstruction(helper, list(args))
+        self.add_instruction(instruction)
+        return instruction
+
     def get_instructions(self):
         return list(self.instructions)
 
     def optimize(self, constant_table):
         self.remove_redundant_guards() # Guards get repeated a lot, remove repeated ones
+        self.remove_allocations() # Objects that don't escape the trace don't need to be allocated
+        self.fold_constants(constant_table) # Work on constants can happen at compile time
         self.dead_value_elimination(get_liveness_ranges(self.instructions)) # Don't need to compute dead values
         self.optimize_constant_guards(constant_table) # Sometimes we guard on a constants
         self.remove_trivial_guards() # Sometimes we guard on something we know the type of
         self.optimize_guards(get_liveness_ranges(self.instructions)) # Sometimes there's a better guard we can use
         self.unroll_and_lift()
+        self.hoist_invariants() # Work and guards that come out the same every time only happen once
+        self.unbox_integers(constant_table) # Integers don't need their tags while in registers
+        self.optimize_induction_variables(constant_table) # Counting loops can do less work or none at all
+        self.propagate_ranges(constant_table) # Compares whose answer we already know don't need checking
+        self.unroll(self.unroll_factor) # Tiny loops can do a few iterations per jump back
 
     # This is a somewhat tracing jit specific optimization, we want to recognize that the initital inputs
     # might not be of a fixed class but after that we might know with certainy that they are. This leads
@@ -380,11 +537,6 @@ class TraceCompiler:
                         continue
                     value_types[instruction.operand] = 0
 
-                if isinstance(instruction, GuardTrue):
-                    if instruction.operand in value_types and value_types[instruction.operand] == 2:
-                        continue
-                    value_types[instruction.operand] = 2
-
                 if isinstance(instruction, GuardNil):
                     if instruction.operand in value_types and value_types[instruction.operand] == 1:
                         continue
@@ -400,7 +552,8 @@ class TraceCompiler:
                 preamble_to_body[instruction] = instruction
                 # We know the type of this in the second run
                 if instruction is not instruction.phi:
-                    value_types[instruction] = value_types[instruction.phi]
+                    if instruction.phi in value_types:
+                        value_types[instruction] = value_types[instruction.phi]
                     phi_nodes[instruction.phi] = instruction # We need know about phi nodes later so that we can update them
                 self.preamble.append(CopyInstruction(instruction, instruction.phi))
                 continue
@@ -416,11 +569,6 @@ class TraceCompiler:
                     continue
                 value_types[instruction.operand] = 0
 
-            if isinstance(instruction, GuardTrue):
-                if instruction.operand in value_types and value_types[instruction.operand] == 2:
-                    continue
-                value_types[instruction.operand] = 2
-
             if isinstance(instruction, GuardNil):
                 if instruction.operand in value_types and value_types[instruction.operand] == 1:
                     continue
@@ -435,6 +583,859 @@ class TraceCompiler:
             preamble_to_body[instruction] = new_inst
             self.body.append(new_inst)
 
+    # Integers don't need their tag while they sit in registers. Integer
+    # arithmetic is rewritten to work on raw machine integers and values are
+    # only converted where that is cheaper or something needs the other form:
+    # stores into objects and any operation that isn't integer arithmetic want
+    # tagged values, while multiplication and division are much simpler raw.
+    # Guard exits take either form since the backend tags raw values on the
+    # way out. Loop carried integers get a new raw input so they stay untagged
+    # from one iteration to the next.
+    def unbox_integers(self, constant_table):
+        preamble = [inst for inst in self.preamble if not isinstance(inst, CopyInstruction)]
+        copies = {inst.input: inst.value for inst in self.preamble if isinstance(inst, CopyInstruction)}
+        inputs = [inst for inst in preamble if isinstance(inst, InputInstruction)]
+        loop_inputs = [inst for inst in inputs if inst.phi is not inst]
+
+        def is_int(value, ints):
+            return value in ints or (isinstance(value, ConstantInstruction) and value.type_index == 0)
+
+        def add_ints(instruction, ints):
+            if isinstance(instruction, GuardInt):
+                ints.add(instruction.operand)
+            elif isinstance(instruction, (IntBinInstruction, ShiftLeftInstruction)):
+                ints.add(instruction)
+
+        # An input can be kept raw if it's an integer on the way into the loop
+        # and on every trip around it
+        preamble_ints = set()
+        for instruction in preamble:
+            add_ints(instruction, preamble_ints)
+        unboxed = [inst for inst in loop_inputs if is_int(copies[inst], preamble_ints)]
+        while True:
+            body_ints = (preamble_ints - set(loop_inputs)) | set(unboxed)
+            for instruction in self.body:
+                add_ints(instruction, body_ints)
+            still_unboxed = [inst for inst in unboxed if is_int(inst.phi, body_ints)]
+            if still_unboxed == unboxed:
+                break
+            unboxed = still_unboxed
+
+        raw_inputs = {}
+        for input_inst in unboxed:
+            raw_input = InputInstruction(None)
+            raw_input.raw = True
+            raw_inputs[input_inst] = raw_input
+
+        # Everything defined before the loop except inputs that change in it
+        invariant = set(preamble) - set(loop_inputs)
+        preamble_values = set(preamble)
+        forms = {} # original value -> {'tagged': ..., 'raw': ..., 'exact': ...}
+        out = []
+        hoisted = []
+        in_body = False
+
+        def forms_of(value):
+            return forms.setdefault(value, {'tagged': value})
+
+        def convert(cls, source):
+            instruction = cls(source)
+            # Conversions of values that don't change in the loop happen before it
+            if in_body and source in invariant:
+                hoisted.append(instruction)
+            else:
+                out.append(instruction)
+            return instruction
+
+        def is_exact(value):
+            return isinstance(value, (UntagInstruction, NormalizeInstruction, ConstantInstruction, ModInstruction))
+
+        def form(value, kind):
+            f = forms_of(value)
+            if kind in f:
+                return f[kind]
+            if kind == 'tagged':
+                f['tagged'] = convert(TagInstruction, f['raw'])
+            elif kind == 'raw' and isinstance(value, ConstantInstruction):
+                constant = ConstantInstruction(value.constant_index, 0)
+                constant.raw = True
+                (hoisted if in_body else out).append(constant)
+                f['raw'] = constant
+            elif kind == 'raw':
+                f['raw'] = convert(UntagInstruction, f['tagged'])
+            elif is_exact(form(value, 'raw')):
+                f['exact'] = f['raw']
+            else:
+                f['exact'] = convert(NormalizeInstruction, f['raw'])
+            return f[kind]
+
+        # How many instructions it would take to get a value in some form
+        def cost(value, kind):
+            f = forms_of(value)
+            if kind in f or isinstance(value, ConstantInstruction):
+                return 0
+            if kind == 'exact' and 'raw' in f and is_exact(f['raw']):
+                return 0
+            source = f['raw'] if 'raw' in f else f['tagged']
+            return 0 if in_body and source in invariant else 1
+
+        def cheapest(values, kinds):
+            return min(kinds, key=lambda kind: sum(cost(v, kind) for v in values))
+
+        # Guard exits don't care which form they get
+        def any_form(value):
+            f = forms_of(value)
+            return f['tagged'] if 'tagged' in f else f['raw']
+
+        def rewrite(instruction, kind):
+            mapped = {v: form(v, kind) for v in instruction.get_live_values()}
+            if all(mapped[v] is v for v in mapped):
+                return instruction
+            return instruction.copy(lambda v: mapped[v])
+
+        # Divisors checked before the loop that don't change in it aren't checked again
+        nonzero = set()
+
+        def guard_nonzero(divisor):
+            if isinstance(divisor, ConstantInstruction) and constant_table[divisor.constant_index].to_int() != 0:
+                return
+            if divisor in nonzero:
+                return
+            # Without a guard to borrow the division goes unchecked and the
+            # backend won't compile the trace
+            guard = self.borrow_guard(out, [any_form(i) for i in self.inputs] if in_body else self.inputs, preamble_values)
+            if guard is not None:
+                out.append(guard.copy_resume(GuardNonZero(guard.guard_id, divisor, list(guard.values_to_keep))))
+                if not in_body:
+                    nonzero.add(divisor)
+
+        def unbox(instructions, ints):
+            for instruction in instructions:
+                operands = instruction.get_live_values()
+                if isinstance(instruction, InputInstruction):
+                    out.append(instruction)
+                elif isinstance(instruction, (IntBinInstruction, ShiftLeftInstruction)) and all(is_int(v, ints) for v in operands):
+                    if isinstance(instruction, (DivInstruction, ModInstruction)):
+                        new_inst = instruction.copy(lambda v: form(v, 'exact'))
+                        guard_nonzero(new_inst.right)
+                        kind = 'raw'
+                    elif isinstance(instruction, MulInstruction):
+                        new_inst = rewrite(instruction, 'raw')
+                        kind = 'raw'
+                    else:
+                        kind = cheapest(operands, ['raw', 'tagged'])
+                        new_inst = rewrite(instruction, kind)
+                    new_inst.raw = kind == 'raw'
+                    forms[instruction] = {kind: new_inst}
+                    out.append(new_inst)
+                elif isinstance(instruction, (BoolBinInstruction, GuardCond)) and all(is_int(v, ints) for v in operands[:2]):
+                    operands = operands[:2]
+                    # Compares need raw integers to be exact, otherwise tagged is just as good
+                    kind = cheapest(operands, ['tagged', 'exact'])
+                    mapped = {v: form(v, kind) for v in operands}
+                    if isinstance(instruction, GuardInstruction):
+                        new_inst = instruction.copy(any_form)
+                        new_inst.operand, new_inst.right = mapped[instruction.operand], mapped[instruction.right]
+                    else:
+                        new_inst = instruction.copy(lambda v: mapped[v])
+                        forms[instruction] = {'tagged': new_inst}
+                    out.append(new_inst)
+                elif isinstance(instruction, GuardInstruction):
+                    if isinstance(instruction, GuardInt) and instruction.operand in ints:
+                        continue
+                    new_inst = instruction.copy(any_form)
+                    new_inst.operand = form(instruction.operand, 'tagged')
+                    if isinstance(instruction, GuardCond):
+                        new_inst.right = form(instruction.right, 'tagged')
+                    out.append(new_inst)
+                else:
+                    new_inst = rewrite(instruction, 'tagged')
+                    if isinstance(instruction, ValueInstruction):
+                        forms[instruction] = {'tagged': new_inst}
+                    out.append(new_inst)
+                add_ints(instruction, ints)
+
+        unbox(preamble, set())
+        new_preamble = out
+
+        # Inside the loop the inputs take on new values each time around
+        in_body = True
+        out = []
+        preamble_forms = {i: forms_of(i) for i in loop_inputs}
+        for input_inst in loop_inputs:
+            forms[input_inst] = {'raw': raw_inputs[input_inst]} if input_inst in raw_inputs else {'tagged': input_inst}
+        unbox(self.body, (preamble_ints - set(loop_inputs)) | set(unboxed))
+        phis = {}
+        for input_inst in loop_inputs:
+            phis[input_inst] = form(input_inst.phi, 'raw' if input_inst in raw_inputs else 'tagged')
+        new_body = out
+
+        # The copies into the loop inputs happen in the preamble
+        in_body = False
+        out = []
+        new_copies = []
+        forms.update(preamble_forms)
+        for input_inst in inputs:
+            if input_inst in raw_inputs:
+                raw_input = raw_inputs[input_inst]
+                raw_input.phi = phis[input_inst]
+                input_inst.phi = input_inst
+                new_copies.append(CopyInstruction(raw_input, form(copies[input_inst], 'raw')))
+            else:
+                if input_inst in phis:
+                    input_inst.phi = phis[input_inst]
+                new_copies.append(CopyInstruction(input_inst, form(copies[input_inst], 'tagged')))
+
+        self.body, live = remove_dead_values(new_body, [i.phi for i in inputs] + [r.phi for r in raw_inputs.values()])
+        # The raw inputs go with the others, before the values they carry
+        # around the loop, which can be values hoisted into the preamble
+        preamble = new_preamble + hoisted + out
+        start = next((i for i, inst in enumerate(preamble) if not isinstance(inst, InputInstruction)), len(preamble))
+        preamble[start:start] = raw_inputs.values()
+        self.preamble, _ = remove_dead_values(preamble + new_copies, live)
+        self.loop_state = [raw_inputs.get(i, i) for i in self.inputs]
+
+    # Guards added by the optimizer reuse the resume state of an earlier guard.
+    # That's only safe if nothing with a side effect happened since, so that
+    # the interpreter can redo the work from there. If there's no such guard
+    # we can go back to the top of the loop where only the inputs are needed.
+    def borrow_guard(self, instructions, inputs, preamble_values):
+        for instruction in reversed(instructions):
+            # Going back to before a helper call would make it happen twice
+            if isinstance(instruction, (SetFieldInstruction, CallHelperInstruction, GuardSuccess)):
+                return None
+            if isinstance(instruction, GuardInstruction) and instruction.redoes_instruction:
+                return instruction
+        if self.loop_header_guard_id is None or not all(i in preamble_values for i in self.inputs):
+            return None
+        return GuardInstruction(self.loop_header_guard_id, None, list(inputs))
+
+    # Work in the body that comes out the same every time around, like
+    # reading a flag out of an object the loop never writes to, moves in
+    # front of the loop, reusing the value from the first iteration when the
+    # preamble has it. A guard on such values can't change its mind inside the
+    # loop. If the preamble already checked it, it's dropped, otherwise it's
+    # checked once on the way in and goes back to the top of the loop if it
+    # fails. The trace keeps following the way these went while recording.
+    def hoist_invariants(self):
+        if self.loop_header_guard_id is None:
+            return
+        preamble, copies = self.split_preamble()
+        loop_inputs = [inst for inst in preamble if isinstance(inst, InputInstruction) and inst.phi is not inst]
+        written = {inst.field_index for inst in preamble + self.body if isinstance(inst, SetFieldInstruction)}
+        # Helpers can write to any field
+        calls = any(isinstance(inst, CallHelperInstruction) for inst in self.body)
+        invariant = set(preamble) - set(loop_inputs)
+        entry = {copy.input: copy.value for copy in copies}
+
+        def key(instruction):
+            if isinstance(instruction, GuardInstruction):
+                values = instruction.get_live_values()
+                operands = values[:len(values) - len(instruction.values_to_keep)]
+                return type(instruction), tuple(operands), getattr(instruction, 'type_index', None)
+            if isinstance(instruction, GetFieldInstruction) and (calls or instruction.field_index in written):
+                return None
+            if not isinstance(instruction, (BinaryOpInstruction, ShiftLeftInstruction, ConvertInstruction, GetFieldInstruction)):
+                return None
+            return (type(instruction), instruction.raw, tuple(instruction.get_live_values()),
+                    getattr(instruction, 'field_index', None), getattr(instruction, 'shift', None))
+
+        known = {}
+        for instruction in preamble:
+            instruction_key = key(instruction)
+            if instruction_key is not None:
+                known.setdefault(instruction_key, instruction)
+
+        replacements = {}
+        hoisted = []
+        body = []
+        for original in self.body:
+            instruction = copy_with_replacements(original, replacements)
+            if instruction is not original:
+                replacements[original] = instruction
+            operands = instruction.get_live_values()
+            if isinstance(instruction, GuardInstruction):
+                operands = operands[:len(operands) - len(instruction.values_to_keep)]
+            instruction_key = key(instruction)
+            if instruction_key is None or not all(v in invariant or isinstance(v, ConstantInstruction) for v in operands):
+                body.append(instruction)
+                continue
+            if isinstance(instruction, GuardInstruction):
+                if instruction_key not in known:
+                    guard = instruction.copy(lambda v: v)
+                    guard.guard_id = self.loop_header_guard_id
+                    guard.values_to_keep = [entry.get(v, v) for v in self.inputs]
+                    guard.resume = None
+                    known[instruction_key] = guard
+                    hoisted.append(guard)
+                continue
+            if instruction_key not in known:
+                known[instruction_key] = instruction
+                hoisted.append(instruction)
+                invariant.add(instruction)
+            replacements[original] = known[instruction_key]
+
+        for input_inst in loop_inputs:
+            input_inst.phi = replacements.get(input_inst.phi, input_inst.phi)
+        self.body, live = remove_dead_values(body, [i.phi for i in loop_inputs])
+        self.preamble, _ = remove_dead_values(preamble + hoisted + copies, live)
+
+    # Induction variable work on the raw loop inputs unbox_integers made
+    def optimize_induction_variables(self, constant_table):
+        self.strength_reduce(constant_table)
+        if not self.closed_form_loop(constant_table):
+            self.hoist_implied_guards(constant_table)
+        self.body, live = remove_dead_values(self.body, [i.phi for i in self.preamble if isinstance(i, InputInstruction)])
+        self.preamble, _ = remove_dead_values(self.preamble, live)
+
+    def split_preamble(self):
+        preamble = [inst for inst in self.preamble if not isinstance(inst, CopyInstruction)]
+        copies = [inst for inst in self.preamble if isinstance(inst, CopyInstruction)]
+        return preamble, copies
+
+    # Multiplying an induction variable by something that doesn't change in
+    # the loop gives another induction variable, one that only needs an add
+    # each time around
+    def strength_reduce(self, constant_table):
+        preamble, copies = self.split_preamble()
+        copy_sources = {copy.input: copy.value for copy in copies}
+        preamble_values = set(preamble)
+        hoisted = []
+        body_end = []
+        recurrences = LoopRecurrences(preamble, self.body, RawArithmetic(constant_table, hoisted))
+        body_arithmetic = RawArithmetic(constant_table, body_end)
+        replacements = {}
+        new_inputs = []
+
+        for instruction in self.body:
+            if not (isinstance(instruction, MulInstruction) and instruction.raw):
+                continue
+            for variable, factor in ((instruction.left, instruction.right), (instruction.right, instruction.left)):
+                if variable not in copy_sources or not recurrences.is_invariant(factor):
+                    continue
+                if not (factor in preamble_values or isinstance(factor, ConstantInstruction)):
+                    continue
+                step = recurrences.step(variable)
+                if step is None:
+                    continue
+                new_input = InputInstruction(None)
+                new_input.raw = True
+                copies.append(CopyInstruction(new_input, recurrences.arithmetic.mul(copy_sources[variable], factor)))
+                new_input.phi = body_arithmetic.add(new_input, recurrences.arithmetic.mul(step, factor))
+                new_inputs.append(new_input)
+                replacements[instruction] = new_input
+                break
+
+        if not replacements:
+            return
+        body = []
+        for instruction in self.body:
+            if instruction in replacements:
+                continue
+            new_inst = copy_with_replacements(instruction, replacements)
+            if new_inst is not instruction:
+                replacements[instruction] = new_inst
+            body.append(new_inst)
+        for instruction in preamble + new_inputs:
+            if isinstance(instruction, InputInstruction):
+                instruction.phi = replacements.get(instruction.phi, instruction.phi)
+        self.body = body + body_end
+        self.preamble = preamble + hoisted + new_inputs + copies
+
+    # A loop that only updates integers and has a single exit guard counting
+    # towards a bound can skip straight to its last iteration. Once the guard
+    # has passed we know how many more times it will, and every loop input can
+    # be moved that many iterations ahead at once. The next time around the
+    # guard fails and the trace exits. Raw arithmetic wraps just like the loop
+    # would have so the closed forms give the same answer even on overflow.
+    def closed_form_loop(self, constant_table):
+        guards = [inst for inst in self.body if isinstance(inst, GuardInstruction)]
+        if len(guards) != 1:
+            return False
+        if any(not isinstance(inst, (ValueInstruction, GuardInstruction)) or isinstance(inst, (NewInstruction, CallHelperInstruction)) for inst in self.body):
+            return False
+
+        preamble, _ = self.split_preamble()
+        body_end = []
+        arithmetic = RawArithmetic(constant_table, body_end)
+        recurrences = LoopRecurrences(preamble, self.body, arithmetic)
+        count = recurrences.trip_count(guards[0])
+        if count is None:
+            return False
+
+        pairs = None
+        new_phis = {}
+        for input_inst in recurrences.loop_inputs:
+            recurrence = recurrences.recurrence(input_inst)
+            if recurrence is None:
+                return False
+            c1, c2 = recurrence
+            if c2 is not None and pairs is None:
+                # count * (count - 1) / 2, halving whichever of the two is even
+                # so that nothing is lost when the product wraps
+                half = arithmetic.div(count, 2)
+                odd_half = arithmetic.shl(arithmetic.div(arithmetic.add(count, arithmetic.constant(1)), 2), 1)
+                pairs = arithmetic.mul(half, arithmetic.sub(odd_half, arithmetic.constant(1)))
+            new_phis[input_inst] = arithmetic.add(arithmetic.add(input_inst, arithmetic.mul(c1, count)), arithmetic.mul(c2, pairs))
+
+        self.body = self.body + body_end
+        for input_inst, phi in new_phis.items():
+            input_inst.phi = phi
+        return True
+
+    # A compare guard on an induction variable can be implied by an earlier
+    # one on the same variable, like a bounds check inside a counting loop.
+    # Whether it is only depends on the two bounds so we check that once
+    # before the loop, going back to the interpreter if it doesn't hold.
+    def hoist_implied_guards(self, constant_table):
+        preamble, copies = self.split_preamble()
+        preamble_values = set(preamble)
+        checks = []
+        arithmetic = RawArithmetic(constant_table, checks)
+        recurrences = LoopRecurrences(preamble, self.body, arithmetic)
+
+        def available(value):
+            return value in preamble_values or isinstance(value, ConstantInstruction)
+
+        def hoist(variable, offset, cls, bound, tagged):
+            upper = cls in (GuardLT, GuardLE)
+            for fact_variable, fact_cls, fact_bound, fact_tagged in facts:
+                if fact_variable is not variable or (fact_cls in (GuardLT, GuardLE)) != upper:
+                    continue
+                if not (available(bound) and available(fact_bound)):
+                    continue
+                header = self.borrow_guard([], self.inputs, preamble_values)
+                if header is None:
+                    return False
+                # variable < n means variable <= n - 1, so variable + offset <= n - 1 + offset
+                edge = offset + ((-1 if upper else 1) if fact_cls in (GuardLT, GuardGT) else 0)
+                limit = arithmetic.add(arithmetic.exact(fact_bound, fact_tagged), arithmetic.constant(edge))
+                checks.append(cls(header.guard_id, limit, arithmetic.exact(bound, tagged), list(header.values_to_keep)))
+                return True
+            return False
+
+        facts = []
+        body = []
+        for instruction in self.body:
+            compare = recurrences.compare_on_induction_variable(instruction)
+            if compare is not None:
+                if hoist(*compare):
+                    continue
+                variable, offset, cls, bound, tagged = compare
+                if offset == 0:
+                    facts.append((variable, cls, bound, tagged))
+            body.append(instruction)
+
+        self.body = body
+        self.preamble = preamble + checks + copies
+
+    # Bounds on integers let us drop compare guards that can't fail and sign
+    # extensions of raw values that can't have wrapped. Compares on tagged
+    # integers whose raw values are exact can use those instead, so nothing
+    # needs tagging each time around the loop. In the body a loop input is
+    # assumed to stay between where it starts and wherever its step takes it,
+    # and we keep that assumption only if the body can't break it.
+    def propagate_ranges(self, constant_table):
+        preamble, copies = self.split_preamble()
+        loop_inputs = [inst for inst in preamble if isinstance(inst, InputInstruction) and inst.phi is not inst]
+        invariant = set(preamble) - set(loop_inputs)
+        replacements = {}
+        hoisted = []
+        raw_forms = {}
+
+        def raw_form(ranges, value):
+            if isinstance(value, TagInstruction) and ranges.get(value.operand) is not None:
+                return value.operand
+            if value.raw or ranges.get(value) is None or not (value in invariant or isinstance(value, ConstantInstruction)):
+                return None
+            if value not in raw_forms:
+                if isinstance(value, ConstantInstruction):
+                    raw_forms[value] = ConstantInstruction(value.constant_index, 0)
+                    raw_forms[value].raw = True
+                else:
+                    raw_forms[value] = UntagInstruction(value)
+                hoisted.append(raw_forms[value])
+            ranges.define(raw_forms[value])
+            return raw_forms[value]
+
+        def compare_raw(ranges, guard):
+            if not any(isinstance(v, TagInstruction) for v in (guard.operand, guard.right)):
+                return guard
+            operand, right = raw_form(ranges, guard.operand), raw_form(ranges, guard.right)
+            if operand is None or right is None:
+                return guard
+            new_guard = guard.copy(lambda v: v)
+            new_guard.operand, new_guard.right = operand, right
+            return new_guard
+
+        def walk(ranges, instructions, rewrite=False, in_body=False):
+            out = []
+            for instruction in instructions:
+                original = instruction
+                if rewrite:
+                    instruction = copy_with_replacements(instruction, replacements)
+                if isinstance(instruction, GuardInstruction):
+                    if ranges.implied(instruction):
+                        continue
+                    if rewrite and in_body and isinstance(instruction, GuardCond):
+                        instruction = compare_raw(ranges, instruction)
+                    ranges.learn(instruction)
+                elif isinstance(instruction, NormalizeInstruction) and ranges.get(instruction.operand) is not None:
+                    ranges.alias(original, instruction.operand)
+                    if rewrite:
+                        replacements[original] = instruction.operand
+                    continue
+                else:
+                    ranges.define(instruction)
+                if instruction is not original:
+                    replacements[original] = instruction
+                out.append(instruction)
+            return out
+
+        ranges = ValueRanges(constant_table)
+        preamble = walk(ranges, preamble, rewrite=True)
+        copies = [CopyInstruction(copy.input, replacements.get(copy.value, copy.value)) for copy in copies]
+        starts = {copy.input: ranges.get(copy.value) for copy in copies}
+        ranges.detach(loop_inputs)
+
+        def assume(bounds):
+            body_ranges = ranges.fork()
+            for input_inst in loop_inputs:
+                body_ranges.set(input_inst, bounds.get(input_inst))
+            return body_ranges
+
+        recurrences = LoopRecurrences(preamble, self.body, RawArithmetic(constant_table, []))
+        assumptions = {}
+        for input_inst in loop_inputs:
+            start = starts.get(input_inst)
+            step = recurrences.constant_step(input_inst)
+            if start is None:
+                continue
+            if step is not None and step >= 0:
+                assumptions[input_inst] = (start[0], INT_RANGE[1])
+            elif step is not None:
+                assumptions[input_inst] = (INT_RANGE[0], start[1])
+            else:
+                assumptions[input_inst] = INT_RANGE
+
+        # Drop assumptions the body breaks until the rest hold
+        while True:
+            body_ranges = assume(assumptions)
+            walk(body_ranges, self.body)
+            next_values = {input_inst: body_ranges.get(input_inst.phi) for input_inst in assumptions}
+            broken = [input_inst for input_inst, bounds in assumptions.items()
+                      if next_values[input_inst] is None or not (bounds[0] <= next_values[input_inst][0] and next_values[input_inst][1] <= bounds[1])]
+            if not broken:
+                break
+            for input_inst in broken:
+                del assumptions[input_inst]
+
+        # The tightest bounds are between the start and wherever the body leaves the input
+        bounds = {}
+        for input_inst in assumptions:
+            start, end = starts[input_inst], next_values[input_inst]
+            bounds[input_inst] = (min(start[0], end[0]), max(start[1], end[1]))
+        self.body = walk(assume(bounds), self.body, rewrite=True, in_body=True)
+        for input_inst in loop_inputs:
+            input_inst.phi = replacements.get(input_inst.phi, input_inst.phi)
+
+        # Guard exits tag raw values themselves, so tags only they use can go
+        tags_used = {i.phi for i in loop_inputs}
+        for instruction in self.body:
+            if isinstance(instruction, GuardCond):
+                tags_used.update((instruction.operand, instruction.right))
+            elif isinstance(instruction, GuardInstruction):
+                tags_used.add(instruction.operand)
+            else:
+                tags_used.update(instruction.get_live_values())
+        for i, instruction in enumerate(self.body):
+            if isinstance(instruction, GuardInstruction) and any(isinstance(v, TagInstruction) and v not in tags_used for v in instruction.values_to_keep):
+                values_to_keep = [v.operand if isinstance(v, TagInstruction) and v not in tags_used else v for v in instruction.values_to_keep]
+                self.body[i] = instruction.copy(lambda v: v)
+                self.body[i].values_to_keep = values_to_keep
+
+        self.body, live = remove_dead_values(self.body, [i.phi for i in loop_inputs])
+        self.preamble, _ = remove_dead_values(preamble + hoisted + copies, live)
+
+    # In a tiny loop the jump back to the top and the moves into the loop
+    # inputs are a big part of every iteration. Doing several iterations per
+    # trip around the loop spreads that cost out. Each copy of the body keeps
+    # its own guards so the loop can still exit after any iteration.
+    def unroll(self, factor):
+        if factor < 2 or len(self.body) > self.MAX_UNROLLED_BODY:
+            return
+        loop_inputs = [inst for inst in self.preamble if isinstance(inst, InputInstruction) and inst.phi is not inst]
+        reductions = self.find_reductions(loop_inputs) if self.split_reductions else []
+
+        body = list(self.body)
+        later_guards = []
+        phis = {input_inst: input_inst.phi for input_inst in loop_inputs}
+        for _ in range(factor - 1):
+            mapping = dict(phis)
+            for instruction in self.body:
+                new_inst = instruction.copy(lambda v: mapping.get(v, v))
+                mapping[instruction] = new_inst
+                body.append(new_inst)
+                if isinstance(new_inst, GuardInstruction):
+                    later_guards.append(new_inst)
+            phis = {input_inst: mapping.get(input_inst.phi, input_inst.phi) for input_inst in loop_inputs}
+        for input_inst in loop_inputs:
+            input_inst.phi = phis[input_inst]
+        self.body = body
+
+        if reductions:
+            self.reassociate_reductions(reductions, later_guards)
+
+    # Loop inputs updated with a single raw add or multiply by something else
+    # in the body, like sum = sum + i. Returns (input, whether it's the left
+    # operand) pairs.
+    def find_reductions(self, loop_inputs):
+        if self.loop_state is None or self.loop_header_guard_id is None:
+            return []
+        # Guards in the later copies go back to the top of the loop, which
+        # means redoing the earlier copies, so those can't have side effects
+        if any(isinstance(inst, (SetFieldInstruction, CallHelperInstruction)) for inst in self.body):
+            return []
+        reductions = []
+        for input_inst in loop_inputs:
+            phi = input_inst.phi
+            if isinstance(phi, (AddInstruction, MulInstruction)) and phi.raw and input_inst in (phi.left, phi.right):
+                reductions.append((input_inst, phi.left is input_inst))
+        return reductions
+
+    # After unrolling a reduction is a chain acc op x1 op x2 ... where every
+    # step waits on the one before. Combining the x's first and then
+    # updating the accumulator once leaves just one step that depends on the
+    # previous trip around the loop, the same as keeping a separate
+    # accumulator per copy but without having to add them up at every exit.
+    # That only works if nothing else needs the partial results, so guards in
+    # the later copies resume at the top of the loop instead.
+    def reassociate_reductions(self, reductions, later_guards):
+        loop_inputs = [inst for inst in self.preamble if isinstance(inst, InputInstruction) and inst.phi is not inst]
+        uses = {}
+        for instruction in self.body:
+            values = instruction.get_live_values()
+            if instruction in later_guards:
+                values = values[:len(values) - len(instruction.values_to_keep)]
+            for value in values:
+                uses[value] = uses.get(value, 0) + 1
+        for input_inst in loop_inputs:
+            uses[input_inst.phi] = uses.get(input_inst.phi, 0) + 1
+
+        links = {} # step in a chain -> (accumulator, the value it adds in)
+        for accumulator, on_left in reductions:
+            value, chain = accumulator.phi, {}
+            while value is not accumulator:
+                if type(value) is not type(accumulator.phi) or (chain and uses.get(value) != 1):
+                    break
+                chain[value] = (accumulator, value.right if on_left else value.left)
+                value = value.left if on_left else value.right
+            if value is accumulator and len(chain) > 1:
+                links.update(chain)
+        if not links:
+            return
+
+        # Terms are combined in a balanced tree as soon as they're available
+        # so the combining can overlap with the rest of the body. Each
+        # pending entry is (value, how many terms it covers).
+        pending = {}
+        body = []
+        replacements = {}
+
+        def combine(cls, left, right):
+            instruction = cls(left, right)
+            instruction.raw = True
+            body.append(instruction)
+            return instruction
+
+        for instruction in self.body:
+            if instruction in later_guards:
+                instruction = instruction.copy(lambda v: replacements.get(v, v))
+                instruction.guard_id = self.loop_header_guard_id
+                instruction.values_to_keep = list(self.loop_state)
+                instruction.resume = None
+            elif instruction in links:
+                accumulator, term = links[instruction]
+                cls = type(instruction)
+                stack = pending.setdefault(accumulator, [])
+                stack.append((replacements.get(term, term), 1))
+                while len(stack) > 1 and stack[-1][1] == stack[-2][1]:
+                    (left, count), (right, _) = stack.pop(-2), stack.pop()
+                    stack.append((combine(cls, left, right), count * 2))
+                if instruction is not accumulator.phi:
+                    continue
+                combined = stack.pop()[0]
+                while stack:
+                    combined = combine(cls, stack.pop()[0], combined)
+                instruction = cls(accumulator, combined)
+                instruction.raw = True
+                replacements[accumulator.phi] = instruction
+            else:
+                new_inst = copy_with_replacements(instruction, replacements)
+                if new_inst is not instruction:
+                    replacements[instruction] = new_inst
+                instruction = new_inst
+            body.append(instruction)
+        for input_inst in loop_inputs:
+            input_inst.phi = replacements.get(input_inst.phi, input_inst.phi)
+
+        self.body, live = remove_dead_values(body, [i.phi for i in loop_inputs])
+        self.preamble, _ = remove_dead_values(self.preamble, live)
+
+    # Allocation removal. A NewInstruction starts out as a virtual object whose
+    # fields are tracked here instead of in memory. Reads of its fields are
+    # replaced by the values that were written, and guards that need the
+    # object describe it in their resume data so it only gets allocated if the
+    # guard fails. Only when a virtual escapes (stored into a real object,
+    # used by an operation we can't see through, or carried around the loop)
+    # do we emit the allocation, right at the point where it escapes.
+    def remove_allocations(self):
+        virtuals = {} # NewInstruction -> list of field values
+        replacements = {}
+        new_instructions = []
+
+        def lookup(value):
+            return replacements.get(value, value)
+
+        def force(value):
+            if value not in virtuals:
+                return
+            fields = virtuals.pop(value)
+            new_instructions.append(value)
+            for field_index, field_value in enumerate(fields):
+                if field_value is None:
+                    continue
+                force(field_value)
+                new_instructions.append(SetFieldInstruction(value, field_index, field_value))
+
+        def emit(instruction):
+            new_inst = copy_with_replacements(instruction, replacements)
+            if new_inst is not instruction:
+                replacements[instruction] = new_inst
+            new_instructions.append(new_inst)
+            return new_inst
+
+        for instruction in self.instructions:
+            if isinstance(instruction, InputInstruction):
+                new_instructions.append(instruction)
+            elif isinstance(instruction, NewInstruction):
+                virtuals[instruction] = [None] * instruction.num_fields
+            elif isinstance(instruction, SetFieldInstruction):
+                obj = lookup(instruction.obj)
+                value = lookup(instruction.value)
+                if obj in virtuals:
+                    virtuals[obj][instruction.field_index] = value
+                    continue
+                force(value)
+                emit(instruction)
+            elif isinstance(instruction, GetFieldInstruction):
+                obj = lookup(instruction.obj)
+                if obj in virtuals and virtuals[obj][instruction.field_index] is not None:
+                    replacements[instruction] = virtuals[obj][instruction.field_index]
+                    continue
+                force(obj)
+                emit(instruction)
+            elif isinstance(instruction, GuardInstruction):
+                operand = lookup(instruction.operand)
+                if operand in virtuals:
+                    if isinstance(instruction, GuardIndex) and instruction.type_index == operand.type_index:
+                        continue # We allocated it ourselves so we know its type
+                    force(operand)
+                if isinstance(instruction, GuardCond):
+                    force(lookup(instruction.right))
+                guard = emit(instruction)
+                self.virtualize_guard(guard, virtuals)
+            else:
+                for value in instruction.get_live_values():
+                    force(lookup(value))
+                emit(instruction)
+
+        # Anything carried around the loop escapes
+        for instruction in self.instructions:
+            if isinstance(instruction, InputInstruction):
+                phi = lookup(instruction.phi)
+                force(phi)
+                instruction.phi = phi
+
+        self.instructions = new_instructions
+
+    # Evaluates operations whose operands are all constants and applies simple
+    # algebraic identities. Folded results are appended to the constant table.
+    def fold_constants(self, constant_table):
+        replacements = {}
+        new_instructions = []
+
+        def lookup(value):
+            return replacements.get(value, value)
+
+        def constant_of(value):
+            if isinstance(value, ConstantInstruction):
+                return constant_table[value.constant_index]
+            return None
+
+        for instruction in self.instructions:
+            if isinstance(instruction, InputInstruction):
+                new_instructions.append(instruction)
+                continue
+
+            new_inst = copy_with_replacements(instruction, replacements)
+            if isinstance(new_inst, BinaryOpInstruction):
+                left = constant_of(new_inst.left)
+                right = constant_of(new_inst.right)
+                if left is not None and right is not None:
+                    result = evaluate_binary_op(new_inst, left, right)
+                    if result is not None:
+                        new_inst = ConstantInstruction(add_constant(constant_table, result), new_inst.type_index)
+                else:
+                    simplified = simplify_binary_op(new_inst, left, right, lambda value: add_constant(constant_table, value))
+                    if simplified is not None:
+                        if simplified is new_inst.left or simplified is new_inst.right:
+                            replacements[instruction] = simplified
+                            continue
+                        new_inst = simplified
+
+            if new_inst is not instruction:
+                replacements[instruction] = new_inst
+            new_instructions.append(new_inst)
+
+        for instruction in self.instructions:
+            if isinstance(instruction, InputInstruction):
+                instruction.phi = lookup(instruction.phi)
+
+        self.instructions = new_instructions
+
+    # Rewrites the values_to_keep of a guard so that virtual objects are
+    # described by its resume data instead of being passed back directly
+    def virtualize_guard(self, guard, virtuals):
+        if not any(v in virtuals for v in guard.values_to_keep):
+            return
+        values_to_keep = []
+        value_slots = {}
+        described = {}
+
+        def describe(value):
+            if value is None:
+                return None
+            if value in virtuals:
+                if value not in described:
+                    virtual = VirtualObject(value.type_index, [])
+                    described[value] = virtual
+                    virtual.fields = [describe(f) for f in virtuals[value]]
+                return described[value]
+            if value not in value_slots:
+                value_slots[value] = len(values_to_keep)
+                values_to_keep.append(value)
+            return value_slots[value]
+
+        guard.resume = [describe(v) for v in guard.values_to_keep]
+        guard.values_to_keep = values_to_keep
+
+    # The guard a compare turns into when it's checked to be true or false
+    TRUE_GUARDS = {EqInstruction: GuardEQ, NeInstruction: GuardNE, LtInstruction: GuardLT,
+                   GtInstruction: GuardGT, LeInstruction: GuardLE, GeInstruction: GuardGE}
+    FALSE_GUARDS = {EqInstruction: GuardNE, NeInstruction: GuardEQ, LtInstruction: GuardGE,
+                    GtInstruction: GuardLE, LeInstruction: GuardGT, GeInstruction: GuardLT}
+
     def optimize_guards(self, liveness_ranges):
         optimized_instructions = []
         skip_next = False
@@ -445,23 +1446,14 @@ class TraceCompiler:
 
             if isinstance(instruction, BoolBinInstruction) and i + 1 < len(self.instructions):
                 next_instruction = self.instructions[i + 1]
-                if isinstance(next_instruction, GuardTrue) and next_instruction.operand is instruction:
+                if isinstance(next_instruction, (GuardTrue, GuardFalse)) and next_instruction.operand is instruction:
                     # Check if the BoolBinInstruction result is no longer used
                     is_unused = liveness_ranges[instruction][1] <= i + 1
 
                     if is_unused:
-                        if isinstance(instruction, EqInstruction):
-                            optimized_instructions.append(GuardEQ(next_instruction.guard_id, instruction.left, instruction.right, next_instruction.values_to_keep))
-                        elif isinstance(instruction, NeInstruction):
-                            optimized_instructions.append(GuardNE(next_instruction.guard_id, instruction.left, instruction.right, next_instruction.values_to_keep))
-                        elif isinstance(instruction, LtInstruction):
-                            optimized_instructions.append(GuardLT(next_instruction.guard_id, instruction.left, instruction.right, next_instruction.values_to_keep))
-                        elif isinstance(instruction, GtInstruction):
-                            optimized_instructions.append(GuardGT(next_instruction.guard_id, instruction.left, instruction.right, next_instruction.values_to_keep))
-                        elif isinstance(instruction, LeInstruction):
-                            optimized_instructions.append(GuardLE(next_instruction.guard_id, instruction.left, instruction.right, next_instruction.values_to_keep))
-                        elif isinstance(instruction, GeInstruction):
-                            optimized_instructions.append(GuardGE(next_instruction.guard_id, instruction.left, instruction.right, next_instruction.values_to_keep))
+                        guards = self.TRUE_GUARDS if isinstance(next_instruction, GuardTrue) else self.FALSE_GUARDS
+                        guard_class = guards[type(instruction)]
+                        optimized_instructions.append(next_instruction.copy_resume(guard_class(next_instruction.guard_id, instruction.left, instruction.right, next_instruction.values_to_keep)))
                         skip_next = True
                         continue
 
@@ -526,7 +1518,9 @@ class TraceCompiler:
                     continue  # Remove the guard as it's sure to succeed
                 elif isinstance(instruction, GuardBool) and constant.is_boolean():
                     continue  # Remove the guard as it's sure to succeed
-                elif isinstance(instruction, GuardTrue) and constant.is_true():
+                elif isinstance(instruction, GuardTrue) and not constant.is_false():
+                    continue  # Remove the guard as it's sure to succeed
+                elif isinstance(instruction, GuardFalse) and constant.is_false():
                     continue  # Remove the guard as it's sure to succeed
                 elif isinstance(instruction, GuardIndex) and constant.is_object() and constant.get_type_index() == instruction.type_index:
                     continue  # Remove the guard as it's sure to succeed
@@ -551,16 +1545,7 @@ class TraceCompiler:
         self.instructions = optimized_instructions
 
     def pretty_print(self):
-        value_to_name = {}
-        name_counter = 0
-
-        def get_value_name(value):
-            if value not in value_to_name:
-                nonlocal name_counter
-                value_to_name[value] = f"v{name_counter}"
-                name_counter += 1
-            return value_to_name[value]
-
+        get_value_name = value_namer()
         pretty_instructions = []
         if self.preamble is not None:
             pretty_instructions.append("pre:")
@@ -575,9 +1560,531 @@ class TraceCompiler:
 
         return "\n".join(pretty_instructions)
 
-def get_liveness_ranges(instructions):
+# Gives values the names v0, v1, ... in the order they're first asked about
+def value_namer():
+    value_to_name = {}
+
+    def get_value_name(value):
+        if value not in value_to_name:
+            value_to_name[value] = f"v{len(value_to_name)}"
+        return value_to_name[value]
+
+    return get_value_name
+
+# Drops values that nothing uses. Returns the remaining instructions and every
+# value they use, including the ones in `live`.
+def remove_dead_values(instructions, live):
+    used = set(live)
+    kept = []
+    for instruction in reversed(instructions):
+        if isinstance(instruction, ValueInstruction) and not isinstance(instruction, InputInstruction) and instruction not in used:
+            continue
+        used.update(instruction.get_live_values())
+        kept.append(instruction)
+    kept.reverse()
+    return kept, used
+
+# Builds raw integer arithmetic into a list of instructions. None stands for
+# zero and anything that can be worked out at compile time is.
+class RawArithmetic:
+    def __init__(self, constant_table, instructions):
+        self.constant_table = constant_table
+        self.instructions = instructions
+        # Values that change inside the loop, and so anything built from them
+        self.variant = set()
+
+    def emit(self, instruction):
+        instruction.raw = True
+        self.instructions.append(instruction)
+        if any(v in self.variant for v in instruction.get_live_values()):
+            self.variant.add(instruction)
+        return instruction
+
+    def constant(self, value):
+        constant = ConstantInstruction(add_constant(self.constant_table, TraxObject.from_int(value)), 0)
+        return self.emit(constant)
+
+    def value_of(self, value):
+        if isinstance(value, ConstantInstruction):
+            return self.constant_table[value.constant_index].to_int()
+        return None
+
+    # Only fold results a tagged integer can hold, otherwise leave it to the machine
+    def fold(self, result):
+        if -(1 << 62) <= result < (1 << 62):
+            return self.constant(result)
+        return None
+
+    def add(self, left, right):
+        if left is None or self.value_of(left) == 0:
+            return right
+        if right is None or self.value_of(right) == 0:
+            return left
+        if self.value_of(left) is not None and self.value_of(right) is not None:
+            folded = self.fold(self.value_of(left) + self.value_of(right))
+            if folded is not None:
+                return folded
+        return self.emit(AddInstruction(left, right))
+
+    def sub(self, left, right):
+        if right is None or self.value_of(right) == 0:
+            return left
+        if left is None:
+            left = self.constant(0)
+        if self.value_of(left) is not None and self.value_of(right) is not None:
+            folded = self.fold(self.value_of(left) - self.value_of(right))
+            if folded is not None:
+                return folded
+        return self.emit(SubInstruction(left, right))
+
+    def neg(self, value):
+        if value is None:
+            return None
+        return self.sub(None, value)
+
+    def mul(self, left, right):
+        if left is None or right is None or self.value_of(left) == 0 or self.value_of(right) == 0:
+            return None
+        if self.value_of(left) == 1:
+            return right
+        if self.value_of(right) == 1:
+            return left
+        if self.value_of(left) is not None and self.value_of(right) is not None:
+            folded = self.fold(self.value_of(left) * self.value_of(right))
+            if folded is not None:
+                return folded
+        return self.emit(MulInstruction(left, right))
+
+    def div(self, value, divisor):
+        return self.emit(DivInstruction(value, self.constant(divisor)))
+
+    def shl(self, value, shift):
+        return self.emit(ShiftLeftInstruction(value, shift))
+
+    # The exact raw value of something a compare looked at
+    def exact(self, value, tagged):
+        if isinstance(value, ConstantInstruction):
+            return self.constant(self.value_of(value))
+        if tagged:
+            return self.emit(UntagInstruction(value))
+        if isinstance(value, (UntagInstruction, NormalizeInstruction, ModInstruction)):
+            return value
+        return self.emit(NormalizeInstruction(value))
+
+# Describes how raw values in a loop body change from one iteration to the
+# next. A recurrence (c1, c2) means that j iterations later
+#   value + c1 * j + c2 * j * (j - 1) / 2
+# is what the value will be. c2 is the same on every iteration while c1 can
+# depend on the current one. Induction variables only have a c1 and sums of
+# induction variables also get a c2. Values that don't change are (None, None).
+class LoopRecurrences:
+    MIRRORED = {}
+
+    def __init__(self, preamble, body, arithmetic: RawArithmetic):
+        self.arithmetic = arithmetic
+        self.loop_inputs = [inst for inst in preamble if isinstance(inst, InputInstruction) and inst.phi is not inst]
+        self.variant = arithmetic.variant
+        self.variant.update(self.loop_inputs)
+        for instruction in body:
+            if isinstance(instruction, ValueInstruction) and any(v in self.variant for v in instruction.get_live_values()):
+                self.variant.add(instruction)
+        self.recurrences = {}
+
+    def is_invariant(self, value):
+        return value is None or value not in self.variant
+
+    # The value an input changes by each time around and whether it's subtracted
+    def increment(self, input_inst):
+        phi = input_inst.phi
+        if not (input_inst.raw and phi.raw):
+            return None
+        if isinstance(phi, AddInstruction) and phi.left is input_inst:
+            return phi.right, False
+        if isinstance(phi, AddInstruction) and phi.right is input_inst:
+            return phi.left, False
+        if isinstance(phi, SubInstruction) and phi.left is input_inst:
+            return phi.right, True
+        return None
+
+    # How much an induction variable changes by, if it's the same each time
+    def step(self, input_inst):
+        increment = self.increment(input_inst)
+        if increment is None or not self.is_invariant(increment[0]):
+            return None
+        value, negated = increment
+        return self.arithmetic.neg(value) if negated else value
+
+    def constant_step(self, input_inst):
+        increment = self.increment(input_inst)
+        if increment is None or self.arithmetic.value_of(increment[0]) is None:
+            return None
+        value, negated = increment
+        step = self.arithmetic.value_of(value)
+        return -step if negated else step
+
+    def recurrence(self, value):
+        if self.is_invariant(value):
+            return (None, None)
+        if value in self.recurrences:
+            return self.recurrences[value]
+        self.recurrences[value] = None # Values that depend on themselves aren't something we understand
+        arithmetic = self.arithmetic
+        result = None
+        if isinstance(value, InputInstruction):
+            difference = self.difference(value.phi, value) if value.raw and value.phi.raw else None
+            if difference is not None:
+                recurrence = self.recurrence(difference)
+                if recurrence is not None and recurrence[1] is None and self.is_invariant(recurrence[0]):
+                    result = (difference, recurrence[0])
+        elif value.raw and isinstance(value, (AddInstruction, SubInstruction)):
+            left = self.recurrence(value.left)
+            right = self.recurrence(value.right)
+            if left is not None and right is not None:
+                combine = arithmetic.add if isinstance(value, AddInstruction) else arithmetic.sub
+                result = (combine(left[0], right[0]), combine(left[1], right[1]))
+        elif value.raw and isinstance(value, MulInstruction):
+            for operand, factor in ((value.left, value.right), (value.right, value.left)):
+                recurrence = self.recurrence(operand)
+                if recurrence is not None and self.is_invariant(factor):
+                    result = (arithmetic.mul(recurrence[0], factor), arithmetic.mul(recurrence[1], factor))
+                    break
+        elif value.raw and isinstance(value, ShiftLeftInstruction):
+            recurrence = self.recurrence(value.operand)
+            if recurrence is not None:
+                factor = arithmetic.constant(1 << value.shift)
+                result = (arithmetic.mul(recurrence[0], factor), arithmetic.mul(recurrence[1], factor))
+        self.recurrences[value] = result
+        return result
+
+    # Finds d such that value = input_inst + d by looking through adds and
+    # subtracts, or returns None. A difference of zero is the constant 0.
+    def difference(self, value, input_inst):
+        arithmetic = self.arithmetic
+        if value is input_inst:
+            return arithmetic.constant(0)
+        if not (value.raw and isinstance(value, (AddInstruction, SubInstruction))):
+            return None
+        left = self.difference(value.left, input_inst)
+        if left is not None:
+            return arithmetic.add(left, value.right) if isinstance(value, AddInstruction) else arithmetic.sub(left, value.right)
+        if isinstance(value, AddInstruction):
+            right = self.difference(value.right, input_inst)
+            if right is not None:
+                return arithmetic.add(value.left, right)
+        return None
+
+    # Picks apart a compare guard between an induction variable (plus a
+    # constant offset) and something that doesn't change in the loop. Returns
+    # (variable, offset, guard class with the variable on the left, bound,
+    # whether the compare was on tagged values) or None.
+    def compare_on_induction_variable(self, guard):
+        if type(guard) not in self.MIRRORED:
+            return None
+        cls, operand, bound = type(guard), guard.operand, guard.right
+        if self.is_invariant(operand):
+            cls, operand, bound = self.MIRRORED[cls], bound, operand
+        if not self.is_invariant(bound) or not isinstance(operand, (TagInstruction, NormalizeInstruction)):
+            return None
+        tagged = isinstance(operand, TagInstruction)
+        variable, offset = operand.operand, 0
+        if isinstance(variable, AddInstruction) and variable.raw and self.arithmetic.value_of(variable.right) is not None:
+            variable, offset = variable.left, self.arithmetic.value_of(variable.right)
+        if variable not in self.loop_inputs or self.step(variable) is None:
+            return None
+        return variable, offset, cls, bound, tagged
+
+    # For an exit guard on an induction variable stepping by one towards its
+    # bound, builds how many more times the guard will pass counting the
+    # current one. Only meaningful once the guard has passed.
+    def trip_count(self, guard):
+        compare = self.compare_on_induction_variable(guard)
+        if compare is None:
+            return None
+        variable, offset, cls, bound, tagged = compare
+        step = self.constant_step(variable)
+        if offset != 0 or step != (1 if cls in (GuardLT, GuardLE) else -1):
+            return None
+        arithmetic = self.arithmetic
+        current = guard.operand if isinstance(guard.operand, NormalizeInstruction) and guard.operand.operand is variable else arithmetic.exact(variable, False)
+        bound = arithmetic.exact(bound, tagged)
+        count = arithmetic.sub(bound, current) if step == 1 else arithmetic.sub(current, bound)
+        if cls in (GuardLE, GuardGE):
+            count = arithmetic.add(count, arithmetic.constant(1))
+        return count
+
+LoopRecurrences.MIRRORED = {GuardLT: GuardGT, GuardGT: GuardLT, GuardLE: GuardGE, GuardGE: GuardLE}
+
+# Every integer a tagged value can hold
+INT_RANGE = (-(1 << 62), (1 << 62) - 1)
+
+# Bounds on the integers values stand for, as (low, high) pairs. Tagged
+# integers always have bounds, at worst INT_RANGE. Raw values only have them
+# while we know they haven't wrapped, which is exactly when they don't need
+# sign extending. A value converted to another form without changing the
+# integer shares its bounds with the original, so a compare on one narrows
+# both. Likewise narrowing a constant offset from a value that didn't wrap
+# narrows the value.
+class ValueRanges:
+    def __init__(self, constant_table):
+        self.constant_table = constant_table
+        self.ranges = {}
+        self.same = {}
+        self.offsets = {} # value -> (base, offset) for value = base + offset
+
+    def fork(self):
+        other = ValueRanges(self.constant_table)
+        other.ranges = dict(self.ranges)
+        other.same = dict(self.same)
+        other.offsets = dict(self.offsets)
+        return other
+
+    # Stops values sharing bounds with any of `values`, keeping what they had
+    def detach(self, values):
+        for value, original in list(self.same.items()):
+            if original in values:
+                del self.same[value]
+                if original in self.ranges:
+                    self.ranges[value] = self.ranges[original]
+        for value, (base, _) in list(self.offsets.items()):
+            if self.find(base) in values:
+                del self.offsets[value]
+
+    def find(self, value):
+        return self.same.get(value, value)
+
+    def get(self, value):
+        if isinstance(value, ConstantInstruction):
+            if value.raw or value.type_index == 0:
+                constant = self.constant_table[value.constant_index].to_int()
+                return (constant, constant)
+            return None
+        return self.ranges.get(self.find(value))
+
+    def set(self, value, bounds):
+        if isinstance(value, ConstantInstruction):
+            return
+        if bounds is None:
+            self.ranges.pop(self.find(value), None)
+        else:
+            self.ranges[self.find(value)] = bounds
+
+    def alias(self, value, original):
+        self.same[value] = self.find(original)
+
+    def narrow(self, value, low, high):
+        bounds = self.get(value)
+        if bounds is None:
+            return
+        self.set(value, (max(low, bounds[0]), min(high, bounds[1])))
+        if self.find(value) in self.offsets:
+            base, offset = self.offsets[self.find(value)]
+            self.narrow(base, low - offset, high - offset)
+
+    @staticmethod
+    def combine(op, left, right):
+        results = [op(a, b) for a in left for b in right]
+        if min(results) < INT_RANGE[0] or max(results) > INT_RANGE[1]:
+            return None
+        return (min(results), max(results))
+
+    def arithmetic(self, instruction):
+        if isinstance(instruction, ShiftLeftInstruction):
+            left, right = self.get(instruction.operand), (1 << instruction.shift, 1 << instruction.shift)
+        else:
+            left, right = self.get(instruction.left), self.get(instruction.right)
+        if left is None or right is None:
+            return None
+        if isinstance(instruction, AddInstruction):
+            return self.combine(lambda a, b: a + b, left, right)
+        if isinstance(instruction, SubInstruction):
+            return self.combine(lambda a, b: a - b, left, right)
+        if isinstance(instruction, (MulInstruction, ShiftLeftInstruction)):
+            return self.combine(lambda a, b: a * b, left, right)
+        if right[0] <= 0 <= right[1]:
+            return None
+        if isinstance(instruction, DivInstruction):
+            return self.combine(trunc_div, left, right)
+        # The remainder is smaller than the divisor and has the dividend's sign
+        largest = max(abs(right[0]), abs(right[1])) - 1
+        return (max(-largest, min(0, left[0])), min(largest, max(0, left[1])))
+
+    # Works out the bounds of a value when it's defined
+    def define(self, instruction):
+        if isinstance(instruction, UntagInstruction):
+            self.alias(instruction, instruction.operand)
+            if self.get(instruction) is None:
+                self.set(instruction, INT_RANGE)
+        elif isinstance(instruction, (TagInstruction, NormalizeInstruction)):
+            if self.get(instruction.operand) is not None:
+                self.alias(instruction, instruction.operand)
+            else:
+                self.set(instruction, INT_RANGE)
+        elif isinstance(instruction, (IntBinInstruction, ShiftLeftInstruction)):
+            bounds = self.arithmetic(instruction)
+            if bounds is not None and isinstance(instruction, (AddInstruction, SubInstruction)):
+                left, right = self.get(instruction.left), self.get(instruction.right)
+                if right[0] == right[1]:
+                    self.offsets[instruction] = (instruction.left, right[0] if isinstance(instruction, AddInstruction) else -right[0])
+                elif left[0] == left[1] and isinstance(instruction, AddInstruction):
+                    self.offsets[instruction] = (instruction.right, left[0])
+            # Tagged arithmetic wraps around to another integer
+            if bounds is None and not instruction.raw:
+                bounds = INT_RANGE
+            self.set(instruction, bounds)
+
+    def compared(self, guard):
+        left, right = self.get(guard.operand), self.get(guard.right)
+        if left is None or right is None:
+            return None
+        if isinstance(guard, (GuardGT, GuardGE)):
+            return right, left
+        return left, right
+
+    # Whether a guard can't fail
+    def implied(self, guard):
+        if isinstance(guard, GuardNonZero):
+            bounds = self.get(guard.operand)
+            return bounds is not None and not (bounds[0] <= 0 <= bounds[1])
+        if not isinstance(guard, GuardCond):
+            return False
+        compared = self.compared(guard)
+        if compared is None:
+            return False
+        left, right = compared
+        if isinstance(guard, (GuardLT, GuardGT)):
+            return left[1] < right[0]
+        if isinstance(guard, (GuardLE, GuardGE)):
+            return left[1] <= right[0]
+        if isinstance(guard, GuardEQ):
+            return left[0] == left[1] == right[0] == right[1]
+        return left[1] < right[0] or right[1] < left[0]
+
+    # Narrows bounds with what we know once a guard has passed
+    def learn(self, guard):
+        if isinstance(guard, GuardInt):
+            if self.get(guard.operand) is None:
+                self.set(guard.operand, INT_RANGE)
+            return
+        if isinstance(guard, GuardNonZero):
+            bounds = self.get(guard.operand)
+            if bounds is not None:
+                low, high = bounds
+                self.narrow(guard.operand, 1 if low == 0 else low, -1 if high == 0 else high)
+            return
+        if not isinstance(guard, GuardCond) or isinstance(guard, GuardNE):
+            return
+        compared = self.compared(guard)
+        if compared is None:
+            return
+        (left_low, left_high), (right_low, right_high) = compared
+        smaller, larger = (guard.right, guard.operand) if isinstance(guard, (GuardGT, GuardGE)) else (guard.operand, guard.right)
+        if isinstance(guard, GuardEQ):
+            self.narrow(smaller, right_low, right_high)
+            self.narrow(larger, left_low, left_high)
+            return
+        gap = 1 if isinstance(guard, (GuardLT, GuardGT)) else 0
+        self.narrow(smaller, INT_RANGE[0], right_high - gap)
+        self.narrow(larger, left_low + gap, INT_RANGE[1])
+
+# Only copies an instruction if one of its operands is being replaced
+def copy_with_replacements(instruction, replacements):
+    if any(v in replacements for v in instruction.get_live_values()):
+        return instruction.copy(lambda v: replacements.get(v, v))
+    return instruction
+
+# Adds a value to the constant table, reusing an existing entry if there is one
+def add_constant(constant_table, value: TraxObject):
+    for i, constant in enumerate(constant_table):
+        if constant.value == value.value:
+            return i
+    constant_table.append(value)
+    return len(constant_table) - 1
+
+# Computes what a binary operation on two constants produces, or None if it
+# can't be done at compile time
+def evaluate_binary_op(instruction, left: TraxObject, right: TraxObject):
+    if isinstance(instruction, (EqInstruction, NeInstruction)):
+        result = left.value == right.value
+        if isinstance(instruction, NeInstruction):
+            result = not result
+        return TraxObject(TraxObject.TRUE_TAG if result else TraxObject.FALSE_TAG)
+    if not (left.is_integer() and right.is_integer()):
+        return None
+    a = left.to_int()
+    b = right.to_int()
+    if isinstance(instruction, AddInstruction):
+        return TraxObject.from_int(a + b)
+    elif isinstance(instruction, SubInstruction):
+        return TraxObject.from_int(a - b)
+    elif isinstance(instruction, MulInstruction):
+        return TraxObject.from_int(a * b)
+    elif isinstance(instruction, DivInstruction):
+        return TraxObject.from_int(trunc_div(a, b)) if b != 0 else None
+    elif isinstance(instruction, ModInstruction):
+        return TraxObject.from_int(trunc_mod(a, b)) if b != 0 else None
+    elif isinstance(instruction, LtInstruction):
+        result = a < b
+    elif isinstance(instruction, LeInstruction):
+        result = a <= b
+    elif isinstance(instruction, GtInstruction):
+        result = a > b
+    elif isinstance(instruction, GeInstruction):
+        result = a >= b
+    else:
+        return None
+    return TraxObject(TraxObject.TRUE_TAG if result else TraxObject.FALSE_TAG)
+
+# Algebraic identities for a binary operation where at most one side is a
+# constant. Returns the replacement value (possibly one of the operands) or
+# None if nothing applies. `new_constant` adds a value to the constant table.
+def simplify_binary_op(instruction, left: TraxObject, right: TraxObject, new_constant):
+    def int_value(constant):
+        if constant is not None and constant.is_integer():
+            return constant.to_int()
+        return None
+
+    a = int_value(left)
+    b = int_value(right)
+    if instruction.left is instruction.right:
+        if isinstance(instruction, (EqInstruction, LeInstruction, GeInstruction)):
+            return ConstantInstruction(new_constant(TraxObject(TraxObject.TRUE_TAG)), instruction.type_index)
+        if isinstance(instruction, (NeInstruction, LtInstruction, GtInstruction)):
+            return ConstantInstruction(new_constant(TraxObject(TraxObject.FALSE_TAG)), instruction.type_index)
+        if isinstance(instruction, SubInstruction):
+            return ConstantInstruction(new_constant(TraxObject.from_int(0)), instruction.type_index)
+
+    if isinstance(instruction, AddInstruction):
+        if b == 0:
+            return instruction.left
+        if a == 0:
+            return instruction.right
+    elif isinstance(instruction, SubInstruction):
+        if b == 0:
+            return instruction.left
+    elif isinstance(instruction, MulInstruction):
+        if b == 1:
+            return instruction.left
+        if a == 1:
+            return instruction.right
+        if a == 0 or b == 0:
+            return ConstantInstruction(new_constant(TraxObject.from_int(0)), instruction.type_index)
+        # A tagged integer shifted left is still a tagged integer
+        if b is not None and b > 0 and b & (b - 1) == 0:
+            return ShiftLeftInstruction(instruction.left, b.bit_length() - 1)
+        if a is not None and a > 0 and a & (a - 1) == 0:
+            return ShiftLeftInstruction(instruction.right, a.bit_length() - 1)
+    elif isinstance(instruction, DivInstruction):
+        if b == 1:
+            return instruction.left
+    return None
+
+# If loop_start is given, instructions[loop_start:] is a loop body that jumps
+# back to its start. Anything from before the loop that the body uses, and
+# every input, then has to stay live for the whole loop.
+def get_liveness_ranges(instructions, loop_start=None):
     liveness = {}
-    phi_nodes = {}
+    # A phi can come before its input, e.g. a value hoisted into the preamble
+    phi_nodes = {inst.phi: inst for inst in instructions if isinstance(inst, InputInstruction) and inst.phi is not None}
 
     def update_liveness(value, idx):
         start, end = liveness[value]
@@ -589,10 +2096,6 @@ def get_liveness_ranges(instructions):
         if isinstance(inst, ValueInstruction):
             liveness[inst] = (idx, idx)
 
-        # We'll use this later to tie the knot if possible
-        if isinstance(inst, InputInstruction) and inst.phi is not None:
-            phi_nodes[inst.phi] = inst
-
         # phi_nodes never die
         if inst in phi_nodes:
             liveness[inst] = (idx, len(instructions))
@@ -601,17 +2104,26 @@ def get_liveness_ranges(instructions):
         for value in inst.get_live_values():
             update_liveness(value, idx)
 
+    if loop_start is not None:
+        for value, (start, end) in liveness.items():
+            if start < loop_start and (end >= loop_start or (isinstance(value, InputInstruction) and value.phi is not value)):
+                liveness[value] = (start, len(instructions))
+
     return liveness
 
-def allocate_registers(instructions, available_registers):
-    liveness_ranges = get_liveness_ranges(instructions)
+# Values in `skip` don't get a register, the backend handles them some other way
+def allocate_registers(instructions, available_registers, loop_start=None, skip=()):
+    liveness_ranges = get_liveness_ranges(instructions, loop_start)
+    # Inputs are kept alive across the whole loop, but a loop carried value can
+    # still take over its input's register once the input itself is dead
+    last_uses = get_liveness_ranges(instructions) if loop_start is not None else liveness_ranges
     register_allocation = {}
     used_registers = set()
     phi_nodes = {}
 
     for idx, inst in enumerate(instructions):
         for value in inst.get_live_values():
-            if liveness_ranges[value][1] == idx:
+            if liveness_ranges[value][1] == idx and value in register_allocation:
                 reg = register_allocation[value]
                 if reg in used_registers:
                     used_registers.remove(reg)
@@ -620,15 +2132,15 @@ def allocate_registers(instructions, available_registers):
         if isinstance(inst, InputInstruction) and inst.phi is not None:
             phi_nodes[inst.phi] = inst
 
-        if isinstance(inst, ValueInstruction):
+        if isinstance(inst, ValueInstruction) and inst not in skip:
             # If this is a phi node, try our best to tie the knot.
             # If an input is its own phi node, there's nothing special we need to do
-            # if inst in phi_nodes and phi_nodes[inst] is not inst:
-            #     if register_allocation[phi_nodes[inst]] not in used_registers:
-            #         reg = register_allocation[phi_nodes[inst]]
-            #         register_allocation[inst] = reg
-            #         used_registers.add(reg)
-            #         continue
+            if loop_start is not None and idx >= loop_start and inst in phi_nodes and phi_nodes[inst] is not inst:
+                input_inst = phi_nodes[inst]
+                # If the input is itself carried into another input its old value is needed at the end
+                if input_inst in register_allocation and last_uses[input_inst][1] <= idx and input_inst not in phi_nodes:
+                    register_allocation[inst] = register_allocation[input_inst]
+                    continue
 
             # Find the first available register
             for reg in available_registers:
@@ -640,3 +2152,79 @@ def allocate_registers(instructions, available_registers):
                 # TODO: Implement spilling
                 raise ValueError("Not enough registers for allocation")
     return register_allocation
+
+# List scheduling for straight line code. Instructions are reordered so that
+# values have time to be computed before they're used, going by the
+# latencies the backend gives for each instruction. Guards, stores and
+# allocations keep their original order, and loads and divisions don't move
+# above a guard since the guard might be what makes them safe to run. Of the
+# instructions that are ready the one with the longest chain of latencies
+# after it goes first.
+#
+# `carried` maps the values that become loop inputs next time around to
+# those inputs. Uses of an input that came before its next value still do,
+# so the register allocator can keep both in the same register.
+def schedule_instructions(instructions, latency, carried=None):
+    position = {inst: i for i, inst in enumerate(instructions)}
+    data_preds = {inst: set() for inst in instructions}
+    order_preds = {inst: set() for inst in instructions}
+    replaced_by = {input_inst: phi for phi, input_inst in (carried or {}).items() if phi in position}
+    last_ordered = None
+    loads = []
+    for inst in instructions:
+        data_preds[inst].update(v for v in inst.get_live_values() if v in position)
+        for value in inst.get_live_values():
+            phi = replaced_by.get(value)
+            if phi is not None and phi is not inst and position[inst] < position[phi]:
+                order_preds[phi].add(inst)
+        ordered = isinstance(inst, (GuardInstruction, SetFieldInstruction, NewInstruction, CallHelperInstruction))
+        if last_ordered is not None and (ordered or isinstance(inst, (GetFieldInstruction, DivInstruction, ModInstruction))):
+            order_preds[inst].add(last_ordered)
+        if isinstance(inst, GuardSuccess) and inst.operand in position:
+            # The call branches to this guard's exit itself, so everything the
+            # exit keeps has to be ready by then
+            call = inst.operand
+            order_preds[call].update(v for v in inst.values_to_keep if v in position and position[v] < position[call])
+        if isinstance(inst, (SetFieldInstruction, NewInstruction, CallHelperInstruction)):
+            # Stores can't go above loads that might read what they overwrite
+            order_preds[inst].update(loads)
+            loads = []
+        if isinstance(inst, GetFieldInstruction):
+            loads.append(inst)
+        if ordered:
+            last_ordered = inst
+
+    succs = {inst: [] for inst in instructions}
+    for inst in instructions:
+        for pred in data_preds[inst] | order_preds[inst]:
+            succs[pred].append(inst)
+    height = {}
+    for inst in reversed(instructions):
+        height[inst] = latency(inst) + max((height[s] for s in succs[inst]), default=0)
+
+    waiting = {inst: len(data_preds[inst] | order_preds[inst]) for inst in instructions}
+    ready_at = {inst: 0 for inst in instructions}
+    ready = [inst for inst in instructions if waiting[inst] == 0]
+    scheduled = []
+    cycle = 0
+    while ready:
+        available = [inst for inst in ready if ready_at[inst] <= cycle]
+        if not available:
+            cycle = min(ready_at[inst] for inst in ready)
+            continue
+        # Guards that can go right after each other do, so the backend can
+        # check them together
+        following = [i for i in available if isinstance(i, GuardInstruction) and scheduled and scheduled[-1] in order_preds[i]]
+        inst = max(following or available, key=lambda i: (height[i], -position[i]))
+        ready.remove(inst)
+        scheduled.append(inst)
+        for succ in succs[inst]:
+            delay = latency(inst) if inst in data_preds[succ] else 1
+            ready_at[succ] = max(ready_at[succ], cycle + delay)
+            waiting[succ] -= 1
+            if waiting[succ] == 0:
+                ready.append(succ)
+        # Instructions with no latency don't turn into any code
+        if latency(inst):
+            cycle += 1
+    return scheduled